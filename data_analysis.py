@@ -28,82 +28,240 @@ nltk resources:
 """
 
 #Necessary imports
-from nltk.corpus import cmudict
 import sqlite3
-import matplotlib.pyplot as plt
 import random
+import re
 import numpy as np
+from data_store import open_db, tokenize_media, load_vocab, decode_tokens
+from data_text import normalize_lyrics
+from data_corpus import CountTable, corpus_word_counts, song_averages, csr_row, csr_matrix
+from data_corpus import load_corpus, corpus_groupings
+from data_stream import stream_media, parallel_media
+from data_counts import stratum_word_counts, stratum_syllables, stratum_song_sums
+from data_syllables import nsyl, syllables, syllable_vector #the compiled cmudict table
 
-cmu = cmudict.dict() #globalize the cmu
+#the database, opened by db() on first use so that importing this file does no 
+#work (cmudict and matplotlib are loaded on first use too)
+db_path = 'song_records.db'
+conn    = None
 
-try: #open the database
-    conn = sqlite3.connect('song_records.db')
-    curs    = conn.cursor()
-    print("Connection Successful")
 
-except:
-    print("Could not connect to sqlite3 db...")
+def db():
+    """
+    The connection to the database. Opened on first use, when the songs added
+    since the last run are tokenized.
+    """
+    global conn
+    
+    if conn is None:
+        conn = open_db(db_path)
+        tokenize_media(conn) #tokenize songs added since the last run
+    
+    return conn
 
 
-def sanitize(corpora_word_dict):
+def sanitize(corpora_word_dict,rules=None):
     """
     Filter out nonsensical words and characters that are left from the 
     extraction and filtering.
+    
+    Every rule looks at the whole vocabulary at once (see vocab_mask), and the
+    words that fail any rule are dropped from every corpus in one pass.
+    
+    Inputs:
+        -corpora_word_dict: {key: {word: count}} dictionaries, filtered in 
+                            place, or a data_corpus.CountTable
+        -rules: list of vocabulary rules, sanitize_rules by default
+    
+    Output:
+        -None for dictionaries (they are changed in place), the filtered 
+         CountTable for a CountTable
     """    
+    table = (corpora_word_dict if isinstance(corpora_word_dict,CountTable) 
+             else dicts_table(corpora_word_dict))
     
-    #get the genres/years 
-    corpora_keys = [k for k in corpora_word_dict.keys()]
+    keep = vocab_mask(table,rules)
     
-    #a list of lists of all words
-    all_words_list  = [corpora_word_dict[k] for k in corpora_keys]
+    if isinstance(corpora_word_dict,CountTable):
+        return drop_columns(table,keep)
     
-    #remove repeats from all_words_list
-    all_words = [set(w for d in all_words_list for w in [w for w in d.keys()])]
+    #now conform the working corpora_word_dict to the kept words
+    for i, corpus_key in enumerate(table.keys):
+        corpus = corpora_word_dict[corpus_key]
+        words, _ = csr_row(table.counts,i)
+        
+        for w in words[~keep[words]].tolist():
+            corpus.pop(table.vocab[w])
+
+def length_bounds(shortest=4,longest=16):
+    """
+    Rule: keep words of shortest to longest characters.
+    """
+    def rule(info):
+        return (info['lengths'] >= shortest) & (info['lengths'] <= longest)
+    return rule
+
+def drop_stopwords(stopwords):
+    """
+    Rule: drop the words of a list of stopwords.
+    """
+    stopwords = set(stopwords)
+    def rule(info):
+        return np.fromiter((w not in stopwords for w in info['words']),dtype=bool,count=len(info['words']))
+    return rule
+
+def min_frequency(n):
+    """
+    Rule: keep words used at least n times in the whole data set.
+    """
+    def rule(info):
+        return info['totals'] >= n
+    return rule
+
+def drop_matching(pattern):
+    """
+    Rule: drop the words a regular expression matches (anywhere in the word).
+    """
+    pattern = re.compile(pattern)
+    def rule(info):
+        return np.fromiter((pattern.search(w) is None for w in info['words']),dtype=bool,count=len(info['words']))
+    return rule
+
+#the default rules of sanitize. after scanning through the data set, it is 
+#notable that words below 4 and above 16 characters have no context meaning.
+sanitize_rules = [length_bounds(4,16)]
+
+def vocab_mask(table,rules=None):
+    """
+    Run vocabulary rules over the vocabulary of a count table.
     
-    #create the actual word set oobject
-    all_words_ = set()
+    A rule is a function of a dictionary holding the vocabulary ('words'), 
+    the length of every word ('lengths') and every word's count over the 
+    whole table ('totals'), that returns a boolean array of the words to keep.
     
-    #for each corpus word set, union it with all_words_
-    for set_ in all_words:
-        all_words_ = all_words_.union(set_)
+    Output:
+        -boolean array over the vocabulary, True for the words every rule keeps
+    """
+    rules  = sanitize_rules if rules is None else rules
+    counts = table.counts
+    info   = {'words'  :table.vocab,
+              'lengths':np.fromiter(map(len,table.vocab),dtype=np.int64,count=len(table.vocab)),
+              'totals' :np.bincount(counts['indices'],weights=counts['data'],
+                                    minlength=len(table.vocab)).astype(np.int64)}
+    
+    keep = np.ones(len(table.vocab),dtype=bool)
+    for rule in rules:
+        keep &= rule(info)
+    
+    return keep
+
+def drop_columns(table,keep):
+    """
+    Drop the words keep marks False from every corpus of a count table.
     
-    #voila! a list of all unique words in the data set
-    all_words_ = list(all_words_)
+    Output:
+        -CountTable over the kept words only
+    """
+    counts  = table.counts
+    new_ids = np.cumsum(keep) - 1 #where every kept word moves to
     
-    # single out words that are less than 4 and greater than 16 characters.
-    #after scanning through the data set, it is notable that below and above these
-    #benchmarks respectively are words that have no context meaning.
-    too_small = [w for w in all_words_ if len(w) < 4]
-    too_big = [w for w in all_words_ if len(w) > 16]
-    
-    #filter out bigs and smalls
-    all_words_ = [w for w in all_words_ if (w not in too_small and w not in too_big)]
-    
-    #now conform the working corpora_word_dict to the word set of all_words_
-    for corpus_key in corpora_keys:
-       
-       corpus = corpora_word_dict[corpus_key]
-       corpus_words = [key for key in corpus.keys()]
-       
-       for word in corpus_words:
-           
-           if word not in all_words_:
-               corpus.pop(word)
+    row_keep = keep[counts['indices']]
+    
+    #kept values before every row start = the new row starts
+    kept_before = np.zeros(len(row_keep) + 1,dtype=np.int64)
+    np.cumsum(row_keep,out=kept_before[1:])
+    indptr = kept_before[np.asarray(counts['indptr']).astype(np.int64)]
+    
+    vocab = [w for w, kept in zip(table.vocab,keep.tolist()) if kept]
+    
+    return CountTable(table.keys,
+                      csr_matrix(indptr,new_ids[counts['indices'][row_keep]].astype(np.uint32),
+                                 counts['data'][row_keep],(len(table.keys),len(vocab))),vocab)
+
+def scan_media(groupings=('genre',)):
+    """
+    Read media once and group its songs every way the analysis needs. The 
+    keys of every grouping are the values found in the data.
+    
+    Input:
+        -groupings: any of 'genre', 'year', 'decade', 'calendar_decade', 
+                    'artist', or a tuple of them for a cube (ex: ('genre','year')).
+                    'decade' buckets the years like stratify_by_year (2010 
+                    goes with 2000-2010), see data_corpus.decade_label
+    
+    Output:
+        -the corpus of media (data_corpus.load_corpus), and a dictionary of 
+         grouping to strata (key to an array of song indices). The strata go 
+         to count_word_occurrence and count_syls together with the corpus.
+    """
+    corpus = load_corpus(db())
+    
+    return corpus, corpus_groupings(corpus,groupings)
+
+def stream_stats(by='genre',size=None,max_bytes=None,workers=1,syllables=True):
+    """
+    The word counts and syllabic averages of a stratification, computed from 
+    media one fetchmany chunk at a time (data_stream.stream_media), for data 
+    sets that do not fit in memory.
+    
+    Inputs:
+        -by: 'genre', 'year', 'decade', 'artist' or a tuple of them
+        -size: songs per chunk
+        -max_bytes: memory budget of the word counts before they spill to disk
+        -workers: processes counting rowid ranges of media in parallel 
+                  (data_stream.parallel_media), None => one per cpu. The
+                  results are the same for any amount of workers.
+        -syllables: False to only count words (the syllable table is not
+                    loaded)
+    
+    Output:
+        -CountTable for yule_batch, and the dictionary count_syls returns 
+         (None without syllables)
+    """
+    conn = db()
+    tokenize_media(conn)
+    syls, weights = vocab_syllables(load_vocab(conn)) if syllables else (None,None)
+    
+    if workers == 1:
+        table, avgs = stream_media(conn,by,syls,weights,size,max_bytes)
+    else:
+        table, avgs = parallel_media(conn,by,syls,weights,workers,None,size,max_bytes)
+    
+    return table, (avgs if syllables else None)
+
+def aggregate_stats(by='genre'):
+    """
+    The word counts and syllabic averages of every genre, year or decade, 
+    read from the per stratum aggregates the database keeps up to date 
+    (data_counts). Only the songs changed since the last call are counted.
+    
+    Output:
+        -CountTable for yule_batch, and the dictionary count_syls returns
+    """
+    conn = db()
+    return stratum_word_counts(conn,by), stratum_syllables(conn,by)
 
 def stratify_by_genre():
     """
     Group the data by genre. Put each data point in its genre list and return 
     the dictionary of lists for each genre. This is the 'strat_dict' mentioned in
     other functions.    
+    
+    (scan_media groups the songs without building a dictionary per row)
     """     
     #grab all the data
-    curs.execute("SELECT song_name, artist_name, lyrics, genre, year FROM media")
+    conn = db()
+    curs = conn.cursor()
+    tokenize_media(conn) #every song with lyrics has its word ids
+    curs.execute("SELECT song_name, artist_name, lyrics, genre, year, tokens FROM media")
     all_data = curs.fetchall()
+    vocab    = load_vocab(conn)
     
     #organize each    
     row_list = []    
     for data in all_data:
-        row_dict = {'song':data[0],'artist':data[1],'lyrics':data[2],'genre':data[3]}
+        row_dict = {'song':data[0],'artist':data[1],'lyrics':data[2],'genre':data[3],
+                    'tokens':song_tokens(data[5],data[2],vocab),'ids':song_ids(data[5])}
         row_list.append(row_dict)
     
     #empty dictionary for each corpus
@@ -124,17 +282,23 @@ def stratify_by_year(choice):
     of lists for each genre. This is the 'strat_dict' mentioned in 
     other functions.  
     
+    (scan_media groups the songs without building a dictionary per row)
     """
     
     #grab all the data
-    curs.execute("SELECT song_name, artist_name, lyrics, genre, year FROM media")
+    conn = db()
+    curs = conn.cursor()
+    tokenize_media(conn) #every song with lyrics has its word ids
+    curs.execute("SELECT song_name, artist_name, lyrics, genre, year, tokens FROM media")
     all_data = curs.fetchall()
+    vocab    = load_vocab(conn)
     
     #organize each    
     row_list = []    
     for data in all_data:
         row_dict = {'song':data[0],'artist':data[1],'lyrics':data[2],'genre':data[3],
-                    'year':data[4]}
+                    'year':data[4],'tokens':song_tokens(data[5],data[2],vocab),
+                    'ids':song_ids(data[5])}
         row_list.append(row_dict)
     
     #individual year dictionary
@@ -164,46 +328,142 @@ def stratify_by_year(choice):
             
     return the_year_dict #return it regardless
 
+def song_tokens(blob,lyrics,vocab):
+    """
+    The words of a song, from its pre-tokenized media.tokens blob (see 
+    data_store.tokenize_media). Falls back to data_text.normalize_lyrics 
+    for a song that has not been tokenized.
+    
+    Inputs:
+        -blob: the tokens column of the song (None if not tokenized)
+        -lyrics: the lyrics column of the song
+        -vocab: list of words indexed by word id (data_store.load_vocab)
+    
+    Output:
+        -list of words
+    """
+    if blob is None:
+        return normalize_lyrics(lyrics)
+    
+    return list(map(vocab.__getitem__,decode_tokens(blob)))
+
+def song_ids(blob):
+    """
+    The word ids of a song as a read only NumPy view of its media.tokens blob 
+    (nothing is copied). Empty for a song without tokens.
+    """
+    if blob is None:
+        return np.zeros(0,dtype=np.uint32)
+    
+    return np.frombuffer(blob,dtype=np.uint32)
+
 
 ###############################################################################
 ############################ COMPUTE YULES ####################################
 ############################################################################### 
-def count_word_occurrence(strat_dict):   
+def count_word_occurrence(strat_dict,corpus=None):   
     """
     Count the word occurrence of a each word in an already stratified dictionary.
     Return the count dictionary.
     
     Inputs:
         -strat_dict ---> A dictionary that has the data stratified by year or genre
+        -corpus     ---> A memory mapped corpus (data_corpus.open_corpus). When 
+                         given, strat_dict maps each key to song indices of the
+                         corpus (data_corpus.corpus_strata) instead of rows.
     
     Output:
         -Word Occurrence counts for every word in the strat_dict corpuses
     
     """    
-    #iterable keys
-    keys = [key for key in strat_dict.keys()]
+    if corpus is not None: #sum the rows of the corpus' count matrix
+        return table_dicts(corpus_word_counts(corpus,strat_dict))
+    
+    #the word ids index the shared vocabulary, so one integer count array 
+    #per corpus holds all of its counts
+    vocab = load_vocab(db())
     
     #empty word counts
     corpora_word_counts = {}
     
-    for key in keys: #iterate over keys
-        corpus = strat_dict[key]  #crack open one corpus
-        corpus_word_set = list()  #make an empty list
-        
-        for row in corpus: #iterate over data in that corpus
-            lyric_set = list(set(row['lyrics'].split()))  #split it into words
-            corpus_word_set = corpus_word_set + lyric_set #add it to the big dictionary
-        
-        corpus_word_dict = {w:0 for w in corpus_word_set} #empty counts
-        
-        for row in corpus: #populate counter
-            for word in row['lyrics'].split():
-                corpus_word_dict[word] +=1
-        
-        corpora_word_counts[key] = corpus_word_dict
+    for key, corpus in strat_dict.items(): #iterate over corpora
+        counts = word_counts(corpus,len(vocab))
+        corpora_word_counts[key] = count_dict(counts,vocab)
     
     return corpora_word_counts #return the counts
 
+def word_counts(rows,n_vocab):
+    """
+    Count every word id of a list of rows (from the stratify functions) in one 
+    pass: the ids of all songs are joined and counted with a single bincount.
+    
+    Inputs:
+        -rows: list of row dictionaries with an 'ids' array
+        -n_vocab: size of the vocabulary
+    
+    Output:
+        -array of counts indexed by word id
+    """
+    if not rows:
+        return np.zeros(n_vocab,dtype=np.int64)
+    
+    ids = np.concatenate([row['ids'] for row in rows])
+    
+    return np.bincount(ids,minlength=n_vocab)
+
+def table_dicts(table):
+    """
+    Turn a data_corpus.CountTable into the {key: {word: count}} dictionaries
+    count_word_occurrence returns.
+    """
+    corpora_word_counts = {}
+    
+    for k, key in enumerate(table.keys):
+        words, counts = csr_row(table.counts,k)
+        corpora_word_counts[key] = dict(zip([table.vocab[i] for i in words],counts.tolist()))
+    
+    return corpora_word_counts
+
+def dicts_table(corpora_word_dict):
+    """
+    Turn {key: {word: count}} dictionaries into a data_corpus.CountTable over
+    the vocabulary they share.
+    """
+    word_ids = {}
+    indptr   = [0]
+    indices  = []
+    data     = []
+    
+    for corpus in corpora_word_dict.values():
+        ids    = np.array([word_ids.setdefault(w,len(word_ids)) for w in corpus.keys()],dtype=np.int64)
+        counts = np.array([c for c in corpus.values()],dtype=np.int64)
+        order  = np.argsort(ids)
+        
+        indices.append(ids[order])
+        data.append(counts[order])
+        indptr.append(indptr[-1] + len(ids))
+    
+    keys  = [key for key in corpora_word_dict.keys()]
+    vocab = [w for w in word_ids.keys()]
+    
+    if not keys:
+        return CountTable(keys,csr_matrix(np.zeros(1,dtype=np.int64),np.zeros(0,dtype=np.int64),
+                                          np.zeros(0,dtype=np.int64),(0,0)),vocab)
+    
+    counts = csr_matrix(np.array(indptr,dtype=np.int64),np.concatenate(indices),
+                        np.concatenate(data),(len(keys),len(vocab)))
+    
+    return CountTable(keys,counts,vocab)
+
+def count_dict(counts,vocab): #helper method
+    """
+    Turn an array of counts indexed by word id into a {word: count} dictionary
+    of the words that occur.
+    """
+    present = np.flatnonzero(counts)
+    
+    return dict(zip([vocab[i] for i in present],counts[present].tolist()))
+
 def yule(corpus1_dict,corpus2_dict):
     """
 
@@ -244,28 +504,210 @@ def yule(corpus1_dict,corpus2_dict):
     #return the finished list
     return yuleCoefList    
 
-def yule_batch(corpora_word_dict):
+def yule_batch(corpora_word_dict,k=None):
     """
     Compute the yule coefficient of a single corpus against the entire data set
     minus that corpus for each corpus in the corpora_word_dict.
     
+    corpora_word_dict can also be the data_corpus.CountTable of a corpus 
+    (data_corpus.corpus_word_counts).
+    
+    Gives the same lists as yule(filter_out_key(key,corpora_word_dict),corpus)
+    for every key, but the rest of the data set is never rebuilt per corpus: 
+    the counts of the whole data set are summed once, "rest" is that total 
+    minus the corpus, and the coefficients of a corpus are computed as arrays 
+    over the shared vocabulary.
+    
+    k=None (the default) keeps the full ranking. With k, only the k lowest 
+    and the k highest coefficients of each corpus are kept (in that order, so
+    yules[:k] and yules[:-k-1:-1] are the same as in the full ranking), and 
+    the rest of the vocabulary is never sorted.
     """
+    if isinstance(corpora_word_dict,CountTable):
+        table = corpora_word_dict
+    else:
+        table = dicts_table(corpora_word_dict)
+    
+    counts  = table.counts
+    n_vocab = len(table.vocab)
+    
+    #every word's count over the whole data set
+    total = np.bincount(counts['indices'],weights=counts['data'],minlength=n_vocab).astype(np.int64)
+    rank  = vocab_ranks(table.vocab)
     
-    keys = [key for key in corpora_word_dict.keys()] #crack open keys
     yule_batch = {} #make an empty yule batch dictionary
     
-    for key in keys: 
-        corpus = corpora_word_dict[key]       
+    for i, key in enumerate(table.keys):
+        words, corpus = csr_row(counts,i)
+        yule_batch[key] = yule_rest(words,corpus,total,rank,table.vocab,k)
+        
+    return yule_batch #return the entire batch!
+
+def vocab_ranks(vocab): #helper method
+    """
+    The alphabetical rank of every word, the tie breaker of yule's sort.
+    """
+    rank = np.empty(len(vocab),dtype=np.int64)
+    rank[sorted(range(len(vocab)),key=vocab.__getitem__)] = np.arange(len(vocab))
+    return rank
+
+def yule_rest(words,corpus,total,rank,vocab,k=None): #helper method
+    """
+    The Yule list of one corpus against the rest of the data set.
+    
+    Inputs:
+        -words, corpus: the word ids the corpus uses and their counts
+        -total: every word's count over the whole data set
+        -rank: vocab_ranks of the vocabulary
+        -k: see yule_batch
+    """
+    corpus = corpus.astype(np.int64)
+    rest   = total[words] - corpus
+    
+    #only the words both sides use
+    both = (corpus > 0) & (rest > 0)
+    words, corpus, rest = words[both], corpus[both], rest[both]
+    
+    coefs = (rest - corpus)/(rest + corpus)
+    
+    #Yule-wise increasing, words in alphabetical order on ties
+    order = yule_order(coefs,rank[words],k)
+    return [[coef,vocab[w]] for coef, w in zip(coefs[order].tolist(),words[order].tolist())]
+
+def yule_order(coefs,ranks,k=None): #helper method
+    """
+    The order of a corpus' Yule list: increasing coefficient, then increasing
+    word rank. With k, only the first k and the last k positions of that order.
+    
+    The cut is made with np.partition, then everything tied with the k-th 
+    coefficient is kept and sorted, so the ends come out exactly as they
+    would from the full sort.
+    """
+    if k is None or len(coefs) <= 2*k:
+        return np.lexsort((ranks,coefs))
+    
+    if k <= 0:
+        return np.zeros(0,dtype=np.int64)
+    
+    #the k-th lowest and the k-th highest coefficient
+    low, high = np.partition(coefs,[k-1,len(coefs)-k])[[k-1,len(coefs)-k]]
+    
+    bottom = np.flatnonzero(coefs <= low)
+    top    = np.flatnonzero(coefs >= high)
     
-        #create word count dict for all words in corpora_word_dict not including corpus
-        master_word_dict = filter_out_key(key,corpora_word_dict)
+    bottom = bottom[np.lexsort((ranks[bottom],coefs[bottom]))][:k]
+    top    = top[np.lexsort((ranks[top],coefs[top]))][-k:]
+    
+    return np.concatenate([bottom,top])
+
+def yule_pairs(corpora_word_dict,k=100):
+    """
+    Compute the yule coefficients of every pair of corpora against eachother:
+    for the pair (a, b), the list yule(corpora_word_dict[a],corpora_word_dict[b])
+    returns, cut to its k lowest and k highest coefficients like yule_batch 
+    (k=None keeps the full lists).
+    
+    corpora_word_dict can also be a data_corpus.CountTable.
+    
+    No set or dictionary is built per pair. The corpora share one vocabulary
+    index (the columns of their count table): corpus a is laid out over the 
+    whole vocabulary once, and its counts are picked out at the words of 
+    every later corpus b in one gather. The (a, b) and (b, a) coefficients
+    are the same up to sign, and every pair's list is ordered with one 
+    lexsort for all the pairs of a. A corpus against itself is every one of
+    its words at 0, as yule(a, a) gives.
+    
+    Output:
+        -the pairs: a dictionary of the corpus 'keys' (and their 'index'), 
+         the 'vocab', and for the ordered pair p = a*len(keys) + b the 
+         coefficients coefs[indptr[p]:indptr[p+1]] of the words (vocabulary
+         ids) words[indptr[p]:indptr[p+1]]. Query it with pair_yules.
+    """
+    if isinstance(corpora_word_dict,CountTable):
+        table = corpora_word_dict
+    else:
+        table = dicts_table(corpora_word_dict)
+    
+    counts   = table.counts
+    n_keys   = len(table.keys)
+    indptr   = np.asarray(counts['indptr']).astype(np.int64)
+    rank     = vocab_ranks(table.vocab)
+    row_of   = np.repeat(np.arange(n_keys),np.diff(indptr)) #the corpus of every count
+    dense    = np.zeros(len(table.vocab),dtype=np.int64)
+    
+    pieces = [] #(pair ids, coefficients, words) of every kept entry
+    
+    for a in range(n_keys):
+        words_a, counts_a = csr_row(counts,a)
+        dense[words_a] = counts_a
         
-        #measure Yules of corpus against entire dataset
-        yules = yule(master_word_dict,corpus)
-        yule_batch[key] = yules #add that yule list to associate it with a corpus.
+        #yule(a, a): every word of a at 0, in alphabetical order
+        words = np.asarray(words_a,dtype=np.int64)
+        order = np.argsort(rank[words],kind='stable')
+        pair  = np.full(len(words),a*n_keys + a,dtype=np.int64)
+        keep  = pair_ends(pair,k)
+        pieces.append((pair[keep],np.zeros(int(keep.sum())),words[order][keep]))
         
+        #every count of the corpora after a, next to a's count of the word
+        later = slice(int(indptr[a+1]),int(indptr[-1]))
+        words = counts['indices'][later].astype(np.int64)
+        cnt_b = counts['data'][later].astype(np.int64)
+        cnt_a = dense[words]
+        b     = row_of[later]
         
-    return yule_batch #return the entire batch!
+        dense[words_a] = 0
+        
+        #only the words both corpora use
+        both = (cnt_a > 0) & (cnt_b > 0)
+        words, cnt_a, cnt_b, b = words[both], cnt_a[both], cnt_b[both], b[both]
+        coefs = (cnt_a - cnt_b)/(cnt_a + cnt_b)
+        
+        #yule(a, b) and yule(b, a) = the negated coefficients
+        for sign, pair in [(1,a*n_keys + b),(-1,b*n_keys + a)]:
+            order = np.lexsort((rank[words],sign*coefs,pair))
+            keep  = pair_ends(pair[order],k)
+            order = order[keep]
+            pieces.append((pair[order],sign*coefs[order],words[order]))
+    
+    pair   = np.concatenate([p for p, _, _ in pieces]) if pieces else np.zeros(0,dtype=np.int64)
+    order  = np.argsort(pair,kind='stable') #pairs together, each still in Yule order
+    bounds = np.searchsorted(pair[order],np.arange(n_keys*n_keys + 1))
+    
+    return {'keys'  :table.keys,
+            'index' :{key:i for i, key in enumerate(table.keys)},
+            'vocab' :table.vocab,
+            'k'     :k,
+            'indptr':bounds.astype(np.int64),
+            'coefs' :np.concatenate([c for _, c, _ in pieces])[order] if pieces else np.zeros(0),
+            'words' :np.concatenate([w for _, _, w in pieces])[order] if pieces else np.zeros(0,dtype=np.int64)}
+
+def pair_ends(pair,k): #helper method
+    """
+    Of entries sorted by pair, the first k and the last k of every pair (all 
+    of them with k None).
+    """
+    if k is None:
+        return np.ones(len(pair),dtype=bool)
+    
+    starts = np.flatnonzero(np.concatenate([[True],pair[1:] != pair[:-1]])) if len(pair) else np.zeros(0,dtype=np.int64)
+    sizes  = np.diff(np.concatenate([starts,[len(pair)]]))
+    pos    = np.arange(len(pair)) - np.repeat(starts,sizes) #position within the pair
+    size   = np.repeat(sizes,sizes)
+    
+    return (pos < k) | (pos >= size - k)
+
+def pair_yules(pairs,key1,key2):
+    """
+    The Yule list of corpus key1 against corpus key2 from yule_pairs: the 
+    same as yule(corpora_word_dict[key1],corpora_word_dict[key2]) (only its
+    ends with k).
+    """
+    p = pairs['index'][key1]*len(pairs['keys']) + pairs['index'][key2]
+    start, stop = int(pairs['indptr'][p]), int(pairs['indptr'][p+1])
+    vocab = pairs['vocab']
+    
+    return [[coef,vocab[w]] for coef, w in zip(pairs['coefs'][start:stop].tolist(),
+                                               pairs['words'][start:stop].tolist())]
 
 def write_yules_to_file(yule_batch):
     """
@@ -365,139 +807,199 @@ def filter_out_key(key,corpora_word_dict):
 
 def avg_syls(lyrics):
     """
-    Compute the average syllable count for a given set of lyrics. Parse through 
-    each word, attempting to use nsyl (a more reliable/accurate function), and 
-    if that fails, using syllables.
+    Compute the average syllable count for a given set of lyrics. Each distinct
+    word is scored once, with nsyl (a more reliable/accurate function) if 
+    cmudict has it, and with syllables otherwise.
+    
+    lyrics can be the lyrics string or the song's tokens (a list of words).
 
     """
-    lyrics = lyrics.split() #convert to words
+    if isinstance(lyrics,str):
+        lyrics = normalize_lyrics(lyrics) #convert to words
     
-    syl_ct = 0 #initalize count
-    for word in lyrics:
-        try: #attempt and nsyl pull
-            syl_ct += nsyl(word)[0]
-        except:
-            #otherwise count using in house algorithm
-            print("Could not find syllables with nsyl for {}".format(word))
-            syl_ct += syllables(word)
+    #score the distinct words, then weight them by how often they occur
+    words, occurrences = np.unique(np.array(lyrics,dtype=str),return_counts=True)
+    syls, _ = syllable_vector(words.tolist())
     
     #return the average syllable count
-    return syl_ct/len(lyrics)
+    return int(syls @ occurrences)/len(lyrics)
             
 
 
-def nsyl(word):
-    """
-    Pull from the Carnegie Melon University's pronunciation dictionary to get
-    syllable counts. Only works for 'real' words.
+def count_syls(strat_dict,corpus=None):
     
-    Citation listed in file header under nltk resources.    
-    """
-    return [len(list(y for y in x if y[-1].isdigit())) for x in cmu[word.lower()]]
-
-def syllables(word):
     """
-    Calculate syllables of a word using a less accurate algorithm.
-    Parse through the sentence, using common syllabic identifiers to count
-    syllables.
+    Count the syllables for each song in each corpus of an already
+    stratified dictionary and return the average syllable count per corpus.    
+    
+    Every word of the vocabulary is scored once (vocab_syllables), and a song's
+    average is its word counts times that syllable vector over its word count.
     
-    ADAPTED FROM: 
-    [http://stackoverflow.com/questions/14541303/count-the-number-of-syllables-in-a-word]
+    With a memory mapped corpus (data_corpus.open_corpus), strat_dict maps
+    each key to song indices of the corpus and the averages come from the 
+    corpus' count matrix.
     """
-    #initialize count
-    count = 0
+    if corpus is not None:
+        syls, weights = vocab_syllables(corpus['vocab'])
+        song_avgs = song_averages(corpus,syls,weights)
+        
+        #summed in song order, like the rows below
+        return {key:sum(song_avgs[songs].tolist())/len(songs) for key, songs in strat_dict.items()}
     
-    #vowel list
-    vowels = 'aeiouy'
+    syls, weights = vocab_syllables(load_vocab(db()))
+    weighted = syls*weights
     
-    #take out punctuation
-    word = word.lower().strip(".:;?!")
+    #make an empty dictionary
+    avg_syls_per_corpus = {}
     
-    #various signifiers of syllabic up or down count
-    if word[0] in vowels:
-        count +=1
+    #iterate over corpora
+    for key, corpus in strat_dict.items():
         
-    for index in range(1,len(word)):
-        if word[index] in vowels and word[index-1] not in vowels:
-            count +=1
-            
-    if word.endswith('e'):
-        count -= 1
+        #every song's weighted syllable total over its weighted word count
+        ids     = np.concatenate([row['ids'] for row in corpus]) if corpus else np.zeros(0,dtype=np.uint32)
+        lengths = np.array([len(row['ids']) for row in corpus],dtype=np.int64)
+        starts  = np.concatenate([[0],np.cumsum(lengths)[:-1]]).astype(np.int64)
+        full    = lengths > 0
         
-    if word.endswith('le') or word.endswith('a'):
-        count+=1
-    
-    if count == 0:
-        count +=1
-    
-    if "ooo" in word or "mm" in word :
-        count = 1
+        avg_syl_ct = np.full(len(corpus),np.nan)
+        if full.any():
+            avg_syl_ct[full] = (np.add.reduceat(weighted[ids],starts[full]) /
+                                np.add.reduceat(weights[ids],starts[full]))
         
-    if word == 'll':
-        count = 0
+        #average out the syllable counts for this corpus 
+        avg_syls_per_corpus[key] = sum(avg_syl_ct.tolist())/len(corpus)
+     
+    return avg_syls_per_corpus
     
-    if (word.startswith('x') and len(word) >= 2) and word[1].isdigit():
-        count = 0
+def vocab_syllables(vocab):
+    """
+    Score every word of a vocabulary the way count_syls scores a word: the
+    first cmudict pronunciation if there is one (which count_syls counts 
+    twice), otherwise the syllables() estimate (counted once).
     
-    if word == 'lmfao':
-        count = 5
+    Input:
+        -vocab: list of words
     
-    if len(word) < 2 and word not in ['a','i','y','o']:
-        count = 0
-        
-    return count
+    Output:
+        -array of syllables per word, array of weights per word
+    """
+    syls, found = syllable_vector(vocab)
+    weights = np.where(found,2,1).astype(np.int64)
     
-def count_syls(strat_dict):
+    return syls, weights
     
+###############################################################################
+############################ SLIDING WINDOWS ##################################
+###############################################################################
+
+def year_stats(aggregates=False):
     """
-    Count the syllables for each song in each corpus of an already
-    stratified dictionary and return the average syllable count per corpus.    
+    The word counts and song sums of every year, from one scan of media or 
+    from the per year aggregates of the database (data_counts).
+    
+    Output:
+        -CountTable of the years (in order), and a dictionary of year to 
+         (songs, songs without words, sum of the syllabic averages of the 
+         other songs)
     """
+    if aggregates:
+        conn = db()
+        return stratum_word_counts(conn,'year'), stratum_song_sums(conn,'year')
     
-    #crack open keys    
-    keys = [k for k in strat_dict.keys()]
+    corpus, groups = scan_media(['year'])
+    years = groups['year']
     
-    #make an empty dictionary
-    avg_syls_per_corpus = {}
+    syls, weights = vocab_syllables(corpus['vocab'])
+    song_avgs = song_averages(corpus,syls,weights)
+    
+    sums = {}
+    for year, songs in years.items():
+        avgs = song_avgs[songs]
+        full = ~np.isnan(avgs)
+        sums[year] = (len(songs),int((~full).sum()),sum(avgs[full].tolist()))
     
-    #iterate over keys
-    for key in keys:
+    return corpus_word_counts(corpus,years), sums
+
+def sliding_windows(width=5,step=1,k=100,aggregates=False):
+    """
+    The Yule list (each window against the rest of the data set) and the 
+    syllabic average of rolling windows of years, ex: 1980-1984, 1981-1985... 
+    The last window always ends at the last year (ex: width 5, step 3 over 
+    1980-2010 ends with 2004-2008 and 2006-2010).
+    
+    The counts of a window are kept as it slides: the years coming in are 
+    added and the years going out are subtracted, so a sweep reads every 
+    year's counts about twice, whatever the width.
+    
+    Inputs:
+        -width: years per window
+        -step: years between the starts of two windows
+        -k: see yule_batch (None => the full ranking)
+        -aggregates: read the years from the database's aggregates (see 
+                     year_stats)
+    
+    Output:
+        -dictionary of window ('first-last') to a dictionary of its 'yule' 
+         list, 'syllables' average (nan if a song has no words) and 'songs'
+    """
+    table, sums = year_stats(aggregates)
+    if not table.keys:
+        return {}
+    
+    years  = [int(year) for year in table.keys]
+    total  = np.bincount(table.counts['indices'],weights=table.counts['data'],
+                         minlength=len(table.vocab)).astype(np.int64)
+    rank   = vocab_ranks(table.vocab)
+    window = {'counts':np.zeros(len(table.vocab),dtype=np.int64),'songs':0,'empty':0,'syl_sum':0.0,
+              'rows':{year:i for i, year in enumerate(years)}}
+    
+    #the windows start every step years; a data set shorter than a window
+    #gets one window. when step does not divide the span, a last window
+    #ending at the last year is added, so no year is left out
+    first, last = years[0], years[-1]
+    starts = [start for start in range(first,max(last - width + 1,first) + 1,step)]
+    if starts[-1] + width - 1 < last:
+        starts.append(last - width + 1)
+    lo = hi = first #the years lo..hi-1 are in the window
+    
+    windows = {}
+    for start in starts:
+        stop = start + width
         
-        #isolate dictionary
-        corpus = strat_dict[key]
+        if start >= hi: #the step jumped past the whole window
+            shift_window(window,table,sums,range(lo,hi),-1)
+            lo = hi = start
         
-        #empty list to be populated by individual syllable counts
-        avg_syl_ct = []
-        for row in corpus:
-            #isolate and split lyrics
-            lyrics = row['lyrics'].split()
-            syl_ct = []
-            for word in lyrics:
-                
-                try: #try to get the syllables using nsyl
-                    syls = nsyl(word)
-                    syl_ct.append(syls[0])
-                    
-                except KeyError: #otherwise use syllables
-                    syls = [syllables(word)]
-                    
-                #append the answer to syl_ct 
-                syl_ct.append(syls[0])   
-            
-            #average out the syllable counts for one song
-            avg_syls = sum(syl for syl in syl_ct)/len(syl_ct)
-            
-            #add this to the corpus syllable count list
-            avg_syl_ct.append(avg_syls)
+        shift_window(window,table,sums,range(hi,stop),1)
+        shift_window(window,table,sums,range(lo,start),-1)
+        lo, hi = start, stop
         
-        #average out the syllable counts for this corpus 
-        avg_syll_corpus = sum(sylls for sylls in avg_syl_ct)/len(avg_syl_ct)
+        words = np.flatnonzero(window['counts'])
+        songs = window['songs']
+        windows["{}-{}".format(start,min(stop-1,last))] = {
+            'yule'     :yule_rest(words,window['counts'][words],total,rank,table.vocab,k),
+            'syllables':float('nan') if window['empty'] or not songs else window['syl_sum']/songs,
+            'songs'    :songs}
+    
+    return windows
+
+def shift_window(window,table,sums,years,sign): #helper method
+    """
+    Add (sign 1) or subtract (sign -1) the counts of some years to a window.
+    """
+    for year in years:
+        row = window['rows'].get(year)
+        if row is None: #no songs that year
+            continue
         
-        #add this key, value pair to the dictionary of syllabic averages
-        avg_syls_per_corpus[key] = avg_syll_corpus
-     
-    return avg_syls_per_corpus
-    
+        words, counts = csr_row(table.counts,row)
+        window['counts'][words] += sign*counts.astype(np.int64)
+        
+        songs, empty, syl_sum = sums[table.keys[row]]
+        window['songs']   += sign*songs
+        window['empty']   += sign*empty
+        window['syl_sum'] += sign*syl_sum
+
 ###############################################################################
 ############################ PLOTTING CODE ####################################
 ###############################################################################
@@ -518,29 +1020,27 @@ def plot_genre_by_yr_by_syllabic(choice):
     
     """    
     
+    import matplotlib.pyplot as plt #only the plots need matplotlib
+    
     #related to together
     fasttrack = False
     
     #clear figure
     plt.clf()
     
-    #get the data by year
-    year_dict = stratify_by_year('year')
-    yr_keys = [key for key in year_dict.keys()] #crack open keys
+    #get the data by genre and year in one scan
+    corpus, groups = scan_media([('genre','year')])
     
-    genre_dict = {'Rock':[],'Jazz':[],'Country':[],'Pop':[],'Dance':[],
-                      'Hip-Hop':[],'R&B/Soul':[],'Latin':[],'Christian/Gospel':[]}
+    #every song's syllabic average (avg_syls: each word counts once)
+    syls, _  = vocab_syllables(corpus['vocab'])
+    song_avg = song_averages(corpus,syls,np.ones_like(syls))
     
-    #iterate over years
-    for key in yr_keys:
-        spec_year = year_dict[key]
-        
-        #add syllabic tendencies in year order to genre_dict ist
-        for row in spec_year:
-            avg_syl = avg_syls(row['lyrics'])
-            genre   = row['genre']
-            mini    = [int(key),avg_syl]
-            genre_dict[genre].append(mini)
+    genre_dict = {}
+    
+    #add syllabic tendencies of every (genre, year) to genre_dict
+    for (genre, year), songs in groups[('genre','year')].items():
+        minis = genre_dict.setdefault(genre,[])
+        minis.extend([int(year),avg_syl] for avg_syl in song_avg[songs].tolist())
     
     #crack open genre_dict's keys
     genre_keys = [key for key in genre_dict.keys()]
@@ -618,12 +1118,7 @@ def plot_genre_by_yr_by_syllabic(choice):
         plt.xlabel("Year")
         plt.ylabel('Average Syllables Per Song')
         plt.legend(loc='best',frameon=False)
-        if len(key.split('/')) < 2:
-            plt.savefig("group_photo.png".format(key))
-        
-        else:
-            key = key.split('/')
-            plt.savefig("group_photo".format(key[0],key[1]))
+        plt.savefig("group_photo.png")
             
         plt.clf()
     
@@ -645,6 +1140,8 @@ def create_new_table_genre_stats():
     """
     Create a table called genre_stats in song_records
     """
+    conn = db()
+    curs = conn.cursor()
     curs.execute("CREATE TABLE genre_stats (yule text, syllabic_average text, top100_yules text, genre text)")
     conn.commit()
 
@@ -652,20 +1149,48 @@ def create_new_table_year_stats():
     """
     Create a table called year_stats in song_records
     """
+    conn = db()
+    curs = conn.cursor()
     curs.execute("CREATE TABLE year_stats (yule text, syllabic_average text, top100_yules text, year text)")
     conn.commit()
     
-def write_to_genre_stats():
+def ensure_stats_tables():
+    """
+    Create genre_stats and year_stats unless they are already there.
+    """
+    conn = db()
+    have = [name for (name,) in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+    
+    if 'genre_stats' not in have:
+        create_new_table_genre_stats()
+    if 'year_stats' not in have:
+        create_new_table_year_stats()
+    
+def write_to_genre_stats(genre_yules=None,avg_syls_per_genre=None,aggregates=False):
     """
     Write important Yule, syllable data to the new tables
+    
+    The Yule batch (k >= 100) and syllabic averages of the genres can be 
+    passed in (ex: from data_pipeline's cache), otherwise they are computed,
+    from the per genre aggregates of the database with aggregates=True 
+    (see aggregate_stats).
     """
-    genre_dict = stratify_by_genre()
-    genres = [key for key in genre_dict.keys()]
+    if aggregates and (genre_yules is None or avg_syls_per_genre is None):
+        genre_cts, avg_syls_per_genre = aggregate_stats('genre')
+        genre_yules = yule_batch(genre_cts,k=100)
     
-    genre_cts = count_word_occurrence(genre_dict)    
-    genre_yules = yule_batch(genre_cts)
+    if genre_yules is None or avg_syls_per_genre is None:
+        corpus, groups = scan_media(['genre'])
+        genre_dict = groups['genre']
+        
+        genre_cts = corpus_word_counts(corpus,genre_dict)    
+        genre_yules = yule_batch(genre_cts,k=100)
+        
+        avg_syls_per_genre = count_syls(genre_dict,corpus)
     
-    avg_syls_per_genre = count_syls(genre_dict)
+    genres = [key for key in genre_yules.keys()]
+    conn = db()
+    curs = conn.cursor()
     for genre in genres:
         syl_ct = avg_syls_per_genre[genre]
         top100 = [mini[0] for mini in genre_yules[genre][:100]]
@@ -676,17 +1201,30 @@ def write_to_genre_stats():
         conn.commit()
 
 
-def write_to_year_stats():
+def write_to_year_stats(year_yules=None,avg_syls_per_year=None,aggregates=False):
     """
     Write important Yule, syllable data to the new tables.
+    
+    The Yule batch (k >= 100) and syllabic averages of the decades can be 
+    passed in, otherwise they are computed (from the per year aggregates with
+    aggregates=True).
     """
-    year_dict = stratify_by_year('decade')
-    years = [key for key in year_dict.keys()]
+    if aggregates and (year_yules is None or avg_syls_per_year is None):
+        year_cts, avg_syls_per_year = aggregate_stats('decade')
+        year_yules = yule_batch(year_cts,k=100)
     
-    year_cts = count_word_occurrence(year_dict)    
-    year_yules = yule_batch(year_cts)
+    if year_yules is None or avg_syls_per_year is None:
+        corpus, groups = scan_media(['decade'])
+        year_dict = groups['decade']
+        
+        year_cts = corpus_word_counts(corpus,year_dict)    
+        year_yules = yule_batch(year_cts,k=100)
+        
+        avg_syls_per_year = count_syls(year_dict,corpus)
     
-    avg_syls_per_year = count_syls(year_dict)
+    years = [key for key in year_yules.keys()]
+    conn = db()
+    curs = conn.cursor()
     for year in years:
         syl_ct = avg_syls_per_year[year]
         top100 = [mini[0] for mini in year_yules[year][:100]]
@@ -698,14 +1236,17 @@ def write_to_year_stats():
 ###############################################################################
         
 def main():
-    genre_dict = stratify_by_genre() #get song data stratified by genre
+    corpus, groups = scan_media(['genre']) #get song data stratified by genre
     
-    corpora_word_dict = count_word_occurrence(genre_dict)  #get word counts for each genre
-    yules = yule_batch(corpora_word_dict) #get the yule coefficient for
-                                          #each genre against the rest
-                                          #of the dataset
+    corpora_word_dict = corpus_word_counts(corpus,groups['genre'])  #get word counts for each genre
+    yules = yule_batch(corpora_word_dict,k=100) #get the yule coefficient for
+                                                #each genre against the rest
+                                                #of the dataset (only the ends
+                                                #are written to file)
     
     write_yules_to_file(yules) #write to a file
-main()
 
-conn.close()
\ No newline at end of file
+if __name__ == '__main__':
+    main()
+    
+    db().close()
\ No newline at end of file
@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+"""
+ * ------------------------------------------------------- *
+ |CS/STAT 287 FINAL PROJECT: HTTP CACHE FILE               |
+ |                                                         |
+ |This file keeps every answer the extraction layer gets   |
+ |from jamrockentertainment, chartlyrics and musixmatch on |
+ |disk so that rebuilding song_records.db does not have to |
+ |go back to the network.                                  |
+ |                                                         |
+ |Responses are stored under the sha256 of their          |
+ |normalized url (scheme/host lowercased, query sorted,    |
+ |musixmatch apikey dropped). A small sqlite index next to |
+ |the files keeps the size, store time and last access of  |
+ |each entry for TTL checks and LRU eviction.              |
+ |                                                         |
+ |In offline ("replay only") mode a miss never touches the |
+ |network, it answers with a 504 like a browser would for  |
+ |an only-if-cached request.                               |
+ * ------------------------------------------------------- *
+urllib.parse citations
+
+   -->[https://docs.python.org/3/library/urllib.parse.html]
+"""
+
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode, quote, unquote
+from collections import namedtuple
+import threading
+import hashlib
+import sqlite3
+import time
+import os
+
+
+#query parameters that never make it into a cache key
+secret_params = ['apikey']
+
+#how long answers stay fresh per host, in seconds (None => forever). chart pages
+#never change, lyrics and genres are allowed to drift slowly.
+host_ttls = {'www.jamrockentertainment.com': None,
+             'api.chartlyrics.com'         : 90*24*3600,
+             'api.musixmatch.com'          : 30*24*3600,
+             'default'                     : 30*24*3600}
+
+#the shape of a cached answer. has the two attributes the extraction layer reads
+#off of a requests.Response.
+CachedResponse = namedtuple('CachedResponse',['status_code','content'])
+
+
+def open_cache(cache_dir='http_cache',max_bytes=512*2**20,ttl=host_ttls,offline=False):
+    """
+    Open (or create) a response cache in cache_dir.
+
+    Inputs:
+        -cache_dir: directory the responses and the index live in
+        -max_bytes: total size of stored responses before LRU eviction kicks in
+        -ttl: dictionary of host to seconds an answer stays fresh (None => forever),
+              with a 'default' entry for every other host
+        -offline: replay only, misses are answered with a 504 instead of fetched
+
+    Output:
+        -cache dictionary to hand to the other functions of this file
+    """
+    os.makedirs(cache_dir,exist_ok=True)
+
+    #the cache is shared by the async crawler's worker threads
+    db = sqlite3.connect(os.path.join(cache_dir,'index.db'),check_same_thread=False)
+    db.execute("CREATE TABLE IF NOT EXISTS responses (key text PRIMARY KEY, url text, "
+               "host text, status integer, size integer, stored_at real, last_access real)")
+    db.execute("CREATE INDEX IF NOT EXISTS responses_lru ON responses (last_access)")
+    db.commit()
+
+    size = db.execute("SELECT COALESCE(SUM(size),0) FROM responses").fetchone()[0]
+
+    return {'dir'      : cache_dir,
+            'db'       : db,
+            'lock'     : threading.Lock(),
+            'max_bytes': max_bytes,
+            'ttl'      : ttl,
+            'offline'  : offline,
+            'size'     : size,
+            'hits'     : 0,
+            'misses'   : 0}
+
+def close_cache(cache):
+    """
+    Close the index of a cache.
+    """
+    cache['db'].close()
+
+def normalize_url(url):
+    """
+    Normalize a request url so that equivalent requests share one cache entry.
+
+    Ex:
+        normalize_url('HTTP://Api.Musixmatch.com:80/ws/1.1/track.search?q_track=call%20me&apikey=123')
+        returns 'http://api.musixmatch.com/ws/1.1/track.search?q_track=call%20me'
+    """
+    parts  = urlsplit(url)
+    scheme = parts.scheme.lower()
+    host   = (parts.hostname or '').lower()
+
+    #only keep non default ports
+    if parts.port and (scheme,parts.port) not in [('http',80),('https',443)]:
+        host = "{}:{}".format(host,parts.port)
+
+    #one spelling of the path and the query, secrets stripped, parameters sorted
+    path  = quote(unquote(parts.path)) or '/'
+    query = sorted((k,v) for k,v in parse_qsl(parts.query,keep_blank_values=True)
+                   if k.lower() not in secret_params)
+
+    return urlunsplit((scheme,host,path,urlencode(query,quote_via=quote),''))
+
+def cache_key(url):
+    """
+    The content address of a url: sha256 of its normalized form.
+    """
+    return hashlib.sha256(normalize_url(url).encode('utf-8')).hexdigest()
+
+def entry_path(cache,key): #helper method
+    """
+    Where the body of a cache entry lives (fanned out over 256 directories).
+    """
+    return os.path.join(cache['dir'],key[:2],key)
+
+def lookup(cache,url):
+    """
+    Find a fresh cached answer for a url.
+
+    Output:
+        -CachedResponse, or None on a miss (never stored, expired, or body gone)
+    """
+    key = cache_key(url)
+    now = time.time()
+
+    with cache['lock']:
+        row = cache['db'].execute("SELECT host, status, stored_at FROM responses WHERE key = ?",
+                                  (key,)).fetchone()
+        if row is None:
+            return None
+
+        host, status, stored_at = row
+        ttl = cache['ttl'].get(host,cache['ttl'].get('default'))
+
+        if ttl is not None and now - stored_at > ttl: #stale
+            return None
+
+        try:
+            with open(entry_path(cache,key),'rb') as f:
+                content = f.read()
+        except FileNotFoundError:
+            return None
+
+        cache['db'].execute("UPDATE responses SET last_access = ? WHERE key = ?",(now,key))
+        cache['db'].commit()
+
+    return CachedResponse(status,content)
+
+def store(cache,url,status,content):
+    """
+    Save an answer for a url, then evict least recently used entries if the
+    cache went over its size budget.
+    """
+    key  = cache_key(url)
+    path = entry_path(cache,key)
+    now  = time.time()
+
+    os.makedirs(os.path.dirname(path),exist_ok=True)
+
+    #write then rename, so a crash never leaves half a body behind. the rename
+    #and the row go in together under the lock, so an evict in another thread
+    #can never remove the body of a row it does not see
+    tmp = "{}.{}.tmp".format(path,threading.get_ident())
+    with open(tmp,'wb') as f:
+        f.write(content)
+
+    with cache['lock']:
+        os.replace(tmp,path)
+
+        old = cache['db'].execute("SELECT size FROM responses WHERE key = ?",(key,)).fetchone()
+        if old is not None:
+            cache['size'] -= old[0]
+
+        cache['db'].execute("INSERT OR REPLACE INTO responses (key,url,host,status,size,stored_at,last_access) "
+                            "VALUES (?,?,?,?,?,?,?)",
+                            (key,normalize_url(url),urlsplit(url).hostname,status,len(content),now,now))
+        cache['db'].commit()
+        cache['size'] += len(content)
+
+        evict(cache)
+
+def evict(cache):
+    """
+    Delete least recently used entries until the cache fits in max_bytes.
+    Expects cache['lock'] to be held.
+    """
+    if cache['size'] <= cache['max_bytes']:
+        return
+
+    doomed = []
+    for key, size in cache['db'].execute("SELECT key, size FROM responses ORDER BY last_access"):
+        if cache['size'] <= cache['max_bytes']:
+            break
+        doomed.append((key,))
+        cache['size'] -= size
+
+    cache['db'].executemany("DELETE FROM responses WHERE key = ?",doomed)
+    cache['db'].commit()
+
+    for (key,) in doomed:
+        try:
+            os.remove(entry_path(cache,key))
+        except FileNotFoundError:
+            pass
+
+def cached_get(cache,url,get):
+    """
+    Answer a request from the cache, falling back to get(url) on a miss.
+    Only 200 answers are stored, failures are always retried.
+
+    Inputs:
+        -cache made by open_cache
+        -url to request
+        -get: callable that fetches a url and returns something with
+              .status_code and .content (ex: requests.get)
+
+    Output:
+        -the cached or fresh response. In offline mode a miss is a
+         CachedResponse with status 504 and an empty body.
+    """
+    hit = lookup(cache,url)
+
+    with cache['lock']:
+        cache['hits' if hit is not None else 'misses'] += 1
+
+    if hit is not None:
+        return hit
+
+    if cache['offline']:
+        return CachedResponse(504,b'')
+
+    r = get(url)
+    if r is not None and r.status_code == 200:
+        store(cache,url,r.status_code,r.content)
+
+    return r
@@ -0,0 +1,527 @@
+# -*- coding: utf-8 -*-
+"""
+ * ------------------------------------------------------- *
+ |CS/STAT 287 FINAL PROJECT: CORPUS STORE FILE             |
+ |                                                         |
+ |This file exports the pre-tokenized lyrics of media into |
+ |a directory of flat binary files and maps them back into |
+ |memory as NumPy arrays, so the analysis can run over     |
+ |corpora bigger than RAM without building any Python      |
+ |objects per word:                                        |
+ |                                                         |
+ |   tokens.u32  --> every word id of every song, one song |
+ |                   after the other                       |
+ |   offsets.u64 --> where each song starts in tokens      |
+ |                   (n_songs + 1 entries)                 |
+ |   genre.u16   --> index of each song's genre in genres  |
+ |   artist.u32  --> index of each song's artist in        |
+ |                   artists.json                          |
+ |   year.u16    --> each song's year                      |
+ |   vocab.txt   --> one word per line, line i = word id i |
+ |   meta.json   --> sizes and the genre labels            |
+ |                                                         |
+ |Song i's words are tokens[offsets[i]:offsets[i+1]], a    |
+ |view into the mapped file, nothing is copied.            |
+ |                                                         |
+ |load_corpus builds the same arrays in memory from one    |
+ |read of media, for data sets that fit in RAM.            |
+ |                                                         |
+ |The first analysis also caches a sparse song x word      |
+ |count matrix (CSR: dtm_indptr.u64, dtm_indices.u32,      |
+ |dtm_data.u32, dtm.json) next to the corpus. Counting any |
+ |grouping of songs is then a sum over the rows of the    |
+ |group, without reading the tokens again.                 |
+ * ------------------------------------------------------- *
+numpy citations
+   -->[https://numpy.org/doc/stable/reference/generated/numpy.memmap.html]
+   -->[https://numpy.org/doc/stable/reference/generated/numpy.bincount.html]
+CSR citations
+   -->[https://docs.scipy.org/doc/scipy/reference/generated/scipy.sparse.csr_array.html]
+"""
+
+from data_store import tokenize_media, load_vocab
+from collections import namedtuple
+import numpy as np
+import json
+import os
+
+
+#tokens read per step while building the count matrix (bounds memory)
+chunk_tokens = 2**24
+
+#the files of the cached count matrix
+dtm_files = [('indptr','dtm_indptr.u64',np.uint64),
+             ('indices','dtm_indices.u32',np.uint32),
+             ('data','dtm_data.u32',np.uint32)]
+
+#the one read of media export_corpus and load_corpus make
+media_scan = ("SELECT tokens, genre, artist_name, year FROM media "
+              "WHERE tokens IS NOT NULL ORDER BY rowid")
+
+#word counts of a list of strata: keys, a (keys x vocabulary) CSR matrix
+#(see csr_matrix) and the vocabulary its columns are indexed by
+CountTable = namedtuple('CountTable',['keys','counts','vocab'])
+
+
+def export_corpus(conn,directory='corpus'):
+    """
+    Write the media table out as a memory mappable corpus (see the file header).
+    Songs are written in rowid order, so song i of the corpus is the i-th row a
+    plain SELECT on media returns.
+
+    Inputs:
+        -conn: connection made by data_store.open_db
+        -directory to write the corpus to
+
+    Output:
+        -the amount of songs written
+    """
+    os.makedirs(directory,exist_ok=True)
+    tokenize_media(conn) #make sure every song has its tokens
+
+    #the cached count matrix belongs to the old export
+    if os.path.exists(os.path.join(directory,'dtm.json')):
+        os.remove(os.path.join(directory,'dtm.json'))
+
+    offsets = [0]
+    genres  = {}
+    genre   = []
+    artists = {}
+    artist  = []
+    year    = []
+
+    with open(os.path.join(directory,'tokens.u32'),'wb') as tokens_f:
+        #stream the table, only one song's tokens are in memory at a time
+        for blob, genre_, artist_, year_ in conn.execute(media_scan):
+            tokens_f.write(blob)
+            offsets.append(offsets[-1] + len(blob)//4)
+            genre.append(genres.setdefault(genre_ or "",len(genres)))
+            artist.append(artists.setdefault(artist_ or "",len(artists)))
+            year.append(int(year_))
+
+    np.array(offsets,dtype=np.uint64).tofile(os.path.join(directory,'offsets.u64'))
+    np.array(genre,dtype=np.uint16).tofile(os.path.join(directory,'genre.u16'))
+    np.array(artist,dtype=np.uint32).tofile(os.path.join(directory,'artist.u32'))
+    np.array(year,dtype=np.uint16).tofile(os.path.join(directory,'year.u16'))
+
+    with open(os.path.join(directory,'artists.json'),'w',encoding='utf-8') as artists_f:
+        json.dump([a for a in artists.keys()],artists_f)
+
+    vocab = load_vocab(conn)
+    with open(os.path.join(directory,'vocab.txt'),'w',encoding='utf-8') as vocab_f:
+        vocab_f.write("\n".join(vocab))
+
+    #written last: a corpus without meta.json is an unfinished export
+    meta = {'n_songs' :len(genre),
+            'n_tokens':offsets[-1],
+            'n_vocab' :len(vocab),
+            'genres'  :[g for g in genres.keys()]}
+    with open(os.path.join(directory,'meta.json'),'w') as meta_f:
+        json.dump(meta,meta_f)
+
+    return len(genre)
+
+def open_corpus(directory='corpus'):
+    """
+    Map an exported corpus into memory. Only the small vocabulary is actually
+    read, the arrays are paged in by the OS as they are used.
+
+    Output:
+        -dictionary with 'tokens', 'offsets', 'genre', 'artist', 'year' (read
+         only NumPy arrays backed by the files), 'genres' and 'artists' (labels),
+         'vocab' (list of words indexed by word id), 'dir' and 'meta'
+    """
+    with open(os.path.join(directory,'meta.json')) as meta_f:
+        meta = json.load(meta_f)
+
+    with open(os.path.join(directory,'vocab.txt'),encoding='utf-8') as vocab_f:
+        vocab = vocab_f.read().split("\n") if meta['n_vocab'] else []
+
+    with open(os.path.join(directory,'artists.json'),encoding='utf-8') as artists_f:
+        artists = json.load(artists_f)
+
+    corpus = {'genres':meta['genres'],'artists':artists,'vocab':vocab,'dir':directory,'meta':meta}
+    for name, dtype, size in [('tokens.u32',np.uint32,meta['n_tokens']),
+                              ('offsets.u64',np.uint64,meta['n_songs'] + 1),
+                              ('genre.u16',np.uint16,meta['n_songs']),
+                              ('artist.u32',np.uint32,meta['n_songs']),
+                              ('year.u16',np.uint16,meta['n_songs'])]:
+        corpus[name.split('.')[0]] = map_array(os.path.join(directory,name),dtype,size)
+
+    return corpus
+
+def load_corpus(conn):
+    """
+    Build a corpus in memory (the same dictionary open_corpus returns, with
+    'dir' None) from a single streaming read of media. Nothing is written to
+    disk, the count matrix is kept in memory too.
+
+    Input:
+        -conn: connection made by data_store.open_db
+    """
+    tokenize_media(conn) #make sure every song has its tokens
+
+    tokens  = bytearray()
+    offsets = [0]
+    genres  = {}
+    genre   = []
+    artists = {}
+    artist  = []
+    year    = []
+
+    for blob, genre_, artist_, year_ in conn.execute(media_scan):
+        tokens += blob
+        offsets.append(offsets[-1] + len(blob)//4)
+        genre.append(genres.setdefault(genre_ or "",len(genres)))
+        artist.append(artists.setdefault(artist_ or "",len(artists)))
+        year.append(int(year_))
+
+    vocab = load_vocab(conn)
+    meta  = {'n_songs' :len(genre),
+             'n_tokens':offsets[-1],
+             'n_vocab' :len(vocab),
+             'genres'  :[g for g in genres.keys()]}
+
+    return {'genres'  :meta['genres'],
+            'artists' :[a for a in artists.keys()],
+            'vocab'   :vocab,
+            'dir'     :None,
+            'meta'    :meta,
+            'tokens'  :np.frombuffer(bytes(tokens),dtype=np.uint32),
+            'offsets' :np.array(offsets,dtype=np.uint64),
+            'genre'   :np.array(genre,dtype=np.uint16),
+            'artist'  :np.array(artist,dtype=np.uint32),
+            'year'    :np.array(year,dtype=np.uint16)}
+
+def map_array(path,dtype,size): #helper method
+    """
+    Map a flat binary file as a read only array of size elements.
+    """
+    #np.memmap can not map an empty file
+    if not size:
+        return np.zeros(0,dtype=dtype)
+
+    return np.memmap(path,dtype=dtype,mode='r',shape=(size,))
+
+def song_ids(corpus,i):
+    """
+    The word ids of song i, as a view into the mapped tokens.
+    """
+    offsets = corpus['offsets']
+    return corpus['tokens'][int(offsets[i]):int(offsets[i+1])]
+
+def decade_label(year,calendar=False):
+    """
+    The decade of a year, bucketed like stratify_by_year in data_analysis.py:
+    1980-1989, 1990-1999 and 2000-2010 (the last chart year goes with the
+    2000s, so year_stats keeps three strata). Years outside the charts, or
+    every year with calendar=True, get their calendar decade (grouping by 
+    'calendar_decade').
+
+    Ex: decade_label(1987) returns '1980-1989', decade_label(2010) returns 
+        '2000-2010', decade_label(2010,calendar=True) returns '2010-2019'
+    """
+    start = year - year % 10
+    if not calendar and 2000 <= year <= 2010:
+        return "2000-2010"
+    return "{}-{}".format(start,start+9)
+
+def song_codes(corpus,by): #helper method
+    """
+    The stratum of every song along one dimension, as an index into its labels.
+
+    Output:
+        -array of codes, list of labels
+    """
+    if by in ['genre','artist']:
+        return np.asarray(corpus[by]), corpus[by + 's']
+
+    years  = np.asarray(corpus['year'])
+    uniq   = np.unique(years)
+    labels = [str(y) if by == 'year' else decade_label(int(y),by == 'calendar_decade') for y in uniq]
+
+    return np.searchsorted(uniq,years), labels
+
+def corpus_strata(corpus,by='genre'):
+    """
+    Group the songs of a corpus. The keys are the values found in the data.
+
+    Input:
+        -by: 'genre', 'artist', 'year', 'decade' or 'calendar_decade' (see 
+             decade_label), or a tuple of them for a cube (ex: ('genre','year') gives keys like ('Rock','1987'))
+
+    Output:
+        -dictionary of stratum key to a sorted array of song indices
+    """
+    dims   = by if isinstance(by,tuple) else (by,)
+    coded  = [song_codes(corpus,dim) for dim in dims]
+    labels = [dim_labels for _, dim_labels in coded]
+
+    #one code per combination of the dimensions
+    codes = (np.ravel_multi_index([c for c, _ in coded],[len(l) for l in labels])
+             if len(corpus['offsets']) > 1 else np.zeros(0,dtype=np.int64))
+
+    #sorting once groups every stratum's songs together (in song order)
+    order = np.argsort(codes,kind='stable')
+    uniq, starts = np.unique(codes[order],return_index=True)
+
+    strata = {}
+    for code, songs in zip(uniq.tolist(),np.split(order,starts[1:])):
+        parts = np.unravel_index(code,[len(l) for l in labels])
+        key   = tuple(labels[d][int(part)] for d, part in enumerate(parts))
+        key   = key if isinstance(by,tuple) else key[0]
+
+        #different codes can share a label (ex: two years of one decade)
+        strata[key] = np.union1d(strata[key],songs) if key in strata else songs
+
+    return strata
+
+def corpus_groupings(corpus,groupings):
+    """
+    Group the songs of a corpus several ways at once (see corpus_strata).
+
+    Ex:
+        corpus_groupings(corpus,['genre','decade',('genre','year')])
+
+    Output:
+        -dictionary of grouping to its strata
+    """
+    return {by:corpus_strata(corpus,by) for by in groupings}
+
+def song_chunks(corpus,max_tokens=None): #helper method
+    """
+    Cut the songs of a corpus into consecutive runs of about max_tokens tokens
+    (at least one song each).
+
+    Output:
+        -generator of (first song, one past the last song)
+    """
+    max_tokens = max_tokens or chunk_tokens
+    offsets    = corpus['offsets']
+    n_songs    = len(offsets) - 1
+    start      = 0
+
+    while start < n_songs:
+        stop  = int(np.searchsorted(offsets,offsets[start] + np.uint64(max_tokens),side='right')) - 1
+        stop  = min(max(stop,start + 1),n_songs)
+        yield start, stop
+        start = stop
+
+def strata_codes(strata,n_songs): #helper method
+    """
+    The stratum of every song as an index into the keys of strata (-1 => the
+    song is in none of them).
+    """
+    codes = np.full(n_songs,-1,dtype=np.int64)
+    for k, songs in enumerate(strata.values()):
+        codes[songs] = k
+
+    return codes
+
+def corpus_word_counts(corpus,strata):
+    """
+    Count every word of every stratum.
+
+    Inputs:
+        -corpus made by open_corpus
+        -strata: dictionary of key to song indices (corpus_strata), the
+                 strata must not share songs
+
+    Output:
+        -CountTable of the strata
+    """
+    dtm    = corpus_dtm(corpus)
+    counts = group_rows(dtm,strata_codes(strata,dtm['shape'][0]),len(strata))
+
+    return CountTable([key for key in strata.keys()],counts,corpus['vocab'])
+
+def song_averages(corpus,values,weights):
+    """
+    The weighted average of a per word value over the words of every song, as
+    two products of the count matrix with a vector. With values = syllables
+    per word this is every song's syllabic average.
+
+    Inputs:
+        -corpus made by open_corpus
+        -values: integer array over the vocabulary
+        -weights: integer array over the vocabulary (how much each occurrence of
+                  a word counts)
+
+    Output:
+        -float array with one average per song (nan for a song without words)
+    """
+    dtm   = corpus_dtm(corpus)
+    sums  = csr_dot(dtm,(values*weights).astype(np.int64))
+    norms = csr_dot(dtm,weights.astype(np.int64))
+
+    averages = np.full(len(norms),np.nan)
+    np.divide(sums,norms,out=averages,where=norms > 0)
+
+    return averages
+
+###############################################################################
+########################### DOCUMENT-TERM MATRIX ##############################
+###############################################################################
+def csr_matrix(indptr,indices,data,shape):
+    """
+    A sparse matrix in CSR form, as a dictionary: row i holds data[indptr[i]:
+    indptr[i+1]] in the columns indices[indptr[i]:indptr[i+1]] (ascending).
+    This is the layout of scipy.sparse.csr_array, see csr_to_scipy.
+    """
+    return {'indptr':indptr,'indices':indices,'data':data,'shape':shape}
+
+def csr_row(csr,i):
+    """
+    The columns and values of row i of a CSR matrix.
+    """
+    start, stop = int(csr['indptr'][i]), int(csr['indptr'][i+1])
+    return csr['indices'][start:stop], csr['data'][start:stop]
+
+def csr_dense(csr):
+    """
+    A CSR matrix as a dense int64 array. Only for matrices with few rows.
+    """
+    dense = np.zeros(csr['shape'],dtype=np.int64)
+    rows  = np.repeat(np.arange(csr['shape'][0]),np.diff(csr['indptr']).astype(np.int64))
+    dense[rows,csr['indices']] = csr['data']
+
+    return dense
+
+def csr_dot(csr,vector):
+    """
+    The product of a CSR matrix with a vector over its columns.
+    """
+    indptr = np.asarray(csr['indptr']).astype(np.int64)
+    result = np.zeros(csr['shape'][0],dtype=np.result_type(vector,csr['data']))
+    full   = np.diff(indptr) > 0
+
+    #reduceat over the rows that have values, the others stay 0
+    if full.any():
+        products = csr['data'].astype(result.dtype)*vector[csr['indices']]
+        result[full] = np.add.reduceat(products,indptr[:-1][full])
+
+    return result
+
+def csr_to_scipy(csr):
+    """
+    Hand a CSR matrix to scipy (an optional dependency) as a scipy.sparse.csr_array.
+    """
+    from scipy.sparse import csr_array
+    return csr_array((csr['data'],csr['indices'],csr['indptr']),shape=csr['shape'])
+
+def group_rows(csr,codes,n_groups):
+    """
+    Sum the rows of a CSR matrix by group.
+
+    Inputs:
+        -csr: matrix of (rows x columns)
+        -codes: group of every row (-1 => left out)
+        -n_groups: the amount of groups
+
+    Output:
+        -CSR matrix of (n_groups x columns), row k the sum of the rows of group k
+    """
+    n_cols  = csr['shape'][1]
+    nnz_grp = np.repeat(codes,np.diff(csr['indptr']).astype(np.int64))
+    keep    = nnz_grp >= 0
+
+    #(group, column) pairs as one flat key, summed per distinct key
+    flat = nnz_grp[keep]*n_cols + csr['indices'][keep]
+    keys, inverse = np.unique(flat,return_inverse=True)
+    sums = np.bincount(inverse,weights=csr['data'][keep],minlength=len(keys)).astype(np.int64)
+
+    indptr = np.zeros(n_groups + 1,dtype=np.int64)
+    np.cumsum(np.bincount(keys//n_cols,minlength=n_groups),out=indptr[1:])
+
+    return csr_matrix(indptr,(keys % n_cols).astype(np.uint32),sums,(n_groups,n_cols))
+
+def count_songs(tokens,offsets,n_vocab): #helper method
+    """
+    The count matrix rows of a run of songs.
+
+    Inputs:
+        -tokens of the songs, offsets of the songs into tokens (starting at 0)
+
+    Output:
+        -stored counts per song, column of every count (uint32), the counts (uint32)
+    """
+    rows = np.repeat(np.arange(len(offsets) - 1),np.diff(offsets).astype(np.int64))
+
+    #distinct (song, word) pairs come out sorted by song, then word
+    keys, counts = np.unique(rows*n_vocab + tokens.astype(np.int64),return_counts=True)
+
+    return (np.bincount(keys//n_vocab,minlength=len(offsets) - 1),
+            (keys % n_vocab).astype(np.uint32),counts.astype(np.uint32))
+
+def build_dtm(corpus,max_tokens=None):
+    """
+    Build the song x word count matrix of a corpus and save it next to it.
+    The tokens are read a chunk of songs at a time and the matrix is written
+    out as it is built, so neither has to fit in memory.
+
+    Output:
+        -the number of stored (song, word) counts
+    """
+    directory = corpus['dir']
+    offsets   = corpus['offsets']
+    n_vocab   = len(corpus['vocab'])
+    row_nnz   = np.zeros(len(offsets) - 1,dtype=np.int64)
+    paths     = {name:os.path.join(directory,file) for name, file, _ in dtm_files}
+
+    with open(paths['indices'],'wb') as indices_f, open(paths['data'],'wb') as data_f:
+        for start, stop in song_chunks(corpus,max_tokens):
+            tokens = corpus['tokens'][int(offsets[start]):int(offsets[stop])]
+            row_nnz[start:stop], indices, data = count_songs(tokens,offsets[start:stop+1] - offsets[start],n_vocab)
+
+            indices.tofile(indices_f)
+            data.tofile(data_f)
+
+    indptr = np.zeros(len(row_nnz) + 1,dtype=np.uint64)
+    np.cumsum(row_nnz,out=indptr[1:])
+    indptr.tofile(paths['indptr'])
+
+    #written last: the matrix only counts as cached once this exists
+    nnz = int(indptr[-1])
+    with open(os.path.join(directory,'dtm.json'),'w') as dtm_f:
+        json.dump({'n_songs':len(row_nnz),'n_vocab':n_vocab,'n_tokens':corpus['meta']['n_tokens'],
+                   'nnz':nnz},dtm_f)
+
+    return nnz
+
+def corpus_dtm(corpus):
+    """
+    The song x word count matrix of a corpus (a CSR matrix of memory mapped
+    arrays), built on first use and cached on disk and in the corpus.
+    """
+    if 'dtm' in corpus:
+        return corpus['dtm']
+
+    if corpus['dir'] is None: #a corpus from load_corpus
+        row_nnz, indices, data = count_songs(corpus['tokens'],corpus['offsets'],len(corpus['vocab']))
+        indptr = np.zeros(len(row_nnz) + 1,dtype=np.uint64)
+        np.cumsum(row_nnz,out=indptr[1:])
+
+        corpus['dtm'] = csr_matrix(indptr,indices,data,(len(row_nnz),len(corpus['vocab'])))
+        return corpus['dtm']
+
+    meta = corpus['meta']
+    path = os.path.join(corpus['dir'],'dtm.json')
+    info = None
+    if os.path.exists(path):
+        with open(path) as dtm_f:
+            info = json.load(dtm_f)
+
+    #a matrix of another export is rebuilt
+    if info is None or [info['n_songs'],info['n_vocab'],info['n_tokens']] != \
+                       [meta['n_songs'],meta['n_vocab'],meta['n_tokens']]:
+        build_dtm(corpus)
+        with open(path) as dtm_f:
+            info = json.load(dtm_f)
+
+    sizes = {'indptr':info['n_songs'] + 1,'indices':info['nnz'],'data':info['nnz']}
+    arrays = {name:map_array(os.path.join(corpus['dir'],file),dtype,sizes[name])
+              for name, file, dtype in dtm_files}
+
+    corpus['dtm'] = csr_matrix(arrays['indptr'],arrays['indices'],arrays['data'],
+                               (info['n_songs'],info['n_vocab']))
+    return corpus['dtm']
@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+"""
+ * ------------------------------------------------------- *
+ |CS/STAT 287 FINAL PROJECT: STRATUM COUNTS FILE           |
+ |                                                         |
+ |This file keeps per stratum aggregates of media in the   |
+ |database, so the Yule and syllable statistics of every   |
+ |genre and year can be read without scanning the lyrics: |
+ |                                                         |
+ |   stratum_counts --> (dim, stratum, word id, count)     |
+ |   stratum_songs  --> (dim, stratum, songs, songs with   |
+ |                      no words, sum of the syllabic      |
+ |                      averages of the other songs)       |
+ |                                                         |
+ |dim is 'genre' or 'year'. Triggers on media log every    |
+ |insert, delete and change of tokens/genre/year to        |
+ |count_deltas: the old song with sign -1, the new song    |
+ |with sign +1. apply_deltas folds the log into the        |
+ |aggregates, so keeping them up to date costs O(songs     |
+ |changed), whichever code changed media (insert_songs,    |
+ |set_genres, relabel, delete_songs, tokenize_media...).   |
+ |The log is applied before every read.                    |
+ * ------------------------------------------------------- *
+sqlite3 citations
+   -->[https://www.sqlite.org/lang_createtrigger.html]
+   -->[https://www.sqlite.org/json1.html#jeach]
+"""
+
+from data_store import load_vocab, batch_size
+from data_corpus import CountTable, csr_matrix, decade_label
+from data_syllables import syllable_vector
+import numpy as np
+import json
+
+
+#the dimensions aggregates are kept for
+dims = ['genre','year']
+
+
+def ensure_stratum_counts(conn):
+    """
+    Create the aggregate tables and the triggers feeding count_deltas. The
+    first time, every song already in media is logged, so the first
+    apply_deltas builds the aggregates from scratch.
+    """
+    have = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'stratum_songs'").fetchone()
+    if have is not None:
+        return
+
+    with conn:
+        conn.execute("CREATE TABLE IF NOT EXISTS count_deltas (sign integer, genre text, year text, tokens blob)")
+        conn.execute("CREATE TABLE IF NOT EXISTS stratum_counts (dim text, stratum text, word_id integer, "
+                     "count integer, PRIMARY KEY (dim, stratum, word_id)) WITHOUT ROWID")
+
+        #the old song goes out, the new song comes in (songs without tokens
+        #are not counted yet, tokenize_media logs them once they have some)
+        conn.execute("CREATE TRIGGER IF NOT EXISTS media_insert_counts AFTER INSERT ON media "
+                     "WHEN NEW.tokens IS NOT NULL BEGIN "
+                     "INSERT INTO count_deltas VALUES (1, NEW.genre, NEW.year, NEW.tokens); END")
+        conn.execute("CREATE TRIGGER IF NOT EXISTS media_delete_counts AFTER DELETE ON media "
+                     "WHEN OLD.tokens IS NOT NULL BEGIN "
+                     "INSERT INTO count_deltas VALUES (-1, OLD.genre, OLD.year, OLD.tokens); END")
+        conn.execute("CREATE TRIGGER IF NOT EXISTS media_update_counts AFTER UPDATE OF tokens, genre, year ON media "
+                     "WHEN OLD.tokens IS NOT NEW.tokens OR OLD.genre IS NOT NEW.genre OR OLD.year IS NOT NEW.year "
+                     "BEGIN "
+                     "INSERT INTO count_deltas SELECT -1, OLD.genre, OLD.year, OLD.tokens WHERE OLD.tokens IS NOT NULL; "
+                     "INSERT INTO count_deltas SELECT 1, NEW.genre, NEW.year, NEW.tokens WHERE NEW.tokens IS NOT NULL; "
+                     "END")
+
+        conn.execute("INSERT INTO count_deltas SELECT 1, genre, year, tokens FROM media "
+                     "WHERE tokens IS NOT NULL ORDER BY rowid")
+
+        #created last: the aggregates only count as set up once this exists
+        conn.execute("CREATE TABLE stratum_songs (dim text, stratum text, songs integer, empty integer, "
+                     "syl_sum real, PRIMARY KEY (dim, stratum))")
+
+def rebuild_counts(conn):
+    """
+    Drop the aggregates and build them again from media (ex: after the
+    syllable table changed).
+    """
+    with conn:
+        for trigger in ['media_insert_counts','media_delete_counts','media_update_counts']:
+            conn.execute("DROP TRIGGER IF EXISTS {}".format(trigger))
+        for table in ['count_deltas','stratum_counts','stratum_songs']:
+            conn.execute("DROP TABLE IF EXISTS {}".format(table))
+
+    ensure_stratum_counts(conn)
+    return apply_deltas(conn)
+
+def apply_deltas(conn,size=None):
+    """
+    Fold the logged changes of media into the aggregates, in the order they
+    were made, and clear the log.
+
+    Output:
+        -the amount of logged songs applied
+    """
+    ensure_stratum_counts(conn)
+    size = size or batch_size
+    done = 0
+
+    while True:
+        rows = conn.execute("SELECT rowid, sign, genre, year, tokens FROM count_deltas "
+                            "ORDER BY rowid LIMIT ?",(size,)).fetchall()
+        if not rows:
+            break
+
+        with conn: #a batch is applied and dropped from the log together
+            apply_batch(conn,rows)
+            conn.execute("DELETE FROM count_deltas WHERE rowid <= ?",(rows[-1][0],))
+
+        done += len(rows)
+
+    return done
+
+def apply_batch(conn,rows): #helper method
+    """
+    Add a batch of logged songs (rowid, sign, genre, year, tokens) to the aggregates.
+    """
+    signs   = np.array([row[1] for row in rows],dtype=np.int64)
+    tokens  = np.frombuffer(b"".join(row[4] for row in rows),dtype=np.uint32).astype(np.int64)
+    lengths = np.array([len(row[4])//4 for row in rows],dtype=np.int64)
+    avgs    = song_syllables(conn,tokens,lengths)
+
+    for d, dim in enumerate(dims):
+        labels = [(row[2+d] or "") if dim == 'genre' else str(int(row[2+d])) for row in rows]
+        strata, codes = np.unique(np.array(labels,dtype=str),return_inverse=True)
+        strata = strata.tolist()
+
+        #net change of every (stratum, word) of the batch
+        n_vocab = int(tokens.max()) + 1 if len(tokens) else 1
+        flat, where = np.unique(np.repeat(codes,lengths)*n_vocab + tokens,return_inverse=True)
+        deltas = np.bincount(where,weights=np.repeat(signs,lengths),minlength=len(flat)).astype(np.int64)
+
+        changed = np.flatnonzero(deltas != 0)
+        keys    = [(dim,strata[f//n_vocab],f % n_vocab) for f in flat[changed].tolist()]
+        conn.executemany("INSERT INTO stratum_counts (dim,stratum,word_id,count) VALUES (?,?,?,?) "
+                         "ON CONFLICT (dim,stratum,word_id) DO UPDATE SET count = count + excluded.count",
+                         [key + (n,) for key, n in zip(keys,deltas[changed].tolist())])
+
+        #words a batch took out of a stratum completely
+        conn.executemany("DELETE FROM stratum_counts WHERE dim = ? AND stratum = ? AND word_id = ? AND count = 0",
+                         [key for key, n in zip(keys,deltas[changed].tolist()) if n < 0])
+
+        #songs and syllable sums. averages are added one song at a time in
+        #the order they were logged, so appending songs gives the very same
+        #float as data_analysis.count_syls summing them in song order
+        songs = {}
+        for code, sign, avg in zip(codes.tolist(),signs.tolist(),avgs.tolist()):
+            songs.setdefault(code,[]).append((sign,avg))
+
+        for code, changes in songs.items():
+            n, empty, syl_sum = conn.execute("SELECT songs, empty, syl_sum FROM stratum_songs "
+                                             "WHERE dim = ? AND stratum = ?",(dim,strata[code])).fetchone() or (0,0,0.0)
+            for sign, avg in changes:
+                n += sign
+                if avg != avg: #nan: a song without words
+                    empty += sign
+                else:
+                    syl_sum = syl_sum + avg if sign > 0 else syl_sum - avg
+
+            if n:
+                conn.execute("INSERT OR REPLACE INTO stratum_songs (dim,stratum,songs,empty,syl_sum) "
+                             "VALUES (?,?,?,?,?)",(dim,strata[code],n,empty,syl_sum))
+            else:
+                conn.execute("DELETE FROM stratum_songs WHERE dim = ? AND stratum = ?",(dim,strata[code]))
+
+def song_syllables(conn,tokens,lengths): #helper method
+    """
+    The syllabic average of every song of a batch, scoring only the words the
+    batch uses (weights as data_analysis.vocab_syllables: cmudict words count
+    twice). nan for a song without words.
+    """
+    avgs = np.full(len(lengths),np.nan)
+    if not len(tokens):
+        return avgs
+
+    ids, where = np.unique(tokens,return_inverse=True)
+    words = [w for (w,) in conn.execute("SELECT word FROM vocab WHERE word_id IN "
+                                        "(SELECT value FROM json_each(?)) ORDER BY word_id",
+                                        (json.dumps(ids.tolist()),))]
+
+    syls, found = syllable_vector(words)
+    weights     = np.where(found,2,1).astype(np.int64)
+
+    starts = np.concatenate([[0],np.cumsum(lengths)[:-1]])
+    full   = lengths > 0
+    avgs[full] = (np.add.reduceat((syls*weights)[where],starts[full]) /
+                  np.add.reduceat(weights[where],starts[full]))
+
+    return avgs
+
+###############################################################################
+################################ READING ######################################
+###############################################################################
+def stratum_labels(dim,by): #helper method
+    """
+    The stratum of by (genre, year or decade) a stored stratum of dim falls in.
+    """
+    if by in ['decade','calendar_decade']:
+        return lambda year: decade_label(int(year),by == 'calendar_decade')
+    return lambda stratum: stratum
+
+def stored_dim(by): #helper method
+    if by not in ['genre','year','decade','calendar_decade']:
+        raise ValueError("aggregates are kept by genre, year or decade, not {}".format(by))
+    return 'genre' if by == 'genre' else 'year'
+
+def stratum_word_counts(conn,by='genre'):
+    """
+    The word counts of every genre, year or decade, read from the aggregates.
+
+    Output:
+        -CountTable of the strata (keys in sorted order), over the whole vocabulary
+    """
+    apply_deltas(conn)
+    dim   = stored_dim(by)
+    label = stratum_labels(dim,by)
+
+    rows = conn.execute("SELECT stratum, word_id, count FROM stratum_counts WHERE dim = ? "
+                        "ORDER BY stratum, word_id",(dim,)).fetchall()
+    vocab = load_vocab(conn)
+
+    strata = sorted(set(label(row[0]) for row in rows))
+    code   = {key:i for i, key in enumerate(strata)}
+
+    #strata that share a label (the years of a decade) are summed
+    flat = np.array([code[label(s)]*len(vocab) + w for s, w, _ in rows],dtype=np.int64)
+    flat, where = np.unique(flat,return_inverse=True)
+    data = np.bincount(where,weights=[n for _, _, n in rows],minlength=len(flat)).astype(np.uint32)
+
+    indptr = np.searchsorted(flat,np.arange(len(strata) + 1,dtype=np.int64)*len(vocab)).astype(np.int64)
+
+    return CountTable(strata,csr_matrix(indptr,(flat % max(len(vocab),1)).astype(np.uint32),data,
+                                        (len(strata),len(vocab))),vocab)
+
+def stratum_syllables(conn,by='genre'):
+    """
+    The syllabic average of every genre, year or decade (the average of the
+    syllabic averages of its songs), read from the aggregates.
+
+    The sums are kept incrementally, so once songs were deleted or re-labelled
+    (or for decades, summed over years) they can differ from count_syls in
+    the last bits of the float.
+
+    Output:
+        -dictionary of stratum to its syllabic average, nan if a song of the
+         stratum has no words (like data_analysis.count_syls)
+    """
+    return {key:(float('nan') if empty else syl_sum/songs) for key, (songs, empty, syl_sum) in 
+            stratum_song_sums(conn,by).items()}
+
+def stratum_song_sums(conn,by='genre'):
+    """
+    The songs of every genre, year or decade, read from the aggregates.
+
+    Output:
+        -dictionary of stratum to (songs, songs without words, sum of the
+         syllabic averages of the other songs)
+    """
+    apply_deltas(conn)
+    dim   = stored_dim(by)
+    label = stratum_labels(dim,by)
+
+    totals = {}
+    for stratum, songs, empty, syl_sum in conn.execute("SELECT stratum, songs, empty, syl_sum FROM stratum_songs "
+                                                       "WHERE dim = ? ORDER BY stratum",(dim,)):
+        n, e, s = totals.get(label(stratum),(0,0,0.0))
+        totals[label(stratum)] = (n + songs,e + empty,s + syl_sum)
+
+    return totals
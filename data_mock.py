@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""
+ * ------------------------------------------------------- *
+ |CS/STAT 287 FINAL PROJECT: MOCK SERVER FILE              |
+ |                                                         |
+ |This file stands up local stand-ins for the three sites  |
+ |that data_xtraction.py talks to (jamrockentertainment,   |
+ |chartlyrics and musixmatch) so that the crawl can be     |
+ |benchmarked without touching the real APIs or quotas.    |
+ |                                                         |
+ |Each service runs on its own port so that per-host       |
+ |connection pools and rate limits behave exactly like     |
+ |they would against the real hosts.                       |
+ * ------------------------------------------------------- *
+http.server resources:
+
+[https://docs.python.org/3/library/http.server.html]
+"""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import threading
+import json
+import time
+
+
+#a handful of genres so that the fake musixmatch answers look realistic
+mock_genres = [['Rock','Pop/Rock'],['Pop','Vocal'],['Hip Hop/Rap','Rap'],
+               ['Country'],['R&B/Soul','Disco'],['Dance','Electronic']]
+
+
+def mock_chart(year,n_songs):
+    """
+    Build a fake jamrock chart page for a given year.
+
+    Input:
+        -year for the page
+        -n_songs: the amount of rows in the chart table
+
+    Output:
+        -html string with one <tr> of rank, song and artist per song
+    """
+    rows = ["<tr><td>{}</td><td>Song {} {}</td><td>Artist {}</td></tr>".format(i+1,year,i,i)
+            for i in range(n_songs)]
+
+    return "<html><body><table>{}</table></body></html>".format("".join(rows))
+
+def mock_lyrics(song,artist):
+    """
+    Build a fake chartlyrics SearchLyricDirect answer for a song.
+    """
+    words = " ".join("{} {} la la love".format(song,artist) for _ in range(40))
+
+    return ("<?xml version=\"1.0\" encoding=\"utf-8\"?><GetLyricResult>"
+            "<LyricSong>{}</LyricSong><LyricArtist>{}</LyricArtist>"
+            "<Lyric>{}</Lyric></GetLyricResult>").format(song,artist,words)
+
+def mock_genre(song,artist):
+    """
+    Build a fake musixmatch track.search answer for a song.
+    """
+    genres = mock_genres[len(song+artist) % len(mock_genres)]
+    genre_list = [{'music_genre':{'music_genre_name':g}} for g in genres]
+    track = {'track':{'track_name':song,'artist_name':artist,
+                      'primary_genres':{'music_genre_list':genre_list}}}
+
+    return json.dumps({'message':{'body':{'track_list':[track]}}})
+
+def make_handler(service,n_songs,latency):
+    """
+    Make a request handler class for one of the mocked services.
+
+    Inputs:
+        -service: 'jamrock', 'chartlyrics' or 'musixmatch'
+        -n_songs: the amount of songs on each chart page
+        -latency: seconds to sleep before answering (simulated network time)
+
+    Output:
+        -a BaseHTTPRequestHandler subclass
+    """
+
+    class MockHandler(BaseHTTPRequestHandler):
+
+        #keep-alive, so connection reuse is actually measured
+        protocol_version = 'HTTP/1.1'
+        
+        #headers and body go out in separate writes, don't let nagle hold the body
+        disable_nagle_algorithm = True
+
+        def do_GET(self):
+            url   = urlparse(self.path)
+            query = {k:v[0] for k,v in parse_qs(url.query).items()}
+
+            if service == 'jamrock':
+                year = url.path.split('-')[-1].split('.')[0]
+                body = mock_chart(year,n_songs)
+
+            elif service == 'chartlyrics':
+                body = mock_lyrics(query.get('song',''),query.get('artist',''))
+
+            else:
+                body = mock_genre(query.get('q_track',''),query.get('q_artist',''))
+
+            time.sleep(latency)
+
+            body = body.encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Length',str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self,*args): #keep the benchmark output readable
+            pass
+
+    return MockHandler
+
+def start_mock_servers(n_songs=100,latency=0.05):
+    """
+    Start one threaded mock server per service on free local ports.
+
+    Inputs:
+        -n_songs: the amount of songs on each chart page
+        -latency: seconds each answer is delayed by
+
+    Output:
+        -dictionary of service name to base url (ex: 'http://127.0.0.1:53211')
+        -list of the running servers, to be handed to stop_mock_servers
+    """
+    hosts   = {}
+    servers = []
+
+    for service in ['jamrock','chartlyrics','musixmatch']:
+        server = ThreadingHTTPServer(('127.0.0.1',0),make_handler(service,n_songs,latency))
+        server.daemon_threads = True
+
+        threading.Thread(target=server.serve_forever,daemon=True).start()
+
+        hosts[service] = "http://127.0.0.1:{}".format(server.server_address[1])
+        servers.append(server)
+
+    return hosts, servers
+
+def stop_mock_servers(servers):
+    """
+    Shut down servers started by start_mock_servers.
+    """
+    for server in servers:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,390 @@
+# -*- coding: utf-8 -*-
+"""
+ * ------------------------------------------------------- *
+ |CS/STAT 287 FINAL PROJECT: ANALYSIS PIPELINE FILE        |
+ |                                                         |
+ |This file runs the analysis as a small graph of stages   |
+ |and keeps every stage's result on disk, so a report on an|
+ |unchanged database is read back instead of recomputed:   |
+ |                                                         |
+ |   corpus --> strata --> count --> sanitize --> yule     |
+ |                 |                     |          |      |
+ |                 |                     +--> pairs |      |
+ |                 +-------> syllables              |      |
+ |                              |                   |      |
+ |                              +---> stats <-------+      |
+ |                                    yule_files <--+      |
+ |                                                         |
+ |Every result is keyed by a fingerprint of its inputs:    |
+ |the content hash of media (see media_fingerprint) for    |
+ |the corpus, and for any other stage its own parameters  |
+ |plus the keys of the stages it reads. A key is known     |
+ |before anything is computed, so a stage whose result is  |
+ |cached never loads its inputs at all, and a change to   |
+ |media or to a parameter only reruns the stages after it. |
+ |                                                         |
+ |Results are .npz files (flat NumPy arrays, strings as    |
+ |utf-8 bytes) in cache_dir, named <stage>-<key>.npz.      |
+ * ------------------------------------------------------- *
+numpy citations
+   -->[https://numpy.org/doc/stable/reference/generated/numpy.savez.html]
+"""
+
+from data_corpus import CountTable, csr_matrix, media_scan, load_corpus, corpus_strata, corpus_word_counts
+from data_store import load_vocab
+import data_analysis
+import numpy as np
+import hashlib
+import time
+import json
+import os
+
+
+#where the stage results are kept
+cache_dir = 'analysis_cache'
+
+#part of every key: bump it when a stage starts computing something different
+cache_version = 3
+
+#stage --> (the stages it reads, the parameters it depends on, what it returns)
+#'corpus' is never stored: it is the contents of media, keyed by their hash
+stages = {'corpus'    : ([],                    [],        None),
+          'strata'    : (['corpus'],            ['by'],    'strata'),
+          'count'     : (['corpus','strata'],   [],        'table'),
+          'sanitize'  : (['count'],             ['rules'], 'table'),
+          'yule'      : (['sanitize'],          ['k'],     'yules'),
+          'pairs'     : (['sanitize'],          ['k'],     'pairs'),
+          'syllables' : (['corpus','strata'],   ['cmu'],   'averages'),
+          'yule_files': (['yule'],              [],        'done'),
+          'stats'     : (['yule','syllables'],  [],        'done')}
+
+
+###############################################################################
+############################ MEDIA FINGERPRINT ################################
+###############################################################################
+def media_fingerprint(conn):
+    """
+    The content hash of media: every song's tokens, genre, artist and year in
+    rowid order, and the vocabulary.
+
+    The hash is stored in media_version (data_store.ensure_media_version),
+    whose triggers clear it whenever media changes, so media is only read
+    again after it changed.
+    """
+    changes, stored = conn.execute("SELECT changes, hash FROM media_version").fetchone()
+
+    if stored is not None:
+        return stored
+
+    digest = hashlib.sha1()
+    for blob, genre, artist, year in conn.execute(media_scan):
+        digest.update(json.dumps([len(blob),genre,artist,year]).encode('utf-8'))
+        digest.update(blob)
+    digest.update("\n".join(load_vocab(conn)).encode('utf-8'))
+
+    stored = digest.hexdigest()
+
+    #only kept if media did not change while it was read
+    with conn:
+        conn.execute("UPDATE media_version SET hash = ? WHERE changes = ?",(stored,changes))
+
+    return stored
+
+def cmu_fingerprint(): #helper method
+    """
+    What the compiled syllable table was built from (data_syllables). Read
+    from the table's cmu.json once load_syllables made sure the table is
+    current, so nltk is only imported when the table is (re)compiled.
+    """
+    import data_syllables
+
+    data_syllables.load_syllables()
+
+    with open(os.path.join(data_syllables.table_dir,'cmu.json')) as meta_f:
+        return json.load(meta_f)['source']
+
+###############################################################################
+############################### STAGES ########################################
+###############################################################################
+def run_strata(corpus,params):
+    return corpus_strata(corpus,params['by'])
+
+def run_count(corpus,strata,params):
+    return corpus_word_counts(corpus,strata)
+
+def run_sanitize(table,params):
+    rules = [getattr(data_analysis,rule)(*args) for rule, *args in params['rules']]
+    return data_analysis.sanitize(table,rules)
+
+def run_yule(table,params):
+    return data_analysis.yule_batch(table,k=params['k'])
+
+def run_pairs(table,params):
+    return data_analysis.yule_pairs(table,k=params['k'])
+
+def run_syllables(corpus,strata,params):
+    return data_analysis.count_syls(strata,corpus)
+
+def run_yule_files(yules,params):
+    check_writes(params['k'],['yule_files'])
+    data_analysis.write_yules_to_file(yules)
+
+def run_stats(yules,syls,params):
+    check_writes(params['k'],['stats'])
+    data_analysis.ensure_stats_tables()
+
+    if params['by'] == 'genre':
+        data_analysis.write_to_genre_stats(yules,syls)
+    elif params['by'] == 'decade':
+        data_analysis.write_to_year_stats(yules,syls)
+    else:
+        raise ValueError("stats are kept by 'genre' or 'decade', not {}".format(params['by']))
+
+stage_runs = {'strata':run_strata,'count':run_count,'sanitize':run_sanitize,'yule':run_yule,'pairs':run_pairs,
+              'syllables':run_syllables,'yule_files':run_yule_files,'stats':run_stats}
+
+###############################################################################
+############################### THE RUN #######################################
+###############################################################################
+def check_writes(k,writes): #helper method
+    """
+    The *_yules.txt files and the stats table hold the 100 lowest (and
+    highest) coefficients of every stratum, so they need k >= 100 (or None).
+    """
+    if writes and k is not None and k < 100:
+        raise ValueError("{} write the 100 lowest and highest Yule coefficients, k = {} keeps fewer "
+                         "(use k >= 100)".format(" and ".join(writes),k))
+
+def new_run(conn,by='genre',k=None,rules=(),directory=None,writes=()):
+    """
+    Start a run of the pipeline.
+
+    Inputs:
+        -conn: connection made by data_store.open_db (media tokenized)
+        -by: 'genre', 'year', 'decade', 'artist' or a tuple of them
+        -k: Yule coefficients kept at each end (None => the full ranking)
+        -rules: sanitize rules, as (rule name in data_analysis, arguments...)
+                Ex: [('length_bounds',4,16),('min_frequency',2)]
+        -directory: where results are kept, cache_dir by default
+        -writes: the writing stages the run is for ('yule_files', 'stats'),
+                 ValueError if k keeps fewer than the 100 they write
+
+    Output:
+        -the run: a dictionary of its parameters, the key and (once asked
+         for) the result of every stage, and the stages it computed
+    """
+    check_writes(k,writes)
+
+    return {'conn'    :conn,
+            'dir'     :directory or cache_dir,
+            'params'  :{'by':by,'k':k,'rules':[list(rule) for rule in rules],'cmu':cmu_fingerprint()},
+            'keys'    :{},
+            'values'  :{},
+            'computed':[]}
+
+def stage_key(run,stage):
+    """
+    The fingerprint of a stage's inputs: the media hash for the corpus, a hash
+    of the stage's parameters and the keys of the stages it reads otherwise.
+    """
+    if stage not in run['keys']:
+        deps, params, _ = stages[stage]
+
+        if stage == 'corpus':
+            key = media_fingerprint(run['conn'])
+        else:
+            ident = [cache_version,stage,{p:run['params'][p] for p in params},
+                     [stage_key(run,dep) for dep in deps]]
+            key   = hashlib.sha1(json.dumps(ident).encode('utf-8')).hexdigest()
+
+        run['keys'][stage] = key
+
+    return run['keys'][stage]
+
+def artifact(run,stage,force=False):
+    """
+    The result of a stage: from the run if it was already asked for, from the
+    cache if its key is there, otherwise computed from the results of the
+    stages it reads (which are looked up the same way) and stored.
+
+    force reruns the stage itself even if its result is cached (a 'done'
+    stage, ex: stats, is otherwise only run once per key).
+    """
+    if stage in run['values'] and not force:
+        return run['values'][stage]
+
+    deps, _, kind = stages[stage]
+    key  = stage_key(run,stage)
+    path = os.path.join(run['dir'],"{}-{}.npz".format(stage,key))
+
+    if stage == 'corpus':
+        value = load_corpus(run['conn'])
+        run['computed'].append(stage)
+
+    elif os.path.exists(path) and not force:
+        value = load_artifact(path,kind,run['params']['by'])
+
+    else:
+        inputs = [artifact(run,dep) for dep in deps]
+        value  = stage_runs[stage](*inputs,run['params'])
+        save_artifact(path,kind,value)
+        run['computed'].append(stage)
+
+    run['values'][stage] = value
+    return value
+
+def report(conn,by='genre',k=100,rules=(),yule_files=False,stats=False,directory=None,force=False,pairs=False):
+    """
+    The Yule batch and syllabic averages of a stratification, through the cache.
+    With yule_files/stats, also write the *_yules.txt files/the stats table
+    of the stratification (once per set of inputs, unless force), which needs
+    k >= 100 or None (ValueError otherwise). With pairs, also the Yule lists 
+    of every pair of strata (data_analysis.yule_pairs).
+
+    Output:
+        -the run (see new_run), its 'values' hold 'yule' and 'syllables' 
+         (and 'pairs')
+    """
+    writes = [stage for stage, wanted in [('yule_files',yule_files),('stats',stats)] if wanted]
+    run    = new_run(conn,by,k,rules,directory,writes)
+
+    artifact(run,'yule')
+    artifact(run,'syllables')
+
+    if pairs:
+        artifact(run,'pairs')
+
+    if yule_files:
+        artifact(run,'yule_files',force)
+    if stats:
+        artifact(run,'stats',force)
+
+    return run
+
+def time_report(conn,repeat=3,**kwargs):
+    """
+    Time report(): a first run (which fills the cache if it is cold) and the
+    best of repeat runs afterwards, which only read the cache.
+
+    Output:
+        -seconds of the first run, seconds of the best cached run
+    """
+    start = time.perf_counter()
+    report(conn,**kwargs)
+    first = time.perf_counter() - start
+
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        report(conn,**kwargs)
+        best = min(best,time.perf_counter() - start)
+
+    return first, best
+
+###############################################################################
+############################## STORAGE ########################################
+###############################################################################
+def pack_strings(strings): #helper method
+    """
+    A list of strings (none holding a newline) as one utf-8 byte array.
+    """
+    return np.frombuffer("\n".join(strings).encode('utf-8'),dtype=np.uint8)
+
+def unpack_strings(packed,n): #helper method
+    return packed.tobytes().decode('utf-8').split("\n") if n else []
+
+def pack_keys(keys): #helper method
+    return np.frombuffer(json.dumps(keys).encode('utf-8'),dtype=np.uint8)
+
+def unpack_keys(packed,by): #helper method
+    keys = json.loads(packed.tobytes().decode('utf-8'))
+    return [tuple(key) for key in keys] if isinstance(by,(tuple,list)) else keys
+
+def save_artifact(path,kind,value):
+    """
+    Write the result of a stage as flat arrays. Written to a temporary file
+    and renamed, so a result is either complete or missing.
+    """
+    if kind == 'strata':
+        keys   = [key for key in value.keys()]
+        songs  = [np.asarray(s,dtype=np.int64) for s in value.values()]
+        arrays = {'keys'  :pack_keys(keys),
+                  'indptr':np.cumsum([0] + [len(s) for s in songs]).astype(np.int64),
+                  'songs' :np.concatenate(songs) if songs else np.zeros(0,dtype=np.int64)}
+
+    elif kind == 'table':
+        arrays = {'keys'   :pack_keys(value.keys),
+                  'indptr' :np.asarray(value.counts['indptr']),
+                  'indices':np.asarray(value.counts['indices']),
+                  'data'   :np.asarray(value.counts['data']),
+                  'vocab'  :pack_strings(value.vocab),
+                  'n_vocab':np.array(len(value.vocab))}
+
+    elif kind == 'yules':
+        lists  = [yules for yules in value.values()]
+        words  = [word for yules in lists for _, word in yules]
+        arrays = {'keys'   :pack_keys([key for key in value.keys()]),
+                  'indptr' :np.cumsum([0] + [len(yules) for yules in lists]).astype(np.int64),
+                  'coefs'  :np.array([coef for yules in lists for coef, _ in yules],dtype=np.float64),
+                  'words'  :pack_strings(words),
+                  'n_words':np.array(len(words))}
+
+    elif kind == 'averages':
+        arrays = {'keys'  :pack_keys([key for key in value.keys()]),
+                  'values':np.array([avg for avg in value.values()],dtype=np.float64)}
+
+    elif kind == 'pairs':
+        arrays = {'keys'   :pack_keys(value['keys']),
+                  'vocab'  :pack_strings(value['vocab']),
+                  'n_vocab':np.array(len(value['vocab'])),
+                  'k'      :np.array(-1 if value['k'] is None else value['k']),
+                  'indptr' :value['indptr'],
+                  'coefs'  :value['coefs'],
+                  'words'  :value['words']}
+
+    else: #'done': nothing to keep but the fact it ran
+        arrays = {}
+
+    os.makedirs(os.path.dirname(path) or '.',exist_ok=True)
+    tmp = path + '.tmp'
+    with open(tmp,'wb') as tmp_f:
+        np.savez(tmp_f,**arrays)
+    os.replace(tmp,path)
+
+def load_artifact(path,kind,by):
+    """
+    Read back a result written by save_artifact, as the stage returned it.
+    """
+    with np.load(path,allow_pickle=False) as arrays:
+        if kind == 'strata':
+            keys, indptr = unpack_keys(arrays['keys'],by), arrays['indptr']
+            songs = arrays['songs']
+            return {key:songs[indptr[i]:indptr[i+1]] for i, key in enumerate(keys)}
+
+        if kind == 'table':
+            keys  = unpack_keys(arrays['keys'],by)
+            vocab = unpack_strings(arrays['vocab'],int(arrays['n_vocab']))
+            return CountTable(keys,csr_matrix(arrays['indptr'],arrays['indices'],arrays['data'],
+                                              (len(keys),len(vocab))),vocab)
+
+        if kind == 'yules':
+            keys, indptr = unpack_keys(arrays['keys'],by), arrays['indptr'].tolist()
+            coefs = arrays['coefs'].tolist()
+            words = unpack_strings(arrays['words'],int(arrays['n_words']))
+            return {key:[[coef,word] for coef, word in zip(coefs[indptr[i]:indptr[i+1]],words[indptr[i]:indptr[i+1]])]
+                    for i, key in enumerate(keys)}
+
+        if kind == 'pairs':
+            keys = unpack_keys(arrays['keys'],by)
+            return {'keys'  :keys,
+                    'index' :{key:i for i, key in enumerate(keys)},
+                    'vocab' :unpack_strings(arrays['vocab'],int(arrays['n_vocab'])),
+                    'k'     :None if int(arrays['k']) < 0 else int(arrays['k']),
+                    'indptr':arrays['indptr'],
+                    'coefs' :arrays['coefs'],
+                    'words' :arrays['words']}
+
+        if kind == 'averages':
+            return dict(zip(unpack_keys(arrays['keys'],by),arrays['values'].tolist()))
+
+    return True
@@ -0,0 +1,476 @@
+# -*- coding: utf-8 -*-
+"""
+ * ------------------------------------------------------- *
+ |CS/STAT 287 FINAL PROJECT: DATA STORE FILE               |
+ |                                                         |
+ |This file holds the bulk write layer for the media table |
+ |of song_records.db.                                      |
+ |                                                         |
+ |Connections are opened in WAL mode with relaxed syncing, |
+ |media gets a unique (song_name, artist_name, year) key   |
+ |so UPDATEs and DELETEs by song and artist are index      |
+ |lookups instead of table scans, and every write goes     |
+ |through executemany with one transaction per batch      |
+ |instead of one commit per row.                           |
+ |                                                         |
+ |Lyrics are also stored pre-tokenized: media.tokens holds |
+ |the word ids of a song (uint32 array) and vocab maps the |
+ |ids back to words, so the analysis never re-splits text. |
+ |                                                         |
+ |media_version counts the changes to media (triggers) so |
+ |cached analysis results can tell when media changed.     |
+ * ------------------------------------------------------- *
+sqlite3 citations
+   -->[https://www.sqlite.org/wal.html]
+   -->[https://www.sqlite.org/pragma.html]
+   -->[https://www.sqlite.org/lang_upsert.html]
+"""
+
+from data_text import normalize_lyrics, strip_legacy_tags, legacy_open, legacy_close
+from itertools import islice
+from array import array
+import sqlite3
+
+
+#rows per transaction for the bulk writers
+batch_size = 10000
+
+#connection settings: WAL so readers never block the writer, NORMAL syncing
+#(safe in WAL mode, one fsync per checkpoint instead of per commit), and a
+#bigger page cache / memory mapped reads for the analysis scans
+pragmas = ["PRAGMA journal_mode = WAL",
+           "PRAGMA synchronous = NORMAL",
+           "PRAGMA temp_store = MEMORY",
+           "PRAGMA cache_size = -65536",
+           "PRAGMA mmap_size = 268435456"]
+
+
+def open_db(path='song_records.db'):
+    """
+    Connect to the database, tune the connection and make sure media has its
+    key.
+
+    Input:
+        -path of the sqlite3 file
+
+    Output:
+        -the tuned sqlite3 connection
+    """
+    conn = sqlite3.connect(path)
+
+    for pragma in pragmas:
+        conn.execute(pragma)
+
+    ensure_media(conn)
+
+    return conn
+
+def ensure_media(conn):
+    """
+    Create media if it is missing and give it a unique (song_name, artist_name,
+    year) key.
+
+    The year is part of the key because a song that charted in two years has
+    one row per year. The index still serves every lookup by song and artist
+    alone, since those are its leading columns.
+
+    Nothing is ever deleted here. If rows share a key (the old INSERT had no
+    key, so a re-run year was inserted twice) the key can not be built and
+    sqlite3.IntegrityError is raised: review and drop the extra rows with the
+    dedupe_media migration (python lyrical.py dedupe [--apply]) first.
+    """
+    conn.execute("CREATE TABLE IF NOT EXISTS media "
+                 "(song_name text, artist_name text, lyrics text, genre text, year text)")
+
+    has_key = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'media_key'").fetchone()
+
+    if has_key is None:
+        duplicates = duplicate_media(conn)
+        if duplicates:
+            raise sqlite3.IntegrityError("media has {} rows sharing a (song_name, artist_name, year) key with an "
+                                         "earlier row, so its unique key can not be built. Review them with "
+                                         "'python lyrical.py dedupe' and drop them with "
+                                         "'python lyrical.py dedupe --apply'".format(len(duplicates)))
+        with conn:
+            conn.execute("CREATE UNIQUE INDEX media_key ON media (song_name, artist_name, year)")
+
+    #pre-tokenized lyrics. the partial index holds exactly the rows that still
+    #need tokenizing, so finding them never scans media
+    add_column(conn,'media','tokens','blob')
+
+    #the genres as musixmatch returned them (see keep_raw_genres), written by
+    #every crawl so that filter_genres always classifies the latest ones
+    add_column(conn,'media','genre_raw','text')
+    conn.execute("CREATE TABLE IF NOT EXISTS vocab (word_id integer PRIMARY KEY, word text UNIQUE NOT NULL)")
+    conn.execute("CREATE INDEX IF NOT EXISTS media_untokenized ON media (tokens) WHERE tokens IS NULL")
+    ensure_media_version(conn)
+    conn.commit()
+
+def duplicate_media(conn):
+    """
+    The rows of media that repeat the (song_name, artist_name, year) of an 
+    earlier row (the first copy, lowest rowid, is the one kept).
+
+    Output:
+        -list of (rowid, song_name, artist_name, year, same) where same is 
+         True when the lyrics and genre are the same as the kept copy's
+    """
+    return [(rowid,song,artist,year,bool(same)) for rowid, song, artist, year, same in 
+            conn.execute("SELECT m.rowid, m.song_name, m.artist_name, m.year, "
+                         "m.lyrics IS k.lyrics AND m.genre IS k.genre "
+                         "FROM (SELECT MIN(rowid) AS keep, song_name, artist_name, year FROM media "
+                         "      WHERE song_name IS NOT NULL AND artist_name IS NOT NULL AND year IS NOT NULL "
+                         "      GROUP BY song_name, artist_name, year HAVING COUNT(*) > 1) d "
+                         "JOIN media m ON m.song_name = d.song_name AND m.artist_name = d.artist_name "
+                         "AND m.year = d.year AND m.rowid != d.keep "
+                         "JOIN media k ON k.rowid = d.keep ORDER BY m.rowid")]
+
+def dedupe_media(path='song_records.db',apply=False):
+    """
+    Migration for databases made before media had its key: find the rows that
+    repeat the key of an earlier row and, with apply=True, delete them and 
+    build the key. Opens the file directly, since open_db refuses a media 
+    table without its key.
+
+    Output:
+        -the rows that are (or, without apply, would be) dropped, see 
+         duplicate_media
+    """
+    conn = sqlite3.connect(path)
+    try:
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'media'").fetchone() is None:
+            return []
+
+        duplicates = duplicate_media(conn)
+
+        if apply:
+            with conn:
+                conn.executemany("DELETE FROM media WHERE rowid = ?",[(row[0],) for row in duplicates])
+                conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS media_key ON media (song_name, artist_name, year)")
+
+        return duplicates
+    finally:
+        conn.close()
+
+def ensure_media_version(conn):
+    """
+    Create media_version, a one row table of how many times media changed and
+    the content hash of media (stored by data_pipeline.media_fingerprint).
+    Triggers count every insert, update and delete on media and clear the 
+    hash, so a stored hash is always the hash of the current rows.
+    """
+    conn.execute("CREATE TABLE IF NOT EXISTS media_version (changes integer NOT NULL, hash text)")
+
+    if conn.execute("SELECT COUNT(*) FROM media_version").fetchone()[0] == 0:
+        conn.execute("INSERT INTO media_version (changes,hash) VALUES (0,NULL)")
+
+    for event in ['INSERT','UPDATE','DELETE']:
+        conn.execute("CREATE TRIGGER IF NOT EXISTS media_{}_version AFTER {} ON media BEGIN "
+                     "UPDATE media_version SET changes = changes + 1, hash = NULL; END".format(event.lower(),event))
+
+def add_column(conn,table,column,kind): #helper method
+    """
+    Add a column to a table unless it is already there.
+    """
+    columns = [row[1] for row in conn.execute("PRAGMA table_info({})".format(table))]
+
+    if column not in columns:
+        with conn:
+            conn.execute("ALTER TABLE {} ADD COLUMN {} {}".format(table,column,kind))
+
+def batches(rows,size=None): #helper method
+    """
+    Cut an iterable of rows into lists of at most size rows.
+    """
+    size  = size or batch_size
+    batch = []
+
+    for row in rows:
+        batch.append(row)
+        if len(batch) == size:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
+
+def write_batches(conn,statement,rows,size=None): #helper method
+    """
+    Run statement over rows with executemany, one transaction per batch.
+
+    Output:
+        -the amount of rows handed to the statement
+    """
+    written = 0
+
+    for batch in batches(rows,size):
+        with conn: #commits on success, rolls the batch back on error
+            conn.executemany(statement,batch)
+        written += len(batch)
+
+    return written
+
+def insert_songs(conn,rows,size=None):
+    """
+    Upsert songs into media. A song already in media (same song, artist and
+    year) keeps its row, and only the columns whose values changed are 
+    written: its lyrics are only overwritten by new non-null lyrics (and only
+    then left for tokenize_media again), and its genre only when the crawled
+    genre differs from the raw genre it was classified from (genre_raw), so a
+    label from filter_genres survives a re-crawl of the same song. A song
+    with nothing new is not written at all (no triggers fire).
+
+    Inputs:
+        -conn: connection made by open_db
+        -rows: iterable of (song_name, artist_name, lyrics, genre, year)
+
+    Output:
+        -the amount of rows handed to the upsert
+    """
+    return write_batches(conn,"INSERT INTO media (song_name,artist_name,lyrics,genre,year,genre_raw) "
+                              "VALUES (?1,?2,?3,?4,?5,?4) "
+                              "ON CONFLICT (song_name,artist_name,year) DO UPDATE SET "
+                              "lyrics = COALESCE(excluded.lyrics,lyrics), "
+                              "genre = CASE WHEN excluded.genre IS NOT COALESCE(genre_raw,genre) "
+                              "THEN COALESCE(excluded.genre,genre) ELSE genre END, "
+                              "genre_raw = COALESCE(excluded.genre,genre_raw), "
+                              "tokens = CASE WHEN excluded.lyrics IS NOT NULL AND excluded.lyrics IS NOT lyrics "
+                              "THEN NULL ELSE tokens END "
+                              "WHERE (excluded.lyrics IS NOT NULL AND excluded.lyrics IS NOT lyrics) "
+                              "OR (excluded.genre IS NOT NULL AND excluded.genre IS NOT genre_raw)",rows,size)
+
+def set_genres(conn,rows,size=None):
+    """
+    Set the genre of songs, matched on song and artist, as crawled (genre_raw
+    gets it too). Like insert_songs, a song whose raw genre is already this
+    one keeps its row (and its label from filter_genres).
+
+    Inputs:
+        -conn: connection made by open_db
+        -rows: iterable of (genre, song_name, artist_name)
+    """
+    return write_batches(conn,"UPDATE media SET genre = ?1, genre_raw = ?1 WHERE song_name = ?2 AND artist_name = ?3 "
+                              "AND genre_raw IS NOT ?1",rows,size)
+
+def relabel(conn,rows,size=None):
+    """
+    Set the genre of songs, matched on rowid. Songs that already have the
+    genre are not written.
+
+    Inputs:
+        -conn: connection made by open_db
+        -rows: iterable of (genre, rowid)
+    """
+    return write_batches(conn,"UPDATE media SET genre = ?1 WHERE rowid = ?2 AND genre IS NOT ?1",rows,size)
+
+def delete_songs(conn,rows,size=None):
+    """
+    Delete songs, matched on song and artist.
+
+    Inputs:
+        -conn: connection made by open_db
+        -rows: iterable of (song_name, artist_name)
+    """
+    return write_batches(conn,"DELETE FROM media WHERE song_name = ? AND artist_name = ?",rows,size)
+
+def keep_raw_genres(conn):
+    """
+    Give media a genre_raw column holding the genres musixmatch returned, so
+    that filter_genres can overwrite genre with a single label and still be
+    re-run later. Rows without a raw copy (from before insert_songs and
+    set_genres kept one) get their current genre; "" is filter_genres' label
+    of a song without genres, so there is nothing to keep for it.
+    """
+    add_column(conn,'media','genre_raw','text')
+
+    with conn:
+        conn.execute("UPDATE media SET genre_raw = genre WHERE genre_raw IS NULL AND genre IS NOT NULL AND genre != ''")
+
+###############################################################################
+############################## TOKEN STORAGE ##################################
+###############################################################################
+def encode_tokens(ids):
+    """
+    Pack a list of word ids into a media.tokens blob (uint32s).
+    """
+    return array('I',ids).tobytes()
+
+def decode_tokens(blob):
+    """
+    Unpack a media.tokens blob into an array of word ids.
+    """
+    ids = array('I')
+    ids.frombytes(blob)
+    return ids
+
+def load_vocab(conn):
+    """
+    The shared vocabulary.
+
+    Output:
+        -list of words, indexed by word id
+    """
+    return [row[0] for row in conn.execute("SELECT word FROM vocab ORDER BY word_id")]
+
+def tokenize_media(conn,size=None):
+    """
+    Tokenize the lyrics of every song that has no tokens yet (new rows, or
+    rows whose lyrics changed) and store the word ids in media.tokens, adding
+    unseen words to vocab. Tokens are the words of data_text.normalize_lyrics
+    (for lyrics cleaned by the crawler, the words of lyrics.split()), so the
+    analysis never splits lyrics itself.
+
+    Output:
+        -the amount of songs tokenized
+    """
+    size     = size or batch_size
+    word_ids = {word:i for i, word in enumerate(load_vocab(conn))}
+    done     = 0
+
+    while True:
+        rows = conn.execute("SELECT rowid, lyrics FROM media WHERE tokens IS NULL "
+                            "AND lyrics IS NOT NULL LIMIT ?",(size,)).fetchall()
+        if not rows:
+            break
+
+        first_new = len(word_ids)
+        updates   = []
+        for rowid, lyrics in rows:
+            ids = [word_ids.setdefault(word,len(word_ids)) for word in normalize_lyrics(lyrics)]
+            updates.append((encode_tokens(ids),rowid))
+
+        #new words are the last ones added to word_ids
+        new_words = [(i,word) for word, i in islice(reversed(word_ids.items()),len(word_ids)-first_new)]
+
+        with conn:
+            conn.executemany("INSERT INTO vocab (word_id,word) VALUES (?,?)",new_words)
+            conn.executemany("UPDATE media SET tokens = ? WHERE rowid = ?",updates)
+
+        done += len(rows)
+
+    return done
+
+def normalize_media(conn,size=None):
+    """
+    Migration for songs crawled before data_text.remove_chars: their lyrics
+    still hold the <lyric> tags as words (see data_text.strip_legacy_tags),
+    which newer crawls do not. Their lyrics are cleaned like a new crawl's 
+    and tokenized again, so every song shares one vocabulary.
+
+    Output:
+        -the amount of songs rewritten
+    """
+    rows = conn.execute("SELECT rowid, lyrics FROM media WHERE lyrics LIKE ?",
+                        ("{}%{}".format(legacy_open,legacy_close),)).fetchall()
+    rows = [(strip_legacy_tags(lyrics),rowid) for rowid, lyrics in rows if strip_legacy_tags(lyrics) != lyrics]
+
+    written = write_batches(conn,"UPDATE media SET lyrics = ?, tokens = NULL WHERE rowid = ?",rows,size)
+    tokenize_media(conn,size)
+
+    return written
+
+###############################################################################
+############################## CRAWL STATE ####################################
+###############################################################################
+def ensure_crawl_state(conn):
+    """
+    Create the crawl_state work queue. One row per (year, song, artist, stage)
+    where stage is 'chart' (song and artist are '' for it), 'lyrics' or 'genre'.
+
+    status is one of:
+        pending --> never tried
+        done    --> finished, result holds the lyrics/genre
+        failed  --> will not be tried again (the api has no answer)
+        retry   --> try again once retry_after (unix time) has passed
+
+    written is set on the lyrics item of a song once the song is in media.
+    """
+    conn.execute("CREATE TABLE IF NOT EXISTS crawl_state (year text, song_name text, artist_name text, "
+                 "stage text, status text DEFAULT 'pending', attempts integer DEFAULT 0, "
+                 "retry_after real, result text, rank text, written integer DEFAULT 0, "
+                 "PRIMARY KEY (year, song_name, artist_name, stage))")
+
+    #queues from before songs were marked once written to media (their 
+    #finished songs are written once more, which changes nothing)
+    add_column(conn,'crawl_state','written','integer DEFAULT 0')
+    conn.execute("CREATE INDEX IF NOT EXISTS crawl_state_status ON crawl_state (status, stage)")
+    conn.commit()
+
+def queue_items(conn,rows,size=None):
+    """
+    Add work to the queue. Items already queued keep their state.
+
+    Inputs:
+        -conn: connection made by open_db
+        -rows: iterable of (year, song_name, artist_name, stage, rank)
+    """
+    return write_batches(conn,"INSERT OR IGNORE INTO crawl_state (year,song_name,artist_name,stage,rank) "
+                              "VALUES (?,?,?,?,?)",rows,size)
+
+def due_items(conn,years,stage,now):
+    """
+    The work of a stage that still has to be done for the given years.
+
+    Output:
+        -list of (year, song_name, artist_name, attempts)
+    """
+    years = [str(year) for year in years]
+    marks = ",".join("?"*len(years))
+
+    return conn.execute("SELECT year, song_name, artist_name, attempts FROM crawl_state "
+                        "WHERE stage = ? AND year IN ({}) AND "
+                        "(status = 'pending' OR (status = 'retry' AND retry_after <= ?)) "
+                        "ORDER BY year, CAST(rank AS integer)".format(marks),
+                        [stage] + years + [now]).fetchall()
+
+def record_results(conn,rows,size=None):
+    """
+    Record the outcome of attempted work, counting the attempt.
+
+    Inputs:
+        -conn: connection made by open_db
+        -rows: iterable of (status, retry_after, result, year, song_name, artist_name, stage)
+    """
+    return write_batches(conn,"UPDATE crawl_state SET status = ?, retry_after = ?, result = ?, "
+                              "attempts = attempts + 1 "
+                              "WHERE year = ? AND song_name = ? AND artist_name = ? AND stage = ?",rows,size)
+
+def finished_songs(conn,years):
+    """
+    Songs whose lyrics and genre are both done and that are not written to 
+    media yet (see mark_written).
+
+    Output:
+        -list of (song_name, artist_name, lyrics, genre, year)
+    """
+    years = [str(year) for year in years]
+    marks = ",".join("?"*len(years))
+
+    return conn.execute("SELECT l.song_name, l.artist_name, l.result, g.result, l.year "
+                        "FROM crawl_state l JOIN crawl_state g "
+                        "ON g.year = l.year AND g.song_name = l.song_name AND g.artist_name = l.artist_name "
+                        "WHERE l.stage = 'lyrics' AND g.stage = 'genre' AND l.status = 'done' "
+                        "AND g.status = 'done' AND l.written = 0 AND l.year IN ({})".format(marks),years).fetchall()
+
+def mark_written(conn,rows,size=None):
+    """
+    Mark finished songs as written to media, so finished_songs leaves them out.
+
+    Inputs:
+        -conn: connection made by open_db
+        -rows: iterable of (song_name, artist_name, lyrics, genre, year), see
+               finished_songs
+    """
+    return write_batches(conn,"UPDATE crawl_state SET written = 1 "
+                              "WHERE year = ? AND song_name = ? AND artist_name = ? AND stage = 'lyrics'",
+                         ((row[4],row[0],row[1]) for row in rows),size)
+
+def crawl_progress(conn):
+    """
+    Count the queue by stage and status.
+
+    Output:
+        -dictionary of (stage, status) to count
+    """
+    return {(stage,status):n for stage, status, n in
+            conn.execute("SELECT stage, status, COUNT(*) FROM crawl_state GROUP BY stage, status")}
@@ -0,0 +1,429 @@
+# -*- coding: utf-8 -*-
+"""
+ * ------------------------------------------------------- *
+ |CS/STAT 287 FINAL PROJECT: STREAMING ANALYSIS FILE       |
+ |                                                         |
+ |This file runs the counting of data_analysis.py over     |
+ |media without ever holding the whole table in memory.    |
+ |                                                         |
+ |media is read in fetchmany chunks. Every chunk is folded |
+ |into a "partial": the word counts, syllable sums and     |
+ |song counts of every stratum seen so far. Word counts    |
+ |are kept as sorted (stratum*vocabulary + word id, count) |
+ |pairs, and once they outgrow the memory budget they are  |
+ |spilled to disk as a sorted run. The runs are merged one |
+ |stratum at a time at the end.                            |
+ |                                                         |
+ |Partials are mergeable (merge_partials), so pieces of    |
+ |media can also be counted separately and combined:       |
+ |parallel_media counts rowid ranges of media on a process |
+ |pool and merges the partials pairwise (a tree reduce).   |
+ * ------------------------------------------------------- *
+numpy citations
+   -->[https://numpy.org/doc/stable/reference/generated/numpy.unique.html]
+   -->[https://numpy.org/doc/stable/reference/generated/numpy.load.html]
+concurrent.futures citations
+   -->[https://docs.python.org/3/library/concurrent.futures.html#processpoolexecutor]
+"""
+
+from data_store import tokenize_media, load_vocab
+from data_corpus import CountTable, csr_matrix, decade_label, media_scan
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import tempfile
+import sqlite3
+import os
+
+
+#songs per fetchmany
+chunk_rows = 5000
+
+#bytes of in memory word counts before they are spilled to disk
+spill_bytes = 256*2**20
+
+#media_scan restricted to a range of rowids, for the shards of parallel_media
+shard_scan = ("SELECT tokens, genre, artist_name, year FROM media "
+              "WHERE tokens IS NOT NULL AND rowid >= ? AND rowid < ? ORDER BY rowid")
+
+
+def stream_chunks(conn,size=None,rowids=None):
+    """
+    Read media (the songs that have tokens) a chunk at a time.
+
+    Inputs:
+        -size: rows per chunk
+        -rowids: (first, one past the last) rowid to read, None => all of media
+
+    Output:
+        -generator of lists of (tokens, genre, artist_name, year) rows
+    """
+    size = size or chunk_rows
+    curs = conn.cursor()
+    curs.execute(media_scan) if rowids is None else curs.execute(shard_scan,rowids)
+
+    while True:
+        rows = curs.fetchmany(size)
+        if not rows:
+            break
+        yield rows
+
+def row_key(by,genre,artist,year): #helper method
+    """
+    The stratum of a media row. by is 'genre', 'artist', 'year', 'decade',
+    'calendar_decade' or a tuple of them (see data_corpus.corpus_strata).
+    """
+    if isinstance(by,tuple):
+        return tuple(row_key(dim,genre,artist,year) for dim in by)
+
+    if by == 'genre':
+        return genre or ""
+    if by == 'artist':
+        return artist or ""
+    if by == 'year':
+        return str(int(year))
+
+    return decade_label(int(year),by == 'calendar_decade')
+
+def new_partial(n_vocab,spill_dir=None,max_bytes=None,keep_songs=False):
+    """
+    An empty partial result.
+
+    Inputs:
+        -n_vocab: size of the vocabulary the word ids index
+        -spill_dir: where sorted runs go once the counts outgrow max_bytes
+                    (a temporary directory by default)
+        -max_bytes: the memory budget of the word counts
+        -keep_songs: also keep every song's syllabic average (one float per
+                     song), so that merging partials of consecutive pieces of
+                     media gives exactly the syllable sums of one serial pass
+
+    Output:
+        -dictionary with the stratum keys (their order gives their codes), the
+         merged word counts ('flat' keys and 'counts'), the chunks' pairs not
+         merged yet ('pending'), 'songs' and 'syl_sums' per
+         stratum, the spilled 'runs' and the kept 'song_avgs'
+    """
+    return {'n_vocab'  :n_vocab,
+            'keys'     :{},
+            'flat'     :np.zeros(0,dtype=np.int64),
+            'counts'   :np.zeros(0,dtype=np.int64),
+            'pending'  :[],
+            'pending_bytes':0,
+            'songs'    :[],
+            'syl_sums' :[],
+            'runs'     :[],
+            'song_avgs':[] if keep_songs else None,
+            'own_dir'  :spill_dir is None,
+            'spill_dir':spill_dir,
+            'max_bytes':max_bytes or spill_bytes}
+
+def add_counts(partial,flat,counts): #helper method
+    """
+    Add sorted (flat key, count) pairs to a partial. The pairs of every chunk
+    are only kept in a list until, together with the merged counts, they near
+    the budget: then they are merged with one sort (compact), and spilled to
+    a sorted run if the merged counts still take more than half the budget.
+    """
+    partial['pending'].append((flat,counts))
+    partial['pending_bytes'] += flat.nbytes + counts.nbytes
+
+    if partial['pending_bytes'] + partial['flat'].nbytes + partial['counts'].nbytes > partial['max_bytes']:
+        compact(partial)
+        if partial['flat'].nbytes + partial['counts'].nbytes > partial['max_bytes']//2:
+            spill(partial)
+
+def compact(partial): #helper method
+    """
+    Merge the pending pairs of a partial into its sorted in memory counts.
+    """
+    if not partial['pending']:
+        return
+
+    flat, inverse = np.unique(np.concatenate([partial['flat']] + [f for f, _ in partial['pending']]),
+                              return_inverse=True)
+    counts = np.bincount(inverse,weights=np.concatenate([partial['counts']] + [c for _, c in partial['pending']]),
+                         minlength=len(flat)).astype(np.int64)
+
+    partial['flat'], partial['counts'] = flat, counts
+    partial['pending'], partial['pending_bytes'] = [], 0
+
+def spill(partial):
+    """
+    Write the in memory counts of a partial to disk as a sorted run.
+    """
+    compact(partial)
+    if partial['spill_dir'] is None:
+        partial['spill_dir'] = tempfile.mkdtemp(prefix='lyrics_spill_')
+
+    #a unique name, partials may share a spill directory
+    handle, path = tempfile.mkstemp(prefix='run_',suffix='.npy',dir=partial['spill_dir'])
+    with os.fdopen(handle,'wb') as run_f:
+        np.save(run_f,np.stack([partial['flat'],partial['counts']]))
+
+    partial['runs'].append(path)
+    partial['flat']   = np.zeros(0,dtype=np.int64)
+    partial['counts'] = np.zeros(0,dtype=np.int64)
+
+def add_chunk(partial,rows,by,syls=None,weights=None):
+    """
+    Fold a chunk of media rows into a partial.
+
+    Inputs:
+        -partial made by new_partial
+        -rows: list of (tokens, genre, artist_name, year)
+        -by: the stratification (see row_key)
+        -syls, weights: syllables and weight of every word id (see
+                        data_analysis.vocab_syllables), None to skip syllables
+    """
+    n_vocab = partial['n_vocab']
+    keys    = partial['keys']
+
+    #the stratum code of every song, new strata get the next code
+    codes = np.array([keys.setdefault(row_key(by,*row[1:]),len(keys)) for row in rows],dtype=np.int64)
+    partial['songs'].extend([0]*(len(keys) - len(partial['songs'])))
+    partial['syl_sums'].extend([0.0]*(len(keys) - len(partial['syl_sums'])))
+
+    tokens  = np.frombuffer(b"".join(row[0] for row in rows),dtype=np.uint32).astype(np.int64)
+    lengths = np.array([len(row[0])//4 for row in rows],dtype=np.int64)
+
+    flat, counts = np.unique(np.repeat(codes,lengths)*n_vocab + tokens,return_counts=True)
+    add_counts(partial,flat,counts)
+
+    for code in codes.tolist():
+        partial['songs'][code] += 1
+
+    if syls is None:
+        return
+
+    #every song's average, added to its stratum in song order
+    starts = np.concatenate([[0],np.cumsum(lengths)[:-1]])
+    full   = lengths > 0
+    avgs   = np.full(len(rows),np.nan)
+    if full.any():
+        avgs[full] = (np.add.reduceat((syls*weights)[tokens],starts[full]) /
+                      np.add.reduceat(weights[tokens],starts[full]))
+
+    syl_sums = partial['syl_sums']
+    for code, avg in zip(codes.tolist(),avgs.tolist()):
+        syl_sums[code] += avg
+
+    if partial['song_avgs'] is not None:
+        partial['song_avgs'].append((codes,avgs))
+
+def merge_partials(a,b):
+    """
+    Merge partial b (counted on other songs, ex: a later chunk of media) into a.
+
+    The syllable sums of b are added to those of a as a whole, which can differ
+    from summing every song in order in the last bits. Partials made with
+    keep_songs=True carry their songs' averages along instead, and when b's
+    songs come after a's, finish_partial sums them exactly as a serial pass.
+
+    Output:
+        -a
+    """
+    n_vocab = a['n_vocab']
+
+    #b's codes in terms of a's keys
+    remap = np.array([a['keys'].setdefault(key,len(a['keys'])) for key in b['keys'].keys()],dtype=np.int64)
+    a['songs'].extend([0]*(len(a['keys']) - len(a['songs'])))
+    a['syl_sums'].extend([0.0]*(len(a['keys']) - len(a['syl_sums'])))
+
+    for code, new in enumerate(remap.tolist()):
+        a['songs'][new]    += b['songs'][code]
+        a['syl_sums'][new] += b['syl_sums'][code]
+
+    if a['song_avgs'] is not None and b['song_avgs'] is not None:
+        a['song_avgs'].extend((remap[codes],avgs) for codes, avgs in b['song_avgs'])
+    else:
+        a['song_avgs'] = None
+
+    compact(b)
+    for flat, counts in [(b['flat'],b['counts'])] + [tuple(np.load(run)) for run in b['runs']]:
+        if len(flat):
+            flat = remap[flat//n_vocab]*n_vocab + flat % n_vocab
+            order = np.argsort(flat)
+            add_counts(a,flat[order],counts[order])
+
+    drop_runs(b)
+
+    return a
+
+def drop_runs(partial): #helper method
+    """
+    Delete the spilled runs of a partial (and its spill directory if it made it).
+    """
+    for run in partial['runs']:
+        os.remove(run)
+
+    if partial['runs'] and partial['own_dir']:
+        os.rmdir(partial['spill_dir'])
+
+    partial['runs'] = []
+
+def finish_partial(partial,vocab):
+    """
+    Turn a partial into its results, merging the spilled runs one stratum at
+    a time (a stratum's counts are the most that is ever in memory besides
+    the result).
+
+    Output:
+        -data_corpus.CountTable of the strata (for data_analysis.yule_batch)
+        -dictionary of stratum to its songs' average syllabic average
+         (what data_analysis.count_syls returns)
+    """
+    compact(partial)
+    n_vocab = partial['n_vocab']
+    keys    = [key for key in partial['keys'].keys()]
+    runs    = [np.load(run,mmap_mode='r') for run in partial['runs']] + \
+              [np.stack([partial['flat'],partial['counts']])]
+
+    indptr  = [0]
+    indices = []
+    data    = []
+
+    for code in range(len(keys)):
+        lo, hi = code*n_vocab, (code + 1)*n_vocab
+        pieces = []
+        for run in runs:
+            start, stop = np.searchsorted(run[0],[lo,hi])
+            pieces.append(np.asarray(run[:,start:stop]))
+
+        stacked = np.concatenate(pieces,axis=1)
+        words, inverse = np.unique(stacked[0] - lo,return_inverse=True)
+        counts = np.bincount(inverse,weights=stacked[1],minlength=len(words)).astype(np.int64)
+
+        indices.append(words.astype(np.uint32))
+        data.append(counts)
+        indptr.append(indptr[-1] + len(words))
+
+    del runs, pieces, stacked
+    drop_runs(partial)
+
+    counts = csr_matrix(np.array(indptr,dtype=np.int64),
+                        np.concatenate(indices) if indices else np.zeros(0,dtype=np.uint32),
+                        np.concatenate(data) if data else np.zeros(0,dtype=np.int64),
+                        (len(keys),n_vocab))
+    syl_sums = partial['syl_sums']
+    if partial['song_avgs'] is not None: #re-add every song in order
+        syl_sums = [0.0]*len(keys)
+        for codes, avgs in partial['song_avgs']:
+            for code, avg in zip(codes.tolist(),avgs.tolist()):
+                syl_sums[code] += avg
+
+    syl_avgs = {key:syl_sums[code]/partial['songs'][code] for code, key in enumerate(keys)}
+
+    return CountTable(keys,counts,vocab), syl_avgs
+
+def stream_media(conn,by='genre',syls=None,weights=None,size=None,max_bytes=None,spill_dir=None):
+    """
+    Count media one chunk at a time.
+
+    Inputs:
+        -conn: connection made by data_store.open_db
+        -by: the stratification (see row_key)
+        -syls, weights: see add_chunk
+        -size: songs per chunk
+        -max_bytes: memory budget of the word counts before spilling
+        -spill_dir: where to spill (a temporary directory by default)
+
+    Output:
+        -see finish_partial
+    """
+    tokenize_media(conn) #every song with lyrics has its word ids
+    vocab   = load_vocab(conn)
+    partial = new_partial(len(vocab),spill_dir,max_bytes)
+
+    for rows in stream_chunks(conn,size):
+        add_chunk(partial,rows,by,syls,weights)
+
+    return finish_partial(partial,vocab)
+
+###############################################################################
+############################ PARALLEL COUNTING ################################
+###############################################################################
+def db_path(conn):
+    """
+    The file of the main database of a connection.
+    """
+    return conn.execute("PRAGMA database_list").fetchone()[2]
+
+def shard_rowids(conn,shards):
+    """
+    Cut the songs of media into shards of consecutive rowids with about the
+    same amount of songs each.
+
+    Output:
+        -list of (first, one past the last) rowid, in rowid order
+    """
+    rowids = np.array([r for (r,) in conn.execute("SELECT rowid FROM media WHERE tokens IS NOT NULL "
+                                                  "ORDER BY rowid")],dtype=np.int64)
+    if not len(rowids):
+        return []
+
+    bounds = rowids[np.linspace(0,len(rowids),min(shards,len(rowids)) + 1).astype(np.int64)[:-1]].tolist()
+
+    return list(zip(bounds,bounds[1:] + [int(rowids[-1]) + 1]))
+
+def count_shard(args):
+    """
+    Count one shard of media into a partial (run in the pool's workers, with
+    their own connection).
+
+    Input:
+        -(database file, rowid range, by, n_vocab, syls, weights, size, max_bytes, spill_dir)
+    """
+    path, rowids, by, n_vocab, syls, weights, size, max_bytes, spill_dir = args
+
+    conn    = sqlite3.connect(path)
+    partial = new_partial(n_vocab,spill_dir,max_bytes,keep_songs=True)
+
+    for rows in stream_chunks(conn,size,rowids):
+        add_chunk(partial,rows,by,syls,weights)
+
+    conn.close()
+
+    return partial
+
+def merge_pair(pair):
+    """
+    merge_partials for the pool: pair is (a, b) or (a,) for an odd one out.
+    """
+    return merge_partials(*pair) if len(pair) == 2 else pair[0]
+
+def parallel_media(conn,by='genre',syls=None,weights=None,workers=None,shards=None,
+                   size=None,max_bytes=None,spill_dir=None):
+    """
+    stream_media on a process pool. media is cut into shards of consecutive
+    rowids, every shard is counted in a worker, and the partials are merged
+    pairwise, neighbour with neighbour, until one is left. The results are
+    identical to stream_media's.
+
+    Inputs:
+        -workers: size of the pool (None => one per cpu)
+        -shards: amount of rowid ranges (None => 4 per worker)
+        -the rest: see stream_media
+
+    Output:
+        -see finish_partial
+    """
+    tokenize_media(conn) #the workers only read, every song must have its ids
+    conn.commit()
+
+    vocab   = load_vocab(conn)
+    workers = workers or os.cpu_count()
+    ranges  = shard_rowids(conn,shards or 4*workers)
+
+    if not ranges:
+        return finish_partial(new_partial(len(vocab)),vocab)
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        tasks = [(db_path(conn),rowids,by,len(vocab),syls,weights,size,max_bytes,spill_dir)
+                 for rowids in ranges]
+        parts = list(pool.map(count_shard,tasks))
+
+        #tree reduce: merge neighbours so the songs stay in rowid order
+        while len(parts) > 1:
+            parts = list(pool.map(merge_pair,[tuple(parts[i:i+2]) for i in range(0,len(parts),2)]))
+
+    return finish_partial(parts[0],vocab)
@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+"""
+ * ------------------------------------------------------- *
+ |CS/STAT 287 FINAL PROJECT: SYLLABLE TABLE FILE           |
+ |                                                         |
+ |This file compiles the CMU pronouncing dictionary into a |
+ |compact syllable table, once, so the analysis never has  |
+ |to load cmudict.dict() (hundreds of MB of Python lists)  |
+ |or recount stress digits on every lookup:                |
+ |                                                         |
+ |   cmu_words.npy  --> every word, sorted                 |
+ |   cmu_starts.npy --> where each word's counts start     |
+ |   cmu_counts.npy --> syllables of every pronunciation   |
+ |                      (uint8), word after word           |
+ |   cmu.json       --> the nltk cmudict file the table    |
+ |                      was built from (path, size, mtime) |
+ |                                                         |
+ |The table is memory mapped on first use. It is rebuilt   |
+ |automatically when the nltk cmudict file changes: its    |
+ |size and mtime are checked with os.stat, so nltk is only |
+ |imported to compile the table.                           |
+ |                                                         |
+ |syllable_vector scores a whole vocabulary at once: one   |
+ |binary search of the table for every word, and the       |
+ |syllables() estimate for the words cmudict does not have.|
+ * ------------------------------------------------------- *
+nltk resources:
+
+[http://www.nltk.org/genindex.html#S]
+[http://stackoverflow.com/questions/5876040/number-of-syllables-for-words-in-a-text]
+[http://stackoverflow.com/questions/14541303/count-the-number-of-syllables-in-a-word]
+"""
+
+import numpy as np
+import json
+import os
+
+
+#where the compiled table lives (next to http_cache, corpus and analysis_cache)
+table_dir = 'syllable_table'
+
+#the loaded table (see load_syllables)
+syllable_table = None
+
+
+def cmu_source():
+    """
+    Identify the nltk cmudict file: its path, size and modification time.
+    Any change to the file changes this.
+    """
+    from nltk.corpus import cmudict
+
+    path = str(cmudict.abspaths()[0])
+    info = os.stat(path)
+
+    return [path,info.st_size,info.st_mtime_ns]
+
+def compile_syllables(directory=None):
+    """
+    Build the syllable table from nltk's cmudict. This is the only place
+    cmudict.dict() is ever loaded.
+
+    Output:
+        -the amount of words in the table
+    """
+    from nltk.corpus import cmudict
+
+    directory = directory or table_dir
+    os.makedirs(directory,exist_ok=True)
+
+    source = cmu_source()
+    cmu    = cmudict.dict()
+    words  = sorted(cmu.keys())
+
+    #syllables of a pronunciation = its stressed phones (they end in a digit)
+    counts = [[len([p for p in pron if p[-1].isdigit()]) for pron in cmu[word]] for word in words]
+    starts = np.zeros(len(words) + 1,dtype=np.uint32)
+    np.cumsum([len(c) for c in counts],out=starts[1:])
+
+    arrays = {'cmu_words' :np.array(words,dtype=str),
+              'cmu_starts':starts,
+              'cmu_counts':np.array([n for c in counts for n in c],dtype=np.uint8)}
+
+    for name, array in arrays.items():
+        tmp = os.path.join(directory,name + '.tmp.npy')
+        np.save(tmp,array)
+        os.replace(tmp,os.path.join(directory,name + '.npy'))
+
+    #written last: the table only counts as built once this exists
+    with open(os.path.join(directory,'cmu.json'),'w') as meta_f:
+        json.dump({'source':source,'n_words':len(words)},meta_f)
+
+    return len(words)
+
+def load_syllables(directory=None):
+    """
+    The syllable table, memory mapped. Compiled first if it is missing or the
+    nltk cmudict file it was built from changed (see table_current). Loaded
+    once per process.
+
+    Output:
+        -dictionary of 'words', 'starts' and 'counts' arrays
+    """
+    global syllable_table
+
+    if syllable_table is not None:
+        return syllable_table
+
+    directory = directory or table_dir
+
+    if not table_current(directory):
+        compile_syllables(directory)
+
+    syllable_table = {name[len('cmu_'):]:np.load(os.path.join(directory,name + '.npy'),mmap_mode='r')
+                      for name in ['cmu_words','cmu_starts','cmu_counts']}
+
+    return syllable_table
+
+def table_current(directory): #helper method
+    """
+    Whether the table in directory is complete and the cmudict file it was 
+    built from still has the size and mtime stored in cmu.json (a stat of
+    the file, nltk is not imported).
+    """
+    meta_path = os.path.join(directory,'cmu.json')
+    if not os.path.exists(meta_path):
+        return False
+
+    with open(meta_path) as meta_f:
+        path, size, mtime = json.load(meta_f)['source']
+
+    try:
+        info = os.stat(path)
+    except OSError: #the cmudict file is gone
+        return False
+
+    return ([info.st_size,info.st_mtime_ns] == [size,mtime] and
+            all(os.path.exists(os.path.join(directory,name + '.npy')) 
+                for name in ['cmu_words','cmu_starts','cmu_counts']))
+
+def nsyl(word):
+    """
+    Pull from the Carnegie Melon University's pronunciation dictionary to get
+    syllable counts. Only works for 'real' words.
+
+    Output:
+        -list of the syllables of every pronunciation of word. Raises KeyError
+         for a word cmudict does not have.
+    """
+    table = load_syllables()
+    word  = word.lower()
+    words = table['words']
+
+    i = int(np.searchsorted(words,word))
+    if i == len(words) or words[i] != word:
+        raise KeyError(word)
+
+    return table['counts'][table['starts'][i]:table['starts'][i+1]].tolist()
+
+def lookup_syllables(words):
+    """
+    nsyl(word)[0] of many words at once.
+
+    Input:
+        -words: list of words
+
+    Output:
+        -int64 array of the syllables of every word's first pronunciation (0
+         where cmudict does not have the word), boolean array of the words it has
+    """
+    table  = load_syllables()
+    known  = table['words']
+    counts = np.zeros(len(words),dtype=np.int64)
+    found  = np.zeros(len(words),dtype=bool)
+
+    if not len(words) or not len(known):
+        return counts, found
+
+    #words of one length at a time, so no array is as wide as the longest
+    #word of the vocabulary (words longer than any cmudict word are not in it)
+    words   = [w.lower() for w in words]
+    lengths = np.array([len(w) for w in words],dtype=np.int64)
+    width   = known.dtype.itemsize//4
+
+    for length in np.unique(lengths).tolist():
+        if length > width:
+            break
+        where = np.flatnonzero(lengths == length)
+        group = np.array([words[i] for i in where.tolist()],dtype='<U{}'.format(max(length,1)))
+
+        at = np.searchsorted(known,group)
+        ok = (at < len(known)) & (known[np.minimum(at,len(known) - 1)] == group)
+
+        found[where[ok]]  = True
+        counts[where[ok]] = table['counts'][table['starts'][at[ok]]]
+
+    return counts, found
+
+def syllables(word):
+    """
+    Calculate syllables of a word using a less accurate algorithm.
+    Parse through the sentence, using common syllabic identifiers to count
+    syllables.
+    
+    ADAPTED FROM: 
+    [http://stackoverflow.com/questions/14541303/count-the-number-of-syllables-in-a-word]
+    """
+    #initialize count
+    count = 0
+    
+    #vowel list
+    vowels = 'aeiouy'
+    
+    #take out punctuation
+    word = word.lower().strip(".:;?!")
+    
+    #various signifiers of syllabic up or down count
+    if word[0] in vowels:
+        count +=1
+        
+    for index in range(1,len(word)):
+        if word[index] in vowels and word[index-1] not in vowels:
+            count +=1
+            
+    if word.endswith('e'):
+        count -= 1
+        
+    if word.endswith('le') or word.endswith('a'):
+        count+=1
+    
+    if count == 0:
+        count +=1
+    
+    if "ooo" in word or "mm" in word :
+        count = 1
+        
+    if word == 'll':
+        count = 0
+    
+    if (word.startswith('x') and len(word) >= 2) and word[1].isdigit():
+        count = 0
+    
+    if word == 'lmfao':
+        count = 5
+    
+    if len(word) < 2 and word not in ['a','i','y','o']:
+        count = 0
+        
+    return count
+
+def syllable_vector(vocab):
+    """
+    The syllables of every word of a vocabulary: the first cmudict 
+    pronunciation if there is one, otherwise the syllables() estimate.
+
+    Output:
+        -int64 array of syllables per word, boolean array of the words cmudict
+         has (the others are the words that needed the estimate)
+    """
+    syls, found = lookup_syllables(vocab)
+
+    for i in np.flatnonzero(~found).tolist():
+        syls[i] = syllables(vocab[i])
+
+    return syls, found
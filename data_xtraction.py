@@ -26,7 +26,7 @@ Created on Mon Nov 21 20:59:05 2016
   |    (1) Set up file by:                                          |
   |                                                                 |
   |         (a) making several imports                              |
-  |         (b) connect to database                                 |
+  |         (b) connect to database (on first use, see db)          |
   |                                                                 |
   |    (2) find_names(year)                                         |
   |                                                                 |
@@ -83,23 +83,89 @@ Created on Mon Nov 21 20:59:05 2016
 """
 
 # Set up file (1) #
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer, UnicodeDammit
 from urllib import request
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from io import BytesIO
+from data_cache import open_cache, cached_get, host_ttls, CachedResponse
+from data_text import remove_chars
+from data_store import open_db, insert_songs, set_genres, delete_songs, relabel, keep_raw_genres, tokenize_media
+from data_store import ensure_crawl_state, queue_items, due_items, record_results, finished_songs, mark_written
+from data_store import crawl_progress
+import numpy as np
+import json
+import os
+import functools
 import requests
+import asyncio
 import sqlite3
-from MUSIC_MATCH_ID import API_KEY
+import time
 
-#musixmatch api
-api = API_KEY.lstrip()
+try: #lxml streams the chart pages in C. without it, chart parsing strains with bs4
+    from lxml import etree
+except ImportError:
+    etree = None
 
+#base address of each service. swapped out for local mock servers when benchmarking
+hosts = {'jamrock'    : "http://www.jamrockentertainment.com",
+         'chartlyrics': "http://api.chartlyrics.com",
+         'musixmatch' : "http://api.musixmatch.com"}
 
-try: #connect to database
-    connect = sqlite3.connect("song_records.db")
-    curs    = connect.cursor()
-    print("Connection Successful")
+#per host crawl limits for the async crawler: requests in flight at once and
+#requests per second (None => no rate limit). keeps us under the api quotas.
+host_limits = {'jamrock'    : {'in_flight': 2, 'per_second': 2.0},
+               'chartlyrics': {'in_flight': 4, 'per_second': 10.0},
+               'musixmatch' : {'in_flight': 4, 'per_second': 10.0}}
 
-except:
-    print("Could not connect to sqlite3 db...")
+#chart pages only need their table cells. 'strainer' gives the same cells as
+#the original full tree parser; 'iterparse' (lxml) is faster but is opt-in,
+#see parse_chart
+td_strainer = SoupStrainer('td')
+chart_mode  = 'strainer'
+
+#resumable crawl: seconds before the first retry of a failed item (doubled on 
+#every attempt) and attempts before an item is given up on
+retry_wait   = 60
+max_attempts = 5
+
+#weight table of filter_genres
+genre_weights_path = os.path.join(os.path.dirname(os.path.abspath(__file__)),'genre_weights.json')
+
+#persistent response cache (see data_cache.py). None => always go to the network.
+#turned on with use_cache.
+http_cache = None
+
+#the database and the musixmatch api key, both loaded on first use (see db and 
+#api_key) so that importing this file does no work
+db_path = "song_records.db"
+connect = None
+api     = None
+
+
+def db():
+    """
+    The connection to the database (WAL mode, keyed media table), opened on 
+    first use.
+    """
+    global connect
+
+    if connect is None:
+        connect = open_db(db_path)
+
+    return connect
+
+def api_key():
+    """
+    The musixmatch api key, read from MUSIC_MATCH_ID.py on first use.
+    """
+    global api
+
+    if api is None:
+        from MUSIC_MATCH_ID import API_KEY
+        api = API_KEY.lstrip()
+
+    return api
 
     
 ###############################################################################
@@ -123,14 +189,35 @@ def find_names(year): # (2)
         -dictionary that will be converted later into rows of the database
     """
     
-    url_addr = "http://www.jamrockentertainment.com/billboard-music-top-100-songs-listed-by-year/top-100-songs-{}.html".format(year)
-    html_doc = get_html_doc(url_addr)
+    html_doc = get_html_doc(chart_url(year))
     
-    #get parser
-    soup = BeautifulSoup(html_doc,'html.parser')
+    return parse_chart(html_doc,year)
+
+def parse_chart(html_doc,year,mode=None):
+    """
+    Parse a jamrock chart page into the grouped_dict described in find_names.
     
+    Input:
+        -html_doc: the html of a chart page
+        -year the chart page belongs to
+        -mode: how the table cells are pulled out of the page (None => chart_mode,
+               set data_xtraction.chart_mode = 'iterparse' to opt in everywhere)
+            'soup'      ----> full BeautifulSoup tree of the page (the original parser)
+            'strainer'  ----> BeautifulSoup that only builds the <td> tags (default,
+                              same cells as 'soup')
+            'iterparse' ----> lxml streaming over the <td> tags (needs lxml, opt-in).
+                              lxml repairs broken markup its own way: unclosed
+                              <td>s become separate cells instead of nesting, and 
+                              a cell holding a nested table comes after the inner
+                              cells and loses their text. Songs are found by cell
+                              position, so only use it on well formed chart pages
+                              (benchmark_chart_parsing checks a set of pages)
+    
+    Output:
+        -dictionary that will be converted later into rows of the database
+    """
     #parse through contents, find top 100 songs, artists of that year
-    relevant_info = [tag.get_text() for tag in soup.find_all('td')]
+    relevant_info = chart_cells(html_doc,mode)
     hold_list = []
     
     #build a dictionary that maps the string SONG>ARTIST
@@ -146,6 +233,116 @@ def find_names(year): # (2)
     
     return grouped_dict
 
+def chart_cells(html_doc,mode=None):
+    """
+    The text of every table cell of a chart page, in page order. See 
+    parse_chart for the modes: 'soup' and 'strainer' give the same cells,
+    'iterparse' only does on well formed pages.
+    """
+    mode = mode or chart_mode
+    
+    if mode == 'iterparse':
+        #same encoding detection as BeautifulSoup, then hand lxml utf-8
+        if not isinstance(html_doc,str):
+            html_doc = UnicodeDammit(html_doc,is_html=True).unicode_markup
+        
+        relevant_info = []
+        for event, tag in etree.iterparse(BytesIO(html_doc.encode('utf-8')),events=('end',),
+                                          tag='td',html=True,encoding='utf-8'):
+            relevant_info.append("".join(tag.itertext()))
+            tag.clear(keep_tail=True) #nothing else of the page is kept around
+        
+        return relevant_info
+    
+    if mode == 'strainer':
+        soup = BeautifulSoup(html_doc,'html.parser',parse_only=td_strainer)
+    else:
+        soup = BeautifulSoup(html_doc,'html.parser')
+    
+    return [tag.get_text() for tag in soup.find_all('td')]
+
+def parse_chart_page(year_page): #helper method
+    """
+    parse_chart for process pools, which hand over one argument.
+    """
+    return parse_chart(year_page[1],year_page[0])
+
+def parse_charts(pages,processes=None):
+    """
+    Parse many chart pages at once on a process pool.
+    
+    Inputs:
+        -pages: dictionary of year to the html of that year's chart page
+        -processes: size of the pool (None => one per cpu)
+    
+    Output:
+        -dictionary of year to grouped_dict
+    """
+    years = [year for year in pages.keys()]
+    
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        dicts = pool.map(parse_chart_page,[(year,pages[year]) for year in years],
+                         chunksize=max(1,len(years)//(4*(processes or os.cpu_count()))))
+        
+        return {year:dict_year for year, dict_year in zip(years,dicts)}
+
+def load_chart_pages(directory):
+    """
+    Load saved chart pages (the top-100-songs-YEAR.html files of jamrock) from
+    a directory.
+    
+    Output:
+        -dictionary of year to page html
+    """
+    pages = {}
+    for name in sorted(os.listdir(directory)):
+        if name.startswith('top-100-songs-') and name.endswith('.html'):
+            with open(os.path.join(directory,name),'rb') as f:
+                pages[int(name[len('top-100-songs-'):-len('.html')])] = f.read()
+    
+    return pages
+
+def benchmark_chart_parsing(pages,repeat=3,processes=None):
+    """
+    Time every chart parsing mode over saved pages (see load_chart_pages), 
+    check that they all agree with the original full tree parser, and time
+    parse_charts on a process pool.
+    
+    Inputs:
+        -pages: dictionary of year to page html
+        -repeat: passes over the pages per mode, the best one is kept
+        -processes: size of the pool for parse_charts
+    
+    Output:
+        -dictionary of mode to pages per second
+    """
+    modes = ['soup','strainer'] + (['iterparse'] if etree is not None else [])
+    reference = {year:parse_chart(pages[year],year,'soup') for year in pages.keys()}
+    rates = {}
+    
+    for mode in modes:
+        best = float('inf')
+        for _ in range(repeat):
+            start = time.perf_counter()
+            parsed = {year:parse_chart(pages[year],year,mode) for year in pages.keys()}
+            best = min(best,time.perf_counter() - start)
+        
+        if parsed != reference:
+            print("{} does not agree with the full parser!".format(mode))
+        
+        rates[mode] = len(pages)/best
+        print("{:>10}: {:8.1f} pages/s".format(mode,rates[mode]))
+    
+    start = time.perf_counter()
+    pooled = parse_charts(pages,processes)
+    rates['pool'] = len(pages)/(time.perf_counter() - start)
+    print("{:>10}: {:8.1f} pages/s ({} mode)".format('pool',rates['pool'],chart_mode))
+    
+    if pooled != reference:
+        print("the pool does not agree with the full parser!")
+    
+    return rates
+
 def find_lyrics(song,artist,grouped_dict): # (3)
     """
     Find the lyrics of a given song (through musixmatch API) and update the 
@@ -160,28 +357,30 @@ def find_lyrics(song,artist,grouped_dict): # (3)
         -1 if successful lyrics scrape, 0 if unsuccessful
     """    
     
-    #modify song,artist to fit api
-    ref_song, ref_artist = form_to_mm_api(song),form_to_mm_api(artist)
-     
-    #set up request
-    cmnd = "http://api.chartlyrics.com/apiv1.asmx/SearchLyricDirect?artist={}&song={}".format(ref_artist,ref_song)
-    r    = requests.get(cmnd)
-     
+    r = http_get(lyrics_url(song,artist))
+    
+    return store_lyrics(song,artist,grouped_dict,r)
+
+def store_lyrics(song,artist,grouped_dict,r):
+    """
+    Sanitize the lyrics out of a chartlyrics response and add them to the 
+    dictionary containing that song. Shared by find_lyrics and find_lyrics_async.
     
-    if r.status_code == 200: # => successful connection
+    Inputs:
+        -song name
+        -artist name
+        -dictionary in which that song,artist meta data is contained
+        -r: the response (None if the request never got an answer)
+    
+    Output:
+        -1 if successful lyrics scrape, 0 if unsuccessful
+    """
+    if r is not None and r.status_code == 200: # => successful connection
     
         print('Successful connection for {} by {}'.format(song,artist))
         
-        #make a beautiful soup
-        html_doc = r.content
-        soup     = BeautifulSoup(html_doc,'html.parser')
-        
-        #extract and sanitize lyrics
-        lyrics   = soup.find_all('lyric')
-        lyrics   = remove_chars(str(lyrics),'lyrics')
-         
         #add appropriately to dictionary
-        grouped_dict['{}>{}'.format(song,artist)]['lyrics'] = lyrics
+        grouped_dict['{}>{}'.format(song,artist)]['lyrics'] = parse_lyrics(r.content)
         
         return 1 # ==> successful scrape
          
@@ -191,8 +390,20 @@ def find_lyrics(song,artist,grouped_dict): # (3)
         #delete that entry (impute the row)
         
         del grouped_dict['{}>{}'.format(song,artist)]
-        return 1 # ==> unsuccessful scrape
+        return 0 # ==> unsuccessful scrape
          
+def parse_lyrics(html_doc):
+    """
+    Extract and sanitize the lyrics of a chartlyrics answer.
+    """
+    #make a beautiful soup
+    soup   = BeautifulSoup(html_doc,'html.parser')
+    
+    #extract and sanitize lyrics
+    lyrics = soup.find_all('lyric')
+    
+    return remove_chars(str(lyrics),'lyrics')
+
 def find_genre(song,artist,grouped_dict): # (4)
     """
     Find the genre of a given song by accessing the musixmatch API. 
@@ -208,30 +419,31 @@ def find_genre(song,artist,grouped_dict): # (4)
         -1 if successful lyrics scrape, 0 if unsuccessful
         
     """
-    #edit song,artist strings to get ready for the api request
-    ref_song, ref_artist = form_to_mm_api(song),form_to_mm_api(artist)
-    base_cmd = "http://api.musixmatch.com/ws/1.1/"
-    
     #request
-    r = requests.get('{}track.search?apikey={}&q_track={}&q_artist={}&f_has_lyrics=1'.format(
-        base_cmd,api,ref_song,ref_artist))
+    r = http_get(genre_url(song,artist))
+    
+    return store_genre(song,artist,grouped_dict,r)
 
+def store_genre(song,artist,grouped_dict,r):
+    """
+    Pull the primary genres out of a musixmatch response and add them to the
+    dictionary containing that song. Shared by find_genre and find_genre_async.
     
-    if (r.status_code == 200): #==>successful connection
+    Inputs:
+        -song name
+        -artist name
+        -dictionary in which that song,artist meta data is contained
+        -r: the response (None if the request never got an answer)
+        
+    Outputs:
+        -1 if successful genre scrape, 0 if unsuccessful
+    """
+    if r is not None and r.status_code == 200: #==>successful connection
         
         try: # try this routine because sometimes the returned json is corrupted
             
-            #get primary genre list
-            pr_genre_list = r.json()['message']['body']['track_list'][0]['track']['primary_genres']['music_genre_list']
-            
-            #filter to genre names
-            genres = [pr_genre_list[i]['music_genre']['music_genre_name'] for i in range(0,len(pr_genre_list))]
-            
-            #join as string
-            genres = ",".join(genres)
-            
             #write whole string to dictionary
-            grouped_dict['{}>{}'.format(song,artist)]['genre'] = genres
+            grouped_dict['{}>{}'.format(song,artist)]['genre'] = parse_genre(r.content)
             
             print("Successful connection for {} by {}".format(song,artist))
             
@@ -245,6 +457,20 @@ def find_genre(song,artist,grouped_dict): # (4)
         print("Unsuccessful connection for {} by {}".format(song,artist))
         return 0 # ==> unsuccessful genre scrape
 
+def parse_genre(json_doc):
+    """
+    Extract the primary genres of a musixmatch answer as a comma separated 
+    string. Raises if the json is corrupted or has no track.
+    """
+    #get primary genre list
+    pr_genre_list = json.loads(json_doc)['message']['body']['track_list'][0]['track']['primary_genres']['music_genre_list']
+    
+    #filter to genre names
+    genres = [pr_genre_list[i]['music_genre']['music_genre_name'] for i in range(0,len(pr_genre_list))]
+    
+    #join as string
+    return ",".join(genres)
+
 ###############################################################################
 ########################## DB ACCESS FUNCTIONS ################################
 ###############################################################################
@@ -262,16 +488,14 @@ def write_dict_to_DB(dict_year): # (5)
         None
     
     """
-    keys = [key for key in dict_year.keys()] #organize names into indexed structure
-    for key in keys:
+    rows = []
+    for key in dict_year.keys():
         key_spl = key.split(">") #crack key open
-        
-        #write to sqlite3 database
-        curs.execute("INSERT INTO media (artist_name,song_name,lyrics,year) VALUES (?,?,?,?)",
-        (key_spl[1],key_spl[0],dict_year[key]['lyrics'],str(dict_year[key]['year'])))
-        
-        #make it real
-        connect.commit()
+        rows.append((key_spl[0],key_spl[1],dict_year[key]['lyrics'],None,str(dict_year[key]['year'])))
+    
+    #write to sqlite3 database, one transaction per batch
+    insert_songs(db(),rows)
+    tokenize_media(db())
 
 def write_genre_to_DB(dict_year): # (5)
     """
@@ -281,19 +505,42 @@ def write_genre_to_DB(dict_year): # (5)
     
     """
     
-    keys = [key for key in dict_year.keys()] #indexed structure
-    for key in keys:
+    updates = []
+    deletes = []
+    for key in dict_year.keys():
         k_spl = key.split(">") #crack key open
         
         if dict_year[key]['genre'] != None: #make sure genre was successfully grabbed
-            curs.execute("UPDATE media SET genre = ? WHERE song_name = ? AND artist_name = ?",
-                         (dict_year[key]['genre'],k_spl[0],k_spl[1]))
+            updates.append((dict_year[key]['genre'],k_spl[0],k_spl[1]))
         
         else: #otherwise impute entire row
-            curs.execute("DELETE FROM media WHERE song_name = ? AND artist_name = ?",
-                         (k_spl[0],k_spl[1]))
-                         
-        connect.commit() #make it real
+            deletes.append((k_spl[0],k_spl[1]))
+    
+    #make it real, in bulk
+    set_genres(db(),updates)
+    delete_songs(db(),deletes)
+        
+def write_year_to_DB(dict_year): # (5)
+    """
+    Write complete rows (lyrics and genre) for a given year to the database in
+    one go. Used by the single pass crawl, which never has to go back and 
+    UPDATE or DELETE what it wrote.
+    
+    Input:
+        dict_year: the dictionary of song meta data for a given year, every
+                   entry holding both its lyrics and its genre.
+    
+    Output:
+        None
+    """
+    rows = []
+    for key in dict_year.keys():
+        key_spl = key.split(">") #crack key open
+        rows.append((key_spl[0],key_spl[1],dict_year[key]['lyrics'],
+                     dict_year[key]['genre'],str(dict_year[key]['year'])))
+    
+    insert_songs(db(),rows) #make it real
+    tokenize_media(db())
         
 ###############################################################################
 ############################ HELPER FUNCTIONS #################################
@@ -317,38 +564,31 @@ def form_to_mm_api(string): #helper method
         
     return string #send it away
 
-def remove_chars(string,choice): #helper method
+def chart_url(year): #helper method
+    """
+    Build the jamrock chart page address for a given year.
+    """
+    return "{}/billboard-music-top-100-songs-listed-by-year/top-100-songs-{}.html".format(
+        hosts['jamrock'],year)
+
+def lyrics_url(song,artist): #helper method
+    """
+    Build the chartlyrics SearchLyricDirect request for a song and artist.
     """
-    Remove irrelevant characters from a string specified by exclude set for
-    either a lyrics string or title string. 
+    ref_song, ref_artist = form_to_mm_api(song),form_to_mm_api(artist)
     
-    Inputs:
-        -string: Either a titlestring (song,artist) or lyrics string
-        -choice: either 'lyrics' or 'title'
+    return "{}/apiv1.asmx/SearchLyricDirect?artist={}&song={}".format(
+        hosts['chartlyrics'],ref_artist,ref_song)
+
+def genre_url(song,artist): #helper method
+    """
+    Build the musixmatch track.search request for a song and artist.
+    """
+    ref_song, ref_artist = form_to_mm_api(song),form_to_mm_api(artist)
     
-    Output:
-        -lowercase, charless string
-    Ex:
-    remove_chars("Hello, World",['e','title') returns "Hllo World"
-    """
-    exclude = ['!', '"', '#', '$', '%', '&',   #exclude set
-               "'", '(', ')', '*', '+', ',', 
-               '-', '.', '/', ':', ';', '<',
-               '=', '>', '?', '@', '[', '\\', 
-               ']', '^', '_', '`', '{', '|', 
-               '}', '~',"'", '\n', '\r',
-               '<lyric>','</lyric>']
-               
-    for ch in exclude: #iterate over exclude set, remove remove and
-                       # replace accordingly
-        if ch in string and choice == 'lyrics':
-            string = string.replace(ch," ")
-            
-        if ch in string and choice == 'title':
-            string = string.replace(ch,"")
-            
-    return string.lower() #return charless string
-        
+    return "{}/ws/1.1/track.search?apikey={}&q_track={}&q_artist={}&f_has_lyrics=1".format(
+        hosts['musixmatch'],api_key(),ref_song,ref_artist)
+
 def get_html_doc(url_addr): #helper method
     """
     Prepare an html document to be parsed into soup.
@@ -357,12 +597,52 @@ def get_html_doc(url_addr): #helper method
         -url_addr : the string containing a url address
     
     Output:
-        -The html document of the site accessed.
+        -The html document of the site accessed (empty if the page is not
+         cached while the cache is offline).
+    
+    """
+    r = http_get(url_addr,urlopen_get) #open url, or replay it
     
+    if r.status_code != 200:
+        print("No cached copy of {}".format(url_addr))
+    
+    return r.content #return it
+
+def urlopen_get(url_addr): #helper method
+    """
+    Fetch a url with urllib in the shape http_get expects. Like urlopen, this
+    raises on anything other than a successful answer.
     """
     url = request.urlopen(url_addr) #open url
-    html_doc = url.read() #grab doc
-    return html_doc #return it
+    return CachedResponse(url.status,url.read()) #grab doc
+
+def http_get(url_addr,get=requests.get): #helper method
+    """
+    GET a url through the response cache, if one is in use.
+    
+    Input:
+        -url_addr : the string containing a url address
+        -get : the function that actually goes to the network
+    
+    Output:
+        -the response (.status_code and .content)
+    """
+    if http_cache is None:
+        return get(url_addr)
+    
+    return cached_get(http_cache,url_addr,get)
+
+def use_cache(cache_dir='http_cache',max_bytes=512*2**20,ttl=host_ttls,offline=False):
+    """
+    Send every request of this file through a persistent response cache.
+    With offline=True nothing goes to the network, so rebuilding the database
+    or re-tuning remove_chars/filter_genres makes no API calls.
+    
+    Inputs:
+        see data_cache.open_cache
+    """
+    global http_cache
+    http_cache = open_cache(cache_dir,max_bytes,ttl,offline)
 
 def get_top_lyrics(year): #batch method
     """
@@ -424,7 +704,447 @@ def get_top_genres(year): #batch method
      print("Scraped genres of {}/100 songs for the year {}".format(successful_scrapes,year))
      
      return dict_year #send away to be written to database
-def filter_genres():
+
+###############################################################################
+############################ ASYNC CRAWL FUNCTIONS ############################
+###############################################################################
+def open_crawler(limits=host_limits):
+    """
+    Set up the shared state of the async crawler: one keep-alive requests.Session
+    per host (its connection pool sized to that host's in flight limit) and a
+    thread pool for the blocking requests to run on.
+    
+    Input:
+        -limits: dictionary of service to {'in_flight': int, 'per_second': float or None}
+    
+    Output:
+        -crawler dictionary to hand to the *_async functions
+    """
+    crawler = {'limits'  : limits,
+               'sessions': {},
+               'gates'   : {},
+               'pool'    : ThreadPoolExecutor(max_workers=sum(l['in_flight'] for l in limits.values()))}
+    
+    for service in limits.keys():
+        #one pool per host, so connections are reused across requests
+        adapter = HTTPAdapter(pool_connections=1,pool_maxsize=limits[service]['in_flight'])
+        session = requests.Session()
+        session.mount('http://',adapter)
+        session.mount('https://',adapter)
+        crawler['sessions'][service] = session
+    
+    return crawler
+
+def close_crawler(crawler):
+    """
+    Close every session and the thread pool of a crawler.
+    """
+    for session in crawler['sessions'].values():
+        session.close()
+    
+    crawler['pool'].shutdown()
+
+def open_gates(crawler):
+    """
+    Make the per host semaphores and rate limit clocks. Must be called inside 
+    the running event loop, once per asyncio.run.
+    """
+    for service, limit in crawler['limits'].items():
+        per_second = limit['per_second']
+        crawler['gates'][service] = {'sem'     : asyncio.Semaphore(limit['in_flight']),
+                                     'lock'    : asyncio.Lock(),
+                                     'interval': 1.0/per_second if per_second else 0.0,
+                                     'next'    : 0.0}
+
+async def fetch_async(crawler,service,url):
+    """
+    GET a url through the gate of its service: wait for a free in flight slot,
+    wait for the service's rate limit, then run the request on the thread pool.
+    
+    Inputs:
+        -crawler made by open_crawler (with open_gates called)
+        -service: 'jamrock', 'chartlyrics' or 'musixmatch'
+        -url to request
+    
+    Output:
+        -the requests.Response, or None if the request itself failed
+    """
+    gate = crawler['gates'][service]
+    
+    async with gate['sem']:
+        
+        #space requests out by the service's interval
+        async with gate['lock']:
+            now  = time.monotonic()
+            wait = gate['next'] - now
+            gate['next'] = max(now,gate['next']) + gate['interval']
+            
+        if wait > 0:
+            await asyncio.sleep(wait)
+        
+        loop = asyncio.get_running_loop()
+        get  = functools.partial(http_get,url,functools.partial(crawler['sessions'][service].get,timeout=30))
+        
+        try:
+            return await loop.run_in_executor(crawler['pool'],get)
+        except requests.RequestException:
+            return None
+
+async def find_names_async(year,crawler):
+    """
+    Async version of find_names. Returns an empty dictionary if the chart page
+    could not be fetched.
+    """
+    r = await fetch_async(crawler,'jamrock',chart_url(year))
+    
+    if r is None or r.status_code != 200:
+        print("Could not fetch the chart for {}".format(year))
+        return {}
+    
+    return parse_chart(r.content,year)
+
+async def find_lyrics_async(song,artist,grouped_dict,crawler):
+    """
+    Async version of find_lyrics.
+    """
+    r = await fetch_async(crawler,'chartlyrics',lyrics_url(song,artist))
+    
+    return store_lyrics(song,artist,grouped_dict,r)
+
+async def find_genre_async(song,artist,grouped_dict,crawler):
+    """
+    Async version of find_genre.
+    """
+    r = await fetch_async(crawler,'musixmatch',genre_url(song,artist))
+    
+    return store_genre(song,artist,grouped_dict,r)
+
+async def get_top_lyrics_async(year,crawler):
+    """
+    Async version of get_top_lyrics: every song of the year is looked up at 
+    once and the gates of the crawler decide how many actually run.
+    """
+    dict_year = await find_names_async(year,crawler)
+    keys = [key.split(">") for key in dict_year.keys()] #crack the keys open
+    
+    scrapes = await asyncio.gather(*[find_lyrics_async(key[0],key[1],dict_year,crawler)
+                                     for key in keys])
+    
+    print("Scraped lyrics of {}/{} songs for the year {}".format(sum(scrapes),len(keys),year))
+    
+    return dict_year
+
+async def get_top_genres_async(year,crawler):
+    """
+    Async version of get_top_genres.
+    """
+    dict_year = await find_names_async(year,crawler)
+    keys = [key.split(">") for key in dict_year.keys()] #crack the keys open
+    
+    scrapes = await asyncio.gather(*[find_genre_async(key[0],key[1],dict_year,crawler)
+                                     for key in keys])
+    
+    print("Scraped genres of {}/{} songs for the year {}".format(sum(scrapes),len(keys),year))
+    
+    return dict_year
+
+async def resolve_song_async(song,artist,dict_year,crawler):
+    """
+    Look up the lyrics and the genre of one song at the same time and add both
+    to dict_year. A song whose lyrics could not be found is removed from 
+    dict_year by store_lyrics, so the genre is stored first.
+    
+    Output:
+        -(1 or 0 for the lyrics, 1 or 0 for the genre)
+    """
+    lyrics_r, genre_r = await asyncio.gather(fetch_async(crawler,'chartlyrics',lyrics_url(song,artist)),
+                                             fetch_async(crawler,'musixmatch',genre_url(song,artist)))
+    
+    genre_scrape  = store_genre(song,artist,dict_year,genre_r)
+    lyrics_scrape = store_lyrics(song,artist,dict_year,lyrics_r)
+    
+    return lyrics_scrape, genre_scrape
+
+async def get_top_songs_async(year,crawler): #batch method
+    """
+    Get the lyrics and genres for the top 100 of a given year in one pass: the
+    chart is fetched and parsed once and every song goes to chartlyrics and
+    musixmatch at the same time. 
+    
+    Songs missing either their lyrics or their genre are dropped here, they 
+    would have been deleted by write_genre_to_DB anyway.
+    
+    Input:
+        -year in question
+        -crawler made by open_crawler
+    
+    Output:
+        -A dictionary of complete song metadata, ready for write_year_to_DB
+    """
+    dict_year = await find_names_async(year,crawler)
+    keys = [key.split(">") for key in dict_year.keys()] #crack the keys open
+    
+    scrapes = await asyncio.gather(*[resolve_song_async(key[0],key[1],dict_year,crawler)
+                                     for key in keys])
+    
+    print("Scraped lyrics of {}/{} and genres of {}/{} songs for the year {}".format(
+        sum(s[0] for s in scrapes),len(keys),sum(s[1] for s in scrapes),len(keys),year))
+    
+    #impute the rows without a genre
+    for key in [key for key in dict_year.keys() if dict_year[key]['genre'] is None]:
+        del dict_year[key]
+    
+    return dict_year
+
+async def crawl_years_async(years,crawler):
+    """
+    Run get_top_songs_async over many years at once.
+    
+    Output:
+        -list of dict_years, in year order
+    """
+    open_gates(crawler)
+    
+    return await asyncio.gather(*[get_top_songs_async(year,crawler) for year in years])
+
+def crawl_async(years,limits=host_limits,write=True): #batch method
+    """
+    Crawl the lyrics and genres of every year concurrently, one pass per year
+    (see get_top_songs_async), and (optionally) write each finished row to 
+    the database once with write_year_to_DB.
+    
+    Inputs:
+        -years: iterable of years to crawl
+        -limits: per host limits (see host_limits)
+        -write: whether to write the results to the database
+    
+    Output:
+        -list of dict_years, in year order
+    """
+    crawler = open_crawler(limits)
+    
+    try:
+        dict_years = asyncio.run(crawl_years_async(list(years),crawler))
+    finally:
+        close_crawler(crawler)
+    
+    if write:
+        for dict_year in dict_years:
+            write_year_to_DB(dict_year)
+    
+    return dict_years
+
+###############################################################################
+########################## RESUMABLE CRAWL FUNCTIONS ##########################
+###############################################################################
+def attempt_outcome(r,parse):
+    """
+    Decide what one attempt at a piece of crawl work amounts to.
+    
+    Inputs:
+        -r: the response (None if the request never got an answer)
+        -parse: function turning a successful answer's content into its result
+    
+    Output:
+        -(status, result): ('done', result), ('failed', None) when the api has 
+         no answer for it, or ('retry', None) when the failure looks transient
+         (no answer, rate limited, server error, offline cache miss)
+    """
+    if r is None or r.status_code == 429 or r.status_code >= 500:
+        return 'retry', None
+    
+    if r.status_code != 200:
+        return 'failed', None
+    
+    try: #corrupted json, no track, ...
+        return 'done', parse(r.content)
+    except:
+        return 'failed', None
+
+def retry_schedule(status,attempts): #helper method
+    """
+    Turn a 'retry' into a retry_after time (doubling the wait on every attempt)
+    or into 'failed' once the item has used up max_attempts.
+    
+    Output:
+        -(status, retry_after)
+    """
+    if status != 'retry':
+        return status, None
+    
+    if attempts + 1 >= max_attempts:
+        return 'failed', None
+    
+    return 'retry', time.time() + retry_wait*2**attempts
+
+async def queue_chart_async(year,attempts,crawler):
+    """
+    Fetch the chart of a year and queue the lyrics and genre work of every 
+    song on it.
+    
+    Output:
+        -the crawl_state result row of the chart item
+    """
+    r = await fetch_async(crawler,'jamrock',chart_url(year))
+    status, dict_year = attempt_outcome(r,lambda html_doc: parse_chart(html_doc,year))
+    
+    result = None
+    if status == 'done':
+        items = []
+        for key in dict_year.keys():
+            key_spl = key.split(">") #crack key open
+            for stage in ['lyrics','genre']:
+                items.append((str(year),key_spl[0],key_spl[1],stage,dict_year[key]['rank']))
+        
+        queue_items(db(),items)
+        result = str(len(dict_year))
+    
+    status, retry_after = retry_schedule(status,attempts)
+    
+    return (status,retry_after,result,str(year),'','','chart')
+
+async def attempt_item_async(item,stage,crawler):
+    """
+    Attempt one lyrics or genre item of the queue.
+    
+    Inputs:
+        -item: (year, song_name, artist_name, attempts) from due_items
+        -stage: 'lyrics' or 'genre'
+        -crawler made by open_crawler
+    
+    Output:
+        -the crawl_state result row of the item
+    """
+    year, song, artist, attempts = item
+    
+    if stage == 'lyrics':
+        r = await fetch_async(crawler,'chartlyrics',lyrics_url(song,artist))
+        status, result = attempt_outcome(r,parse_lyrics)
+    else:
+        r = await fetch_async(crawler,'musixmatch',genre_url(song,artist))
+        status, result = attempt_outcome(r,parse_genre)
+    
+    status, retry_after = retry_schedule(status,attempts)
+    
+    return (status,retry_after,result,year,song,artist,stage)
+
+async def resume_years_async(years,crawler,flush_every):
+    """
+    Work through everything that is due in the crawl_state queue for the 
+    given years: first the charts that have not been fetched, then every 
+    pending (or due for retry) lyrics and genre item. Results are recorded
+    flush_every items at a time, so a crash loses at most that much work.
+    """
+    open_gates(crawler)
+    
+    #charts first, they fill the queue
+    queue_items(db(),[(str(year),'','','chart','') for year in years])
+    charts = await asyncio.gather(*[queue_chart_async(item[0],item[3],crawler)
+                                    for item in due_items(db(),years,'chart',time.time())])
+    record_results(db(),charts)
+    
+    now   = time.time()
+    work  = [attempt_item_async(item,stage,crawler) for stage in ['lyrics','genre']
+             for item in due_items(db(),years,stage,now)]
+    
+    print("Resuming {} crawl items for {} years".format(len(work),len(years)))
+    
+    finished = []
+    for attempt in asyncio.as_completed(work):
+        finished.append(await attempt)
+        
+        if len(finished) >= flush_every: #checkpoint
+            record_results(db(),finished)
+            finished = []
+    
+    record_results(db(),finished)
+
+def crawl_resumable(years,limits=host_limits,flush_every=100): #batch method
+    """
+    Crawl the given years through the crawl_state queue (see data_store.py),
+    so that the crawl can be stopped at any point (crash, quota cut off, 
+    ctrl-c) and picked back up by calling this again: only missing work is
+    fetched. Items that failed transiently are retried on a later call once 
+    their retry_after has passed.
+    
+    Every song whose lyrics and genre got done since the last call is then
+    written to media (songs written before are left alone, so a call with 
+    nothing to do does not touch media).
+    
+    Inputs:
+        -years: iterable of years to crawl
+        -limits: per host limits (see host_limits)
+        -flush_every: items per checkpoint
+    
+    Output:
+        -dictionary of (stage, status) to count, see data_store.crawl_progress
+    """
+    years = list(years)
+    ensure_crawl_state(db())
+    
+    crawler = open_crawler(limits)
+    try:
+        asyncio.run(resume_years_async(years,crawler,flush_every))
+    finally:
+        close_crawler(crawler)
+    
+    #write what was completed since the last call. a crash between the two
+    #writes only means those songs are upserted again next time (a no-op)
+    songs = finished_songs(db(),years)
+    insert_songs(db(),songs)
+    mark_written(db(),songs)
+    tokenize_media(db())
+    
+    progress = crawl_progress(db())
+    print("Crawl progress: {}".format(progress))
+    
+    return progress
+
+def benchmark_crawl(years=range(1980,1983),n_songs=100,latency=0.05,limits=None):
+    """
+    Time the serial two pass crawl (get_top_lyrics + get_top_genres) against 
+    the single pass crawl_async on local mock servers (see data_mock.py). Nothing is written to the database.
+    
+    Inputs:
+        -years to crawl
+        -n_songs: songs per mock chart page
+        -latency: seconds each mock answer takes
+        -limits: per host limits for the async crawl. Defaults to the in flight
+                 limits of host_limits without rate limits (the mock has no quota)
+    
+    Output:
+        -dictionary of mode to seconds taken
+    """
+    from data_mock import start_mock_servers, stop_mock_servers #benchmark only, not needed to crawl
+    
+    if limits is None:
+        limits = {s:{'in_flight':l['in_flight'],'per_second':None} for s,l in host_limits.items()}
+    
+    mock_hosts, servers = start_mock_servers(n_songs,latency)
+    real_hosts = dict(hosts)
+    hosts.update(mock_hosts) #point every request at the mock
+    
+    try:
+        start = time.perf_counter()
+        for year in years:
+            get_top_lyrics(year)
+            get_top_genres(year)
+        serial = time.perf_counter() - start
+        
+        start = time.perf_counter()
+        crawl_async(years,limits,write=False)
+        concurrent = time.perf_counter() - start
+    
+    finally:
+        hosts.update(real_hosts)
+        stop_mock_servers(servers)
+    
+    print("serial crawl: {:.2f}s, async crawl: {:.2f}s ({:.1f}x)".format(
+        serial,concurrent,serial/concurrent))
+    
+    return {'serial':serial,'async':concurrent}
+
+def filter_genres(weights_path=genre_weights_path):
     
     """---------------------------------------------------------------------------- * 
  |  Filter the genres of each song to single genre.                                 | 
@@ -513,64 +1233,116 @@ def filter_genres():
  |      Christian/Gospel         Christian/Gospel 5.0                               |
  |      Holiday                  Christian/Gospel 5.0                               |
  * -------------------------------------------------------------------------------- *  
+ |  The weights actually used are loaded from genre_weights.json (or weights_path), |
+ |  and the raw musixmatch genres are kept in genre_raw so that the classification  |
+ |  can be re-run after re-tuning them.                                             |
+ * -------------------------------------------------------------------------------- *
    """
     
-    #Make weights
-    genre_weights = {'Rock'   : {'Alternative':0.6, 'Heavy Metal':0.8,
-                                 'Singer/Songwriter':0.6, 'Pop/Rock':0.9,
-                                 'American Trad Rock':0.8,'Rock':1.0,'New Wave':1.0},          
-                    'Hip-Hop' : {'Hip-Hop':1.0,'Hip Hop/Rap':1.0,
-                                 'Hardcore Rap':1.0, 'Rap':1.0},
-                    'R&B/Soul': {'R&B/Soul':0.9,'Soul':0.9,'Disco':0.9},
-                    'Latin'   : {'Latin':1.0,'Pop in Spanish': 1.0, 'Reggae': 1.0,
-                                 'Latin Urban':1.0,'Salsa y Tropical':1.0},
-                    'Dance'   : {'Dance':1.0,'Electronic':1.0},
-                    'Country' : {'Country': 3.0},
-                    'Jazz'    : {'Jazz': 10.0},
-                    'Pop'     : {'Soundtrack':0.7,'Pop':0.5, 'Vocal':0.6,
-                                 'Easy Listening': 0.5,'Holiday':1.0},
-                    'Christian/Gospel': {'Christian/Gospel':10.0}}
-    
-    #Make it iterable
-    prim_genre_weight_keys = [key for key in genre_weights.keys()]
-    
-    curs.execute("SELECT genre, song_name, artist_name FROM media")
-    data = curs.fetchall()
+    #Make weights (see genre_weights.json)
+    genre_weights = load_genre_weights(weights_path)
+    compiled      = compile_genre_weights(genre_weights)
     
+    #classify from the raw musixmatch genres, so the weights can be re-tuned
+    #and filter_genres run again
+    keep_raw_genres(db())
+    curs = db().cursor()
+    curs.execute("SELECT genre_raw, rowid, genre FROM media")
+    data = curs.fetchall()
     
     all_genres = [entry[0] for entry in data]
-    all_songs = [entry[1] for entry in data]
-    all_artists = [entry[2] for entry in data]
-    
-    for i in range(len(all_genres)):
-        indiv_weights = {'Rock':0,'Hip-Hop':0,'R&B/Soul':0,'Latin':0,
-                         'Dance':0,'Country':0,'Jazz':0,'Pop':0,'Christian/Gospel':0}
-        artist = all_artists[i] #stored as tuple
-        song   = all_songs[i]   #stored as tuple
-        genres = all_genres[i] #genres tored as comma separated list
-        genres = genres.split(",") #split genres
-        for g in genres:
-            for pg in prim_genre_weight_keys: #pg = primary genre 
-                
-                subgenres = [sg for sg in genre_weights[pg].keys()] #sg = subgenre
-                
-                if g in subgenres:
-                    for sg in subgenres:
-                        if g == sg:
-                            indiv_weights[pg]+=genre_weights[pg][sg]
-        
-        indiv_weight_keys = [k for k in indiv_weights.keys()]
-        top_genre_wt = 0
-        top_genre    = ""
-        
-        for k in indiv_weight_keys:
-            if indiv_weights[k] > top_genre_wt:
-                top_genre = k
-        
-        print("Updating {} - {} to {}".format(song,artist,top_genre))
-        curs.execute("UPDATE media SET genre = ? WHERE artist_name = ? AND song_name = ?",(top_genre,artist,song))
-        
-        connect.commit()
+    all_rowids = [entry[1] for entry in data]
+    
+    top_genres = classify_genres(all_genres,compiled)
+    
+    #write every changed label at once (an unchanged row is not touched, so
+    #it does not count as a change of media)
+    changed = [(top,rowid) for top, rowid, entry in zip(top_genres,all_rowids,data) if top != entry[2]]
+    relabel(db(),changed)
+    print("Updated the genres of {} songs".format(len(changed)))
+
+def load_genre_weights(path=genre_weights_path):
+    """
+    Load the weight table of filter_genres from a json file of
+    {parent genre: {subgenre: weight}}. Parents keep the order of the file,
+    which is the order ties are broken in.
+    """
+    with open(path,encoding='utf-8') as f:
+        return json.load(f)
+
+def compile_genre_weights(genre_weights):
+    """
+    Compile the weight table into a subgenre index and a subgenre x parent
+    weight matrix, once, instead of walking the nested dictionaries for 
+    every genre of every song.
+    
+    Input:
+        -genre_weights: {parent genre: {subgenre: weight}}
+    
+    Output:
+        -dictionary with 'parents' (list), 'subgenres' (subgenre -> row of 
+         the matrix) and 'weights' (subgenres x parents numpy array)
+    """
+    parents   = [pg for pg in genre_weights.keys()]
+    subgenres = {}
+    
+    for pg in parents:
+        for sg in genre_weights[pg].keys():
+            subgenres.setdefault(sg,len(subgenres))
+    
+    #a subgenre can vote for more than one parent
+    weights = np.zeros((len(subgenres),len(parents)))
+    for p, pg in enumerate(parents):
+        for sg, wt in genre_weights[pg].items():
+            weights[subgenres[sg],p] += wt
+    
+    return {'parents':parents,'subgenres':subgenres,'weights':weights}
+
+def classify_genres(all_genres,compiled):
+    """
+    Score the comma separated raw genres of every song against the compiled 
+    weights in one batched pass and pick each song's top parent genre.
+    
+    Every distinct raw string is parsed once into (string, subgenre) pairs,
+    the pairs form a sparse string x subgenre matrix, and multiplying it by 
+    the subgenre x parent weights gives every string's parent scores.
+    
+    Inputs:
+        -all_genres: list of raw genre strings (None for a song without genres)
+        -compiled: output of compile_genre_weights
+    
+    Output:
+        -list of top genres, aligned with all_genres. "" for songs without a 
+         single weighted genre, ties go to the parent listed first.
+    """
+    parents   = compiled['parents']
+    subgenres = compiled['subgenres']
+    weights   = compiled['weights']
+    
+    #songs share a handful of raw genre strings, parse each one once
+    uniq    = {}
+    inverse = np.array([uniq.setdefault(g or "",len(uniq)) for g in all_genres],dtype=np.int64)
+    
+    rows, cols = [], []
+    for i, genres in enumerate(uniq.keys()):
+        for g in genres.split(","):
+            if g in subgenres:
+                rows.append(i)
+                cols.append(subgenres[g])
+    
+    #sparse (string x subgenre) times (subgenre x parent), one column at a time
+    rows   = np.array(rows,dtype=np.int64)
+    cols   = np.array(cols,dtype=np.int64)
+    scores = np.zeros((len(uniq),len(parents)))
+    for p in range(len(parents)):
+        scores[:,p] = np.bincount(rows,weights=weights[cols,p],minlength=len(uniq))
+    
+    #argmax, "" when nothing scored
+    best   = scores.argmax(axis=1)
+    labels = np.array(parents + [""],dtype=object)
+    top    = labels[np.where(scores.max(axis=1) > 0,best,len(parents))]
+    
+    return top[inverse].tolist()
         
 def hand_enter():
     """
@@ -582,6 +1354,7 @@ def hand_enter():
     """
     
     #get all rows in question
+    curs = db().cursor()
     curs.execute("SELECT song_name, artist_name FROM media WHERE genre = ?",("Holiday",))
     
     genre_less = curs.fetchall()
@@ -593,7 +1366,7 @@ def hand_enter():
         print("{} songs left!".format(len(genre_less)-i))
         update_g = input("What is this song's genre? ")
         curs.execute("UPDATE media SET genre = ? WHERE artist_name = ? AND song_name = ?",(update_g,row[1],row[0]))
-        connect.commit()
+        db().commit()
         
         quit_ = input("Want to quit? ")
         
@@ -605,10 +1378,13 @@ def main():
     Main method where code is executed.    
     
     """
+    curs = db().cursor()
     curs.execute("SELECT * FROM media WHERE song_name =? ",("Call Me",))
     genres = curs.fetchall()  
     print(genres)
     pass
-main() #execute main
 
-connect.close() #close database conection
\ No newline at end of file
+if __name__ == '__main__':
+    main() #execute main
+    
+    db().close() #close database conection
\ No newline at end of file
@@ -0,0 +1,358 @@
+# -*- coding: utf-8 -*-
+"""
+ * ------------------------------------------------------- *
+ |CS/STAT 287 FINAL PROJECT: COMMAND LINE FILE             |
+ |                                                         |
+ |One entry point for the whole pipeline:                  |
+ |                                                         |
+ |   python lyrical.py crawl 1980 2010   --> build the db  |
+ |   python lyrical.py classify          --> one genre each|
+ |   python lyrical.py dedupe [--apply]  --> drop repeated |
+ |                                           songs (old db)|
+ |   python lyrical.py normalize         --> re-clean the  |
+ |                                           lyrics of old |
+ |                                           crawls        |
+ |   python lyrical.py count --by genre  --> word counts   |
+ |   python lyrical.py yule --by decade  --> Yule ranking  |
+ |   python lyrical.py syllables         --> syllabic avgs |
+ |   python lyrical.py plot all          --> time series   |
+ |   python lyrical.py stats             --> stats tables  |
+ |   python lyrical.py windows --width 5 --> rolling years |
+ |   python lyrical.py pairs Rock Pop    --> Yule of a pair|
+ |   python lyrical.py report            --> yule/syllables|
+ |                                           through the   |
+ |                                           result cache  |
+ |   python lyrical.py startup           --> time the      |
+ |                                           start of each |
+ |                                           subcommand    |
+ |                                                         |
+ |Every subcommand imports only the modules it needs (see  |
+ |command_modules): counting never loads bs4/requests,     |
+ |only plot loads matplotlib, and count/yule only load the |
+ |syllable table (or nltk to compile it) to read the       |
+ |aggregates.                                              |
+ * ------------------------------------------------------- *
+argparse citations
+   -->[https://docs.python.org/3/library/argparse.html#sub-commands]
+"""
+
+import importlib
+import subprocess
+import argparse
+import time
+import sys
+import os
+
+
+#the modules each subcommand needs, imported when it runs
+command_modules = {'crawl'    : ['data_xtraction'],
+                   'classify' : ['data_xtraction'],
+                   'dedupe'   : ['data_store'],
+                   'normalize': ['data_store'],
+                   'count'    : ['data_analysis'],
+                   'yule'     : ['data_analysis'],
+                   'syllables': ['data_analysis'],
+                   'plot'     : ['data_analysis','matplotlib.pyplot'],
+                   'stats'    : ['data_analysis'],
+                   'report'   : ['data_analysis','data_pipeline'],
+                   'windows'  : ['data_analysis'],
+                   'pairs'    : ['data_analysis','data_pipeline'],
+                   'startup'  : []}
+
+
+def parse_by(by):
+    """
+    A --by option as data_analysis takes it.
+
+    Ex: parse_by('genre') returns 'genre', parse_by('genre,year') returns ('genre','year')
+    """
+    dims = tuple(dim.strip() for dim in by.split(','))
+    return dims if len(dims) > 1 else dims[0]
+
+def load(command,db_path):
+    """
+    Import the modules of a subcommand and point them at the database.
+
+    Output:
+        -dictionary of module name to module
+    """
+    modules = {name:importlib.import_module(name) for name in command_modules[command]}
+
+    for module in modules.values():
+        if hasattr(module,'db_path'):
+            module.db_path = db_path
+
+    return modules
+
+def stratum_counts(modules,args,syllables=False): #helper method
+    """
+    The word counts of --by, in memory or streamed, and with syllables=True 
+    its syllabic averages (None otherwise, the syllable table is not loaded).
+    The aggregates always keep their syllable sums up to date, so reading 
+    them loads the syllable table either way.
+    """
+    da = modules['data_analysis']
+    by = parse_by(args.by)
+
+    if args.aggregates:
+        table, syls = da.aggregate_stats(by)
+        return table, (syls if syllables else None)
+
+    if args.stream or args.workers != 1:
+        return da.stream_stats(by,workers=args.workers,syllables=syllables)
+
+    corpus, groups = da.scan_media([by])
+    return (da.corpus_word_counts(corpus,groups[by]),
+            da.count_syls(groups[by],corpus) if syllables else None)
+
+def label(key): #helper method
+    return "/".join(key) if isinstance(key,tuple) else str(key)
+
+###############################################################################
+############################### SUBCOMMANDS ###################################
+###############################################################################
+def run_crawl(modules,args):
+    dx = modules['data_xtraction']
+
+    if args.cache or args.offline:
+        dx.use_cache(args.cache or 'http_cache',offline=args.offline)
+
+    years = range(args.first,(args.last or args.first) + 1)
+    if args.resumable:
+        dx.crawl_resumable(years)
+    else:
+        dx.crawl_async(years)
+
+def run_classify(modules,args):
+    modules['data_xtraction'].filter_genres()
+
+def run_dedupe(modules,args):
+    rows = modules['data_store'].dedupe_media(args.db,args.apply)
+
+    for rowid, song, artist, year, same in rows:
+        print("{:>8}  {} - {} ({}){}".format(rowid,song,artist,year,"" if same else "  [lyrics/genre differ]"))
+    print("{} {} rows repeating an earlier (song, artist, year)".format("dropped" if args.apply else "would drop",
+                                                                          len(rows)))
+
+def run_normalize(modules,args):
+    ds   = modules['data_store']
+    conn = ds.open_db(args.db)
+
+    print("re-cleaned the lyrics of {} songs".format(ds.normalize_media(conn)))
+    conn.close()
+
+def run_count(modules,args):
+    table, _ = stratum_counts(modules,args)
+
+    for i, key in enumerate(table.keys):
+        start, stop = int(table.counts['indptr'][i]), int(table.counts['indptr'][i+1])
+        print("{:>30}: {:>10} words, {:>8} distinct".format(label(key),int(table.counts['data'][start:stop].sum()),
+                                                            stop - start))
+
+def run_yule(modules,args):
+    da = modules['data_analysis']
+    table, _ = stratum_counts(modules,args)
+
+    if args.sanitize:
+        table = da.sanitize(table)
+
+    yules = da.yule_batch(table,k=args.k)
+
+    if args.write:
+        da.write_yules_to_file(yules)
+        return
+
+    for key, ranking in yules.items():
+        print("{}:".format(label(key)))
+        print("   most  : {}".format(", ".join(word for _, word in ranking[:10])))
+        print("   least : {}".format(", ".join(word for _, word in ranking[:-11:-1])))
+
+def run_syllables(modules,args):
+    from data_syllables import lookup_syllables
+
+    table, syls = stratum_counts(modules,args,syllables=True)
+
+    for key, avg in syls.items():
+        print("{:>30}: {:.4f}".format(label(key),avg))
+
+    #the distinct words of this count whose syllables were estimated
+    used = sorted(set(table.counts['indices'].tolist()))
+    _, found = lookup_syllables([table.vocab[i] for i in used])
+    print("{} words not in cmudict were estimated".format(len(used) - int(found.sum())))
+
+def run_plot(modules,args):
+    choice = args.choice if len(args.choice) > 1 else args.choice[0]
+    modules['data_analysis'].plot_genre_by_yr_by_syllabic(choice)
+
+def run_stats(modules,args):
+    da = modules['data_analysis']
+
+    da.ensure_stats_tables()
+    da.write_to_genre_stats(aggregates=args.aggregates)
+    da.write_to_year_stats(aggregates=args.aggregates)
+
+def run_windows(modules,args):
+    windows = modules['data_analysis'].sliding_windows(args.width,args.step,args.k,args.aggregates)
+
+    for name, window in windows.items():
+        print("{} ({} songs): {:.4f}".format(name,window['songs'],window['syllables']))
+        print("   most  : {}".format(", ".join(word for _, word in window['yule'][:10])))
+        print("   least : {}".format(", ".join(word for _, word in window['yule'][:-11:-1])))
+
+def run_pairs(modules,args):
+    da, dp = modules['data_analysis'], modules['data_pipeline']
+    by     = parse_by(args.by)
+    rules  = [[int(a) if a.isdigit() else a for a in rule.split(':')] for rule in args.rule]
+    pairs  = dp.report(da.db(),by,args.k,rules,pairs=True,directory=args.cache)['values']['pairs']
+
+    #ex: "pairs Rock Pop" or, for a cube, "pairs --by genre,decade Rock,1980-1989 Pop,1980-1989"
+    keys = [parse_by(key) for key in args.keys] or pairs['keys']
+    for key1 in keys:
+        for key2 in keys:
+            if key1 == key2:
+                continue
+            ranking = da.pair_yules(pairs,key1,key2)
+            print("{} vs {}:".format(label(key1),label(key2)))
+            print("   most  : {}".format(", ".join(word for _, word in ranking[:10])))
+            print("   least : {}".format(", ".join(word for _, word in ranking[:-11:-1])))
+
+def run_report(modules,args):
+    dp    = modules['data_pipeline']
+    by    = parse_by(args.by)
+    rules = [[int(a) if a.isdigit() else a for a in rule.split(':')] for rule in args.rule]
+
+    start = time.perf_counter()
+    run   = dp.report(modules['data_analysis'].db(),by,args.k,rules,args.write,args.stats,args.cache,args.force)
+
+    for key, avg in run['values']['syllables'].items():
+        ranking = run['values']['yule'][key]
+        print("{:>30}: {:.4f}  {}".format(label(key),avg,", ".join(word for _, word in ranking[:5])))
+    print("recomputed: {} ({:.3f} s)".format(", ".join(run['computed']) or "nothing",time.perf_counter() - start))
+
+def run_startup(modules,args):
+    """
+    Time how long every subcommand takes to start (a fresh interpreter,
+    argument parsing and its imports) without doing its work.
+    """
+    commands = [c for c in command_modules.keys() if c != 'startup']
+    probes   = {'crawl':['1980'],'plot':['all']}
+    here     = os.path.abspath(__file__)
+
+    for command in commands:
+        best = float('inf')
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            subprocess.run([sys.executable,here,'--startup-only','--db',args.db,command] + probes.get(command,[]),
+                           check=True)
+            best = min(best,time.perf_counter() - start)
+
+        print("{:>10}: {:7.1f} ms".format(command,best*1000))
+
+###############################################################################
+def make_parser():
+    """
+    The argument parser of every subcommand.
+    """
+    parser = argparse.ArgumentParser(prog='lyrical',description="Lyrical analysis pipeline")
+    parser.add_argument('--db',default='song_records.db',help="sqlite3 database (default song_records.db)")
+    parser.add_argument('--startup-only',action='store_true',help=argparse.SUPPRESS)
+    commands = parser.add_subparsers(dest='command',required=True)
+
+    crawl = commands.add_parser('crawl',help="crawl charts, lyrics and genres into the database")
+    crawl.add_argument('first',type=int,help="first year")
+    crawl.add_argument('last',type=int,nargs='?',help="last year (default: first)")
+    crawl.add_argument('--resumable',action='store_true',help="go through the crawl_state queue")
+    crawl.add_argument('--cache',help="response cache directory")
+    crawl.add_argument('--offline',action='store_true',help="replay the response cache only")
+    crawl.set_defaults(run=run_crawl)
+
+    classify = commands.add_parser('classify',help="reduce every song to a single genre")
+    classify.set_defaults(run=run_classify)
+
+    dedupe = commands.add_parser('dedupe',help="list (or drop) the rows that keep media from getting its key")
+    dedupe.add_argument('--apply',action='store_true',help="delete them and build the key")
+    dedupe.set_defaults(run=run_dedupe)
+
+    normalize = commands.add_parser('normalize',help="clean the lyrics of songs crawled before remove_chars like "
+                                                     "new ones and tokenize them again")
+    normalize.set_defaults(run=run_normalize)
+
+    for name, run, helps in [('count',run_count,"word counts per stratum"),
+                             ('yule',run_yule,"Yule coefficients of every stratum against the rest"),
+                             ('syllables',run_syllables,"syllabic average per stratum")]:
+        command = commands.add_parser(name,help=helps)
+        command.add_argument('--by',default='genre',help="genre, year, decade, calendar_decade, artist or a comma list (ex: genre,decade)")
+        command.add_argument('--stream',action='store_true',help="count media in chunks instead of in memory")
+        command.add_argument('--workers',type=int,default=1,help="processes counting in parallel (0 => one per cpu)")
+        command.add_argument('--aggregates',action='store_true',
+                             help="read the per genre/year counts the database keeps (genre, year or decade only)")
+        command.set_defaults(run=run)
+
+    commands.choices['yule'].add_argument('--k',type=int,default=100,help="words kept at each end (0 => all)")
+    commands.choices['yule'].add_argument('--sanitize',action='store_true',help="drop nonsensical words first")
+    commands.choices['yule'].add_argument('--write',action='store_true',help="write the *_yules.txt files (needs --k 100 or more)")
+
+    plot = commands.add_parser('plot',help="plot the syllabic averages of the genres over time")
+    plot.add_argument('choice',nargs='+',help="all, together, indiv or a list of genres")
+    plot.set_defaults(run=run_plot)
+
+    stats = commands.add_parser('stats',help="fill the genre_stats and year_stats tables")
+    stats.add_argument('--aggregates',action='store_true',help="read the per genre/year counts the database keeps")
+    stats.set_defaults(run=run_stats)
+
+    windows = commands.add_parser('windows',help="Yule lists and syllabic averages of rolling windows of years")
+    windows.add_argument('--width',type=int,default=5,help="years per window")
+    windows.add_argument('--step',type=int,default=1,help="years between two windows")
+    windows.add_argument('--k',type=int,default=100,help="words kept at each end (0 => all)")
+    windows.add_argument('--aggregates',action='store_true',help="read the per year counts the database keeps")
+    windows.set_defaults(run=run_windows)
+
+    pairs = commands.add_parser('pairs',help="Yule lists of every pair of strata against eachother")
+    pairs.add_argument('keys',nargs='*',help="strata to compare (default: all of them)")
+    pairs.add_argument('--by',default='genre',help="genre, year, decade, calendar_decade, artist or a comma list (ex: genre,decade)")
+    pairs.add_argument('--k',type=int,default=100,help="words kept at each end (0 => all)")
+    pairs.add_argument('--rule',action='append',default=[],help="sanitize rule as name:arg:arg, repeatable")
+    pairs.add_argument('--cache',help="result cache directory (default analysis_cache)")
+    pairs.set_defaults(run=run_pairs)
+
+    report = commands.add_parser('report',help="Yule batch and syllabic averages, only recomputing what changed")
+    report.add_argument('--by',default='genre',help="genre, year, decade, calendar_decade, artist or a comma list (ex: genre,decade)")
+    report.add_argument('--k',type=int,default=100,help="words kept at each end (0 => all)")
+    report.add_argument('--rule',action='append',default=[],
+                        help="sanitize rule as name:arg:arg, repeatable (ex: length_bounds:4:16)")
+    report.add_argument('--write',action='store_true',help="write the *_yules.txt files (needs --k 100 or more)")
+    report.add_argument('--stats',action='store_true',help="write the stats table (genre or decade)")
+    report.add_argument('--cache',help="result cache directory (default analysis_cache)")
+    report.add_argument('--force',action='store_true',help="write files/stats even if already written")
+    report.set_defaults(run=run_report)
+
+    startup = commands.add_parser('startup',help="time the start of every subcommand")
+    startup.add_argument('--repeat',type=int,default=5,help="runs per subcommand, the best is kept")
+    startup.set_defaults(run=run_startup)
+
+    return parser
+
+def main(argv=None):
+    parser = make_parser()
+    args   = parser.parse_args(argv)
+
+    if hasattr(args,'workers'):
+        args.workers = args.workers or None #0 => one per cpu
+    if hasattr(args,'k'):
+        args.k = args.k or None #0 => the full ranking
+
+    #the *_yules.txt files and the stats table hold the 100 lowest and highest
+    #coefficients (see data_pipeline.check_writes)
+    if getattr(args,'k',None) is not None and args.k < 100 and (getattr(args,'write',False) or 
+                                                                getattr(args,'stats',False)):
+        parser.error("--write and --stats need --k 100 or more (or 0 for all), not --k {}".format(args.k))
+
+    modules = load(args.command,args.db)
+
+    if args.startup_only:
+        return
+
+    args.run(modules,args)
+
+if __name__ == '__main__':
+    main()
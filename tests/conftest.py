@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+"""
+The modules live at the top of the repository, next to this directory.
+
+The tests never need nltk: syllable_table stands a small pronouncing 
+dictionary (cmu) in for the compiled cmudict table.
+"""
+import sys
+import os
+
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+import pytest
+
+import data_syllables
+
+
+#a small pronouncing dictionary standing in for cmudict
+cmu = {'love' :[['L','AH1','V']],
+       'baby' :[['B','EY1','B','IY0']],
+       'night':[['N','AY1','T']],
+       'dance':[['D','AE1','N','S']],
+       'forever':[['F','ER0','EH1','V','ER0']],
+       'heart':[['HH','AA1','R','T']],
+       'tonight':[['T','AH0','N','AY1','T'],['T','UW0','N','AY1','T']]}
+
+
+@pytest.fixture
+def syllable_table(monkeypatch):
+    """
+    The syllable table of cmu, loaded as data_syllables.load_syllables would.
+    """
+    words  = sorted(cmu.keys())
+    counts = [[len([p for p in pron if p[-1].isdigit()]) for pron in cmu[w]] for w in words]
+    starts = np.zeros(len(words) + 1,dtype=np.uint32)
+    np.cumsum([len(c) for c in counts],out=starts[1:])
+
+    table = {'words' :np.array(words,dtype=str),
+             'starts':starts,
+             'counts':np.array([n for c in counts for n in c],dtype=np.uint8)}
+    monkeypatch.setattr(data_syllables,'syllable_table',table)
+
+    return table
@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+"""
+The fast paths of data_analysis.py against the original dict based code
+(yule_batch from yule/filter_out_key, count_word_occurrence and count_syls as
+they were first written), on a tiny media table. The sanitize rules and
+yule_pairs are checked against the same counts filtered word by word and
+against yule() of every pair.
+
+The songs are chosen so that many words tie on their Yule coefficient, some
+genres have no songs at all (stratify_by_genre still has them) and one genre
+has a single song without words.
+"""
+
+import re
+
+import numpy as np
+import pytest
+
+import data_analysis
+import data_syllables
+from data_store import open_db, insert_songs
+from conftest import cmu
+
+
+songs = [('s1','a1',"love baby night love dance",'Rock','1981'),
+         ('s2','a2',"love heart heart zorp forever",'Rock','1985'),
+         ('s3','a3',"baby baby night tonight glarb",'Pop','1990'),
+         ('s4','a4',"dance dance love night zorp",'Pop','1999'),
+         ('s5','a5',"tonight heart love qwix",'Country','2003'),
+         ('s6','a6',"forever night baby",'Country','2010'),
+         ('s7','a7',"love night",'Dance','2004'),
+         ('s8','a8',"",'Hip-Hop','2007')]
+
+
+@pytest.fixture
+def media(tmp_path,monkeypatch,syllable_table):
+    """
+    A fresh database holding songs, and the small syllable table.
+    """
+    path = str(tmp_path/'songs.db')
+    conn = open_db(path)
+    insert_songs(conn,songs)
+    conn.close()
+
+    monkeypatch.setattr(data_analysis,'db_path',path)
+    monkeypatch.setattr(data_analysis,'conn',None)
+
+    yield path
+
+    data_analysis.db().close()
+
+###############################################################################
+############################ THE ORIGINAL CODE ################################
+###############################################################################
+def original_count_word_occurrence(strat_dict):
+    corpora_word_counts = {}
+    for key, corpus in strat_dict.items():
+        corpus_word_dict = {}
+        for row in corpus:
+            for word in row['lyrics'].split():
+                corpus_word_dict[word] = corpus_word_dict.get(word,0) + 1
+        corpora_word_counts[key] = corpus_word_dict
+    return corpora_word_counts
+
+def original_yule_batch(corpora_word_dict):
+    return {key:data_analysis.yule(data_analysis.filter_out_key(key,corpora_word_dict),corpus)
+            for key, corpus in corpora_word_dict.items()}
+
+def original_nsyl(word):
+    return [len(list(y for y in x if y[-1].isdigit())) for x in cmu[word.lower()]]
+
+def original_count_syls(strat_dict):
+    avg_syls_per_corpus = {}
+    for key, corpus in strat_dict.items():
+        avg_syl_ct = []
+        for row in corpus:
+            syl_ct = []
+            for word in row['lyrics'].split():
+                try:
+                    syls = original_nsyl(word)
+                    syl_ct.append(syls[0])
+                except KeyError:
+                    syls = [data_syllables.syllables(word)]
+                syl_ct.append(syls[0])
+            avg_syl_ct.append(sum(syl_ct)/len(syl_ct))
+        avg_syls_per_corpus[key] = sum(avg_syl_ct)/len(avg_syl_ct)
+    return avg_syls_per_corpus
+
+def ends(yules,k): #the k lowest and k highest of a full list, like yule_batch(k=k)
+    return yules if len(yules) <= 2*k else yules[:k] + yules[-k:]
+
+def with_words(strat_dict): #the strata the original count_syls can average
+    return {key:rows for key, rows in strat_dict.items() if rows and all(row['lyrics'].split() for row in rows)}
+
+###############################################################################
+################################# TESTS #######################################
+###############################################################################
+def test_word_counts_match_original(media):
+    strat = data_analysis.stratify_by_genre()
+    expected = original_count_word_occurrence(strat)
+
+    assert data_analysis.count_word_occurrence(strat) == expected
+    assert expected['Jazz'] == {} and expected['Hip-Hop'] == {}
+
+def test_yule_batch_matches_original(media):
+    strat    = data_analysis.stratify_by_genre()
+    counts   = original_count_word_occurrence(strat)
+    expected = original_yule_batch(counts)
+
+    #ties: several words share a coefficient, their order is alphabetical
+    coefs = [coef for coef, _ in expected['Rock']]
+    assert len(coefs) > len(set(coefs))
+
+    assert data_analysis.yule_batch(counts) == expected
+    assert data_analysis.yule_batch(counts,k=2) == {key:ends(y,2) for key, y in expected.items()}
+
+    #the count table of one scan of media
+    corpus, groups = data_analysis.scan_media(['genre'])
+    table = data_analysis.corpus_word_counts(corpus,groups['genre'])
+    assert data_analysis.yule_batch(table) == {key:expected[key] for key in table.keys}
+
+@pytest.mark.parametrize('workers,max_bytes',[(1,None),(2,None),(1,64),(2,64)])
+def test_streamed_counts_match_original(media,workers,max_bytes):
+    strat    = data_analysis.stratify_by_genre()
+    counts   = original_count_word_occurrence(strat)
+    expected = original_yule_batch(counts)
+
+    #64 bytes: the counts spill to sorted runs every few chunks
+    table, syls = data_analysis.stream_stats('genre',size=2,max_bytes=max_bytes,workers=workers)
+
+    assert data_analysis.table_dicts(table) == {key:counts[key] for key in table.keys}
+    assert data_analysis.yule_batch(table) == {key:expected[key] for key in table.keys}
+
+    original = original_count_syls(with_words(strat))
+    assert {key:syls[key] for key in original.keys()} == original
+    assert np.isnan(syls['Hip-Hop']) #the song without words
+
+def test_count_syls_matches_original(media):
+    strat    = data_analysis.stratify_by_genre()
+    expected = original_count_syls(with_words(strat))
+
+    #tonight has two pronunciations, glarb/zorp/qwix are not in the dictionary
+    assert data_analysis.count_syls(with_words(strat)) == expected
+
+    corpus, groups = data_analysis.scan_media(['genre'])
+    by_corpus = data_analysis.count_syls(groups['genre'],corpus)
+    assert {key:by_corpus[key] for key in expected.keys()} == expected
+    assert np.isnan(by_corpus['Hip-Hop'])
+
+def test_decades_match_stratify_by_year(media):
+    strat = data_analysis.stratify_by_year('decade')
+    corpus, groups = data_analysis.scan_media(['decade','calendar_decade'])
+
+    assert sorted(groups['decade'].keys()) == sorted(strat.keys())
+    assert (data_analysis.count_word_occurrence(groups['decade'],corpus) == 
+            original_count_word_occurrence(strat))
+
+    #opt in: 2010 is a decade of its own
+    assert sorted(groups['calendar_decade'].keys()) == ['1980-1989','1990-1999','2000-2009','2010-2019']
+
+def test_lookup_syllables_mixed_lengths(media):
+    words = ['Love','a','supercalifragilisticexpialidocious','tonight','zorp','HEART','']
+    counts, found = data_syllables.lookup_syllables(words)
+
+    assert found.tolist() == [True,False,False,True,False,True,False]
+    assert counts.tolist() == [1,0,0,2,0,1,0]
+
+@pytest.mark.parametrize('writes',[{'stats':True},{'yule_files':True}])
+def test_report_needs_100_coefficients(media,tmp_path,writes):
+    import data_pipeline
+
+    with pytest.raises(ValueError):
+        data_pipeline.report(data_analysis.db(),'genre',k=5,directory=str(tmp_path/'cache'),**writes)
+
+def test_windows_reach_the_last_year(media):
+    windows = data_analysis.sliding_windows(width=5,step=3,k=None)
+
+    #1981-1985, 1984-1988, ... 2005-2009, then the window ending at 2010
+    assert list(windows.keys())[-2:] == ['2005-2009','2006-2010']
+
+    strat  = data_analysis.stratify_by_year('year')
+    counts = original_count_word_occurrence({'in' :[row for y in range(2006,2011) for row in strat[str(y)]],
+                                             'out':[row for y in range(1980,2006) for row in strat[str(y)]]})
+    assert windows['2006-2010']['yule'] == data_analysis.yule(counts['out'],counts['in'])
+    assert windows['2006-2010']['songs'] == 2
+
+def rule_kept(corpora_word_dict,shortest=4,longest=16,stopwords=(),n=1,pattern=None): #word by word
+    totals = {}
+    for corpus in corpora_word_dict.values():
+        for word, count in corpus.items():
+            totals[word] = totals.get(word,0) + count
+    keep = lambda w: (shortest <= len(w) <= longest and w not in stopwords and totals[w] >= n and
+                      (pattern is None or re.search(pattern,w) is None))
+    return {key:{w:c for w, c in corpus.items() if keep(w)} for key, corpus in corpora_word_dict.items()}
+
+@pytest.mark.parametrize('rules,kept',[(None,{}),
+                                       ([data_analysis.length_bounds(5,6)],{'shortest':5,'longest':6}),
+                                       ([data_analysis.drop_stopwords(['love','night'])],{'shortest':0,'stopwords':['love','night']}),
+                                       ([data_analysis.min_frequency(3)],{'shortest':0,'n':3}),
+                                       ([data_analysis.drop_matching('^[a-z]{4}$|q')],{'shortest':0,'pattern':'^[a-z]{4}$|q'}),
+                                       ([data_analysis.length_bounds(),data_analysis.min_frequency(2),
+                                         data_analysis.drop_stopwords(['baby'])],{'n':2,'stopwords':['baby']})])
+def test_sanitize_rules(media,rules,kept):
+    counts   = original_count_word_occurrence(data_analysis.stratify_by_genre())
+    expected = rule_kept(counts,**kept)
+
+    #dictionaries are filtered in place
+    data_analysis.sanitize(counts,rules)
+    assert counts == expected
+
+    corpus, groups = data_analysis.scan_media(['genre'])
+    table = data_analysis.sanitize(data_analysis.corpus_word_counts(corpus,groups['genre']),rules)
+    assert data_analysis.table_dicts(table) == {key:expected[key] for key in table.keys}
+    assert data_analysis.yule_batch(table) == original_yule_batch({key:expected[key] for key in table.keys})
+
+@pytest.mark.parametrize('k',[None,2])
+def test_yule_pairs_match_yule(media,k):
+    counts = original_count_word_occurrence(data_analysis.stratify_by_genre())
+    pairs  = data_analysis.yule_pairs(counts,k=k)
+
+    for key1 in counts.keys():
+        for key2 in counts.keys():
+            full = data_analysis.yule(counts[key1],counts[key2])
+            assert data_analysis.pair_yules(pairs,key1,key2) == (full if k is None else ends(full,k))
+
+    #a genre against itself: every one of its words at 0, like yule()
+    assert data_analysis.pair_yules(pairs,'Rock','Rock') == ends([[0.0,w] for w in sorted(counts['Rock'])],k or 100)
+    assert data_analysis.pair_yules(pairs,'Rock','Jazz') == []
+
+    corpus, groups = data_analysis.scan_media(['genre'])
+    table = data_analysis.corpus_word_counts(corpus,groups['genre'])
+    from_table = data_analysis.yule_pairs(table,k=k)
+    assert all(data_analysis.pair_yules(from_table,key1,key2) == data_analysis.pair_yules(pairs,key1,key2)
+               for key1 in table.keys for key2 in table.keys)
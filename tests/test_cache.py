@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""
+data_cache.py: the keys responses are stored under, LRU eviction, TTLs and
+the offline (replay only) mode. The clock is a counter, so the order of the
+accesses is the order of the calls.
+"""
+
+import os
+from types import SimpleNamespace
+
+import pytest
+
+import data_cache
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = {'t':1000.0}
+    def tick():
+        now['t'] += 1
+        return now['t']
+    monkeypatch.setattr(data_cache,'time',SimpleNamespace(time=tick))
+    return now
+
+@pytest.fixture
+def cache(tmp_path,clock):
+    cache = data_cache.open_cache(str(tmp_path/'http_cache'),max_bytes=10)
+    yield cache
+    data_cache.close_cache(cache)
+
+def response(status,content):
+    return data_cache.CachedResponse(status,content)
+
+def never(url):
+    raise AssertionError("went to the network for {}".format(url))
+
+###############################################################################
+################################# TESTS #######################################
+###############################################################################
+def test_equivalent_urls_share_a_key():
+    url = 'http://api.musixmatch.com/ws/1.1/track.search?q_artist=abba&q_track=call%20me'
+
+    assert data_cache.normalize_url('HTTP://Api.Musixmatch.com:80/ws/1.1/track.search?q_track=call%20me&apikey=123&q_artist=abba') == url
+    for same in ['http://api.musixmatch.com/ws/1.1/track.search?q_track=call+me&q_artist=abba&apikey=456',
+                 'http://API.musixmatch.com/ws/1.1/track.search?q_artist=abba&q_track=call%20me']:
+        assert data_cache.cache_key(same) == data_cache.cache_key(url)
+
+    for other in ['https://api.musixmatch.com/ws/1.1/track.search?q_artist=abba&q_track=call%20me',
+                  'http://api.musixmatch.com:8080/ws/1.1/track.search?q_artist=abba&q_track=call%20me',
+                  'http://api.musixmatch.com/ws/1.1/track.search?q_artist=abba&q_track=call%20you']:
+        assert data_cache.cache_key(other) != data_cache.cache_key(url)
+
+    assert len(data_cache.cache_key(url)) == 64 #sha256
+
+def test_least_recently_used_entries_are_evicted(cache):
+    data_cache.store(cache,'http://a.com/1',200,b'1111')
+    data_cache.store(cache,'http://a.com/2',200,b'2222')
+    assert data_cache.lookup(cache,'http://a.com/1') == response(200,b'1111') #1 is now newer than 2
+
+    data_cache.store(cache,'http://a.com/3',200,b'3333') #12 bytes > 10: 2 goes
+
+    assert data_cache.lookup(cache,'http://a.com/2') is None
+    assert not os.path.exists(data_cache.entry_path(cache,data_cache.cache_key('http://a.com/2')))
+    assert data_cache.lookup(cache,'http://a.com/1') == response(200,b'1111')
+    assert data_cache.lookup(cache,'http://a.com/3') == response(200,b'3333')
+    assert cache['size'] == 8
+
+    #the size survives a reopen
+    reopened = data_cache.open_cache(cache['dir'],max_bytes=10)
+    assert reopened['size'] == 8
+    data_cache.close_cache(reopened)
+
+def test_overwriting_an_entry_counts_its_size_once(cache):
+    data_cache.store(cache,'http://a.com/1',200,b'1111')
+    data_cache.store(cache,'http://a.com/1',200,b'111111')
+
+    assert cache['size'] == 6
+    assert data_cache.lookup(cache,'http://a.com/1') == response(200,b'111111')
+
+def test_stale_entries_are_misses(tmp_path,clock):
+    cache = data_cache.open_cache(str(tmp_path/'http_cache'),ttl={'old.com':10,'default':None})
+    data_cache.store(cache,'http://old.com/x',200,b'x')
+    data_cache.store(cache,'http://new.com/x',200,b'x')
+
+    clock['t'] += 100
+
+    assert data_cache.lookup(cache,'http://old.com/x') is None
+    assert data_cache.lookup(cache,'http://new.com/x') == response(200,b'x')
+    data_cache.close_cache(cache)
+
+def test_only_successes_are_stored(cache):
+    gets = []
+    def get(url):
+        gets.append(url)
+        return response(500 if url.endswith('bad') else 200,b'body')
+
+    assert data_cache.cached_get(cache,'http://a.com/good',get) == response(200,b'body')
+    assert data_cache.cached_get(cache,'http://a.com/good',never) == response(200,b'body')
+
+    data_cache.cached_get(cache,'http://a.com/bad',get)
+    data_cache.cached_get(cache,'http://a.com/bad',get) #failures are retried
+
+    assert gets == ['http://a.com/good','http://a.com/bad','http://a.com/bad']
+    assert (cache['hits'],cache['misses']) == (1,3)
+
+def test_offline_mode_replays_and_never_fetches(tmp_path,clock):
+    online = data_cache.open_cache(str(tmp_path/'http_cache'))
+    data_cache.cached_get(online,'http://a.com/1',lambda url: response(200,b'one'))
+    data_cache.close_cache(online)
+
+    offline = data_cache.open_cache(str(tmp_path/'http_cache'),offline=True)
+
+    assert data_cache.cached_get(offline,'http://A.com/1',never) == response(200,b'one')
+    assert data_cache.cached_get(offline,'http://a.com/2',never) == response(504,b'')
+    assert data_cache.lookup(offline,'http://a.com/2') is None #a miss is not stored
+    data_cache.close_cache(offline)
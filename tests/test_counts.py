@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""
+The per stratum aggregates of data_counts.py against a full rescan of media
+(data_analysis.scan_media), after the kinds of changes the triggers log:
+inserts, re-labels, re-crawled lyrics and deletes.
+"""
+
+import math
+
+import pytest
+
+import data_analysis
+from data_store import open_db, insert_songs, relabel, delete_songs, tokenize_media
+from data_counts import apply_deltas, rebuild_counts, stratum_word_counts, stratum_syllables
+
+
+songs = [('s1','a1',"love baby night love dance",'Rock','1981'),
+         ('s2','a2',"love heart heart zorp forever",'Rock','1985'),
+         ('s3','a3',"baby baby night tonight glarb",'Pop','1990'),
+         ('s4','a4',"dance dance love night zorp",'Pop','1999'),
+         ('s5','a5',"tonight heart love qwix",'Country','2003'),
+         ('s6','a6',"forever night baby",'Country','2010'),
+         ('s7','a7',"",'Hip-Hop','2007')]
+
+
+@pytest.fixture
+def conn(tmp_path,monkeypatch,syllable_table):
+    """
+    data_analysis' connection, to a database whose aggregates are built.
+    """
+    path = str(tmp_path/'songs.db')
+    conn = open_db(path)
+    insert_songs(conn,songs)
+    tokenize_media(conn)
+    apply_deltas(conn)
+
+    monkeypatch.setattr(data_analysis,'db_path',path)
+    monkeypatch.setattr(data_analysis,'conn',conn)
+
+    yield conn
+
+    conn.close()
+
+def rescan(by): #the word counts and syllabic averages of every stratum, from scratch
+    corpus, groups = data_analysis.scan_media([by])
+    table = data_analysis.corpus_word_counts(corpus,groups[by])
+    return data_analysis.table_dicts(table), data_analysis.count_syls(groups[by],corpus)
+
+def same_syllables(a,b):
+    return a.keys() == b.keys() and all(math.isnan(a[k]) and math.isnan(b[k]) or
+                                        a[k] == pytest.approx(b[k],rel=1e-12) for k in a.keys())
+
+def assert_matches_rescan(conn):
+    for by in ['genre','year','decade','calendar_decade']:
+        counts, syls = rescan(by)
+        table = stratum_word_counts(conn,by)
+
+        #strata without a single word have no counts to keep
+        assert data_analysis.table_dicts(table) == {key:words for key, words in counts.items() if words}
+        assert same_syllables(stratum_syllables(conn,by),syls)
+
+###############################################################################
+################################# TESTS #######################################
+###############################################################################
+def test_aggregates_match_a_rescan(conn):
+    assert_matches_rescan(conn)
+
+def test_aggregates_follow_relabels_deletes_and_inserts(conn):
+    relabel(conn,[('Pop',1),('Rock',6)])
+    delete_songs(conn,[('s4','a4')])
+    insert_songs(conn,[('s8','a8',"tonight tonight love",'Dance','2009'),
+                       ('s9','a9',"night zorp",'Rock','1982'),
+                       ('s3','a3',"baby night forever",'Pop','1990')]) #new lyrics for s3
+    tokenize_media(conn)
+
+    assert conn.execute("SELECT COUNT(*) FROM count_deltas").fetchone()[0] > 0
+    assert_matches_rescan(conn)
+
+    #a song moved out of a stratum for good leaves nothing behind
+    relabel(conn,[('Rock',1)])
+    delete_songs(conn,[('s5','a5'),('s6','a6')])
+    assert 'Country' not in stratum_word_counts(conn,'genre').keys
+    assert_matches_rescan(conn)
+
+def test_rebuild_gives_the_same_aggregates(conn):
+    relabel(conn,[('Dance',2)])
+    delete_songs(conn,[('s1','a1')])
+
+    before = {by:(data_analysis.table_dicts(stratum_word_counts(conn,by)),stratum_syllables(conn,by))
+              for by in ['genre','year']}
+    rebuild_counts(conn)
+
+    for by, (counts, syls) in before.items():
+        assert data_analysis.table_dicts(stratum_word_counts(conn,by)) == counts
+        assert same_syllables(stratum_syllables(conn,by),syls)
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""
+Smoke tests of the command line: every subcommand of lyrical.py runs
+against a small database from a scratch working directory (the files the
+subcommands write land there). crawl is only started (--startup-only), it
+would go to the network.
+"""
+
+import os
+
+import pytest
+
+import lyrical
+import data_analysis
+import data_pipeline
+import data_xtraction
+from data_store import open_db, insert_songs
+from data_text import legacy_open, legacy_close
+
+
+songs = [('s1','a1',"love baby night love dance",'Rock','1981'),
+         ('s2','a2',"love heart heart zorp forever",'Rock','1985'),
+         ('s3','a3',"baby baby night tonight glarb",'Pop','1990'),
+         ('s4','a4',"dance dance love night zorp",'Pop','1999'),
+         ('s5','a5',"tonight heart love qwix",'Country','2003'),
+         ('s6','a6',legacy_open + "forever night baby" + legacy_close,'Country','2010'),
+         ('s7','a7',"love night",'Electronic,Dance','2004')]
+
+
+@pytest.fixture
+def db(tmp_path,monkeypatch,syllable_table):
+    """
+    The path of a fresh database, with tmp_path as the working directory.
+    """
+    path = str(tmp_path/'songs.db')
+    conn = open_db(path)
+    insert_songs(conn,songs)
+    conn.close()
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(data_pipeline,'cmu_fingerprint',lambda: ['cmu',1]) #there is no compiled table to read
+    for module, conn_name in [(data_analysis,'conn'),(data_xtraction,'connect')]:
+        monkeypatch.setattr(module,'db_path',path)
+        monkeypatch.setattr(module,conn_name,None)
+
+    yield path
+
+    for module, conn_name in [(data_analysis,'conn'),(data_xtraction,'connect')]:
+        if getattr(module,conn_name) is not None:
+            getattr(module,conn_name).close()
+
+def run(db,*argv):
+    lyrical.main(['--db',db] + list(argv))
+
+###############################################################################
+################################# TESTS #######################################
+###############################################################################
+@pytest.mark.parametrize('argv',[['count'],['count','--by','genre,decade'],['count','--stream'],
+                                 ['count','--workers','2'],['count','--aggregates','--by','year']])
+def test_count(db,capsys,argv):
+    run(db,*argv)
+    out = capsys.readouterr().out
+
+    assert 'Rock' in out or '1981' in out
+    assert 'words' in out
+
+@pytest.mark.parametrize('argv',[['yule','--k','2'],['yule','--k','0','--sanitize'],
+                                 ['yule','--by','decade','--stream'],['yule','--aggregates']])
+def test_yule(db,capsys,argv):
+    run(db,*argv)
+    assert 'most  :' in capsys.readouterr().out
+
+def test_yule_write(db,tmp_path):
+    run(db,'yule','--write')
+    assert (tmp_path/'Rock_yules.txt').exists()
+
+def test_writes_need_100_coefficients(db):
+    for argv in [['yule','--k','5','--write'],['report','--k','5','--stats']]:
+        with pytest.raises(SystemExit):
+            run(db,*argv)
+
+@pytest.mark.parametrize('argv',[['syllables'],['syllables','--stream'],['syllables','--aggregates']])
+def test_syllables(db,capsys,argv):
+    run(db,*argv)
+    out = capsys.readouterr().out
+
+    #glarb, qwix, zorp and the tag left in s6 ('lyric') are not in the small cmudict of conftest
+    assert out.splitlines()[-1] == "4 words not in cmudict were estimated"
+
+def test_classify(db):
+    run(db,'classify')
+
+    conn = data_xtraction.db()
+    assert conn.execute("SELECT genre, genre_raw FROM media WHERE song_name = 's7'").fetchone() == ('Dance','Electronic,Dance')
+
+def test_dedupe(db,capsys):
+    run(db,'dedupe')
+    assert capsys.readouterr().out.strip() == "would drop 0 rows repeating an earlier (song, artist, year)"
+
+def test_normalize(db,capsys):
+    run(db,'normalize')
+    assert capsys.readouterr().out.strip() == "re-cleaned the lyrics of 1 songs"
+
+    conn = open_db(db)
+    assert conn.execute("SELECT lyrics FROM media WHERE song_name = 's6'").fetchone() == ("  forever night baby  ",)
+    conn.close()
+
+def test_plot(db,tmp_path):
+    matplotlib = pytest.importorskip('matplotlib')
+    matplotlib.use('Agg')
+
+    run(db,'plot','together')
+    assert (tmp_path/'everyone.png').exists()
+
+@pytest.mark.parametrize('argv',[['stats'],['stats','--aggregates']])
+def test_stats(db,argv):
+    run(db,*argv)
+
+    conn = data_analysis.db()
+    assert conn.execute("SELECT COUNT(*) FROM genre_stats").fetchone()[0] > 0
+    assert conn.execute("SELECT COUNT(*) FROM year_stats").fetchone()[0] > 0
+
+def test_windows(db,capsys):
+    run(db,'windows','--width','10','--step','10','--k','3')
+    out = capsys.readouterr().out
+
+    assert '1981-1990' in out and '2001-2010' in out
+
+def test_pairs(db,capsys,tmp_path):
+    run(db,'pairs','Rock','Pop','--k','3')
+
+    assert capsys.readouterr().out.splitlines()[0::3] == ['Rock vs Pop:','Pop vs Rock:']
+    assert os.listdir(str(tmp_path/'analysis_cache'))
+
+def test_report(db,capsys):
+    run(db,'report','--k','3','--by','decade')
+    assert capsys.readouterr().out.splitlines()[-1].startswith('recomputed: ')
+
+    #nothing changed: nothing is recomputed
+    run(db,'report','--k','3','--by','decade')
+    assert capsys.readouterr().out.splitlines()[-1].startswith('recomputed: nothing')
+
+def test_crawl_starts(db):
+    run(db,'--startup-only','crawl','1980')
+
+def test_startup(db,capsys):
+    run(db,'startup','--repeat','1')
+    out = capsys.readouterr().out
+
+    assert [line.split(':')[0].strip() for line in out.splitlines()] == [c for c in lyrical.command_modules if c != 'startup']
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+The write layer of data_store.py: the media upsert and the dedupe migration.
+"""
+
+import sqlite3
+import pytest
+
+from data_store import open_db, insert_songs, tokenize_media, dedupe_media, normalize_media
+from data_store import load_vocab, decode_tokens
+
+
+def media_rows(conn):
+    return conn.execute("SELECT song_name, artist_name, lyrics, genre, year, genre_raw, tokens "
+                        "FROM media ORDER BY rowid").fetchall()
+
+def media_changes(conn):
+    return conn.execute("SELECT changes FROM media_version").fetchone()[0]
+
+@pytest.fixture
+def conn(tmp_path):
+    conn = open_db(str(tmp_path/'songs.db'))
+    insert_songs(conn,[('s1','a1',"love baby",'Pop,Vocal','1982'),
+                       ('s2','a2',"night",'Rock','1982')])
+    tokenize_media(conn)
+    yield conn
+    conn.close()
+
+def test_upsert_same_song_changes_nothing(conn):
+    with conn: #a label from filter_genres
+        conn.execute("UPDATE media SET genre = 'Pop' WHERE song_name = 's1'")
+    before, changes = media_rows(conn), media_changes(conn)
+
+    insert_songs(conn,[('s1','a1',"love baby",'Pop,Vocal','1982'),
+                       ('s2','a2',"night",'Rock','1982')])
+
+    assert media_rows(conn) == before
+    assert media_changes(conn) == changes
+
+def test_upsert_writes_only_what_changed(conn):
+    with conn:
+        conn.execute("UPDATE media SET genre = 'Pop' WHERE song_name = 's1'")
+
+    #new lyrics, same raw genre: the label stays, the song is tokenized again
+    insert_songs(conn,[('s1','a1',"love baby love",'Pop,Vocal','1982')])
+    assert conn.execute("SELECT lyrics, genre, genre_raw, tokens IS NULL FROM media "
+                        "WHERE song_name = 's1'").fetchone() == ("love baby love",'Pop','Pop,Vocal',1)
+
+    #a new raw genre replaces the label, null lyrics keep the old ones
+    insert_songs(conn,[('s2','a2',None,'Jazz','1982')])
+    assert conn.execute("SELECT lyrics, genre, genre_raw, tokens IS NULL FROM media "
+                        "WHERE song_name = 's2'").fetchone() == ("night",'Jazz','Jazz',0)
+
+    #a new year of a song is a new row
+    insert_songs(conn,[('s2','a2',"night",'Rock','1983')])
+    assert conn.execute("SELECT COUNT(*) FROM media").fetchone()[0] == 3
+
+def test_dedupe_migration(tmp_path):
+    path = str(tmp_path/'old.db')
+
+    #a table from before media had its key, with a year crawled twice
+    old = sqlite3.connect(path)
+    old.execute("CREATE TABLE media (song_name text, artist_name text, lyrics text, genre text, year text)")
+    old.executemany("INSERT INTO media VALUES (?,?,?,?,?)",[('s1','a1',"x",'Rock','1980'),
+                                                            ('s2','a2',"y",'Pop','1980'),
+                                                            ('s1','a1',"x",'Rock','1980'),
+                                                            ('s1','a1',"z",'Rock','1980')])
+    old.commit()
+    old.close()
+
+    with pytest.raises(sqlite3.IntegrityError,match='dedupe'):
+        open_db(path)
+
+    #a dry run reports the rows and drops nothing
+    assert dedupe_media(path) == [(3,'s1','a1','1980',True),(4,'s1','a1','1980',False)]
+    assert dedupe_media(path) == [(3,'s1','a1','1980',True),(4,'s1','a1','1980',False)]
+
+    dedupe_media(path,apply=True)
+
+    conn = open_db(path)
+    assert media_rows(conn) == [('s1','a1',"x",'Rock','1980',None,None),('s2','a2',"y",'Pop','1980',None,None)]
+    conn.close()
+
+def test_normalize_media_matches_a_new_crawl(tmp_path):
+    from data_text import remove_chars, remove_chars_loop
+
+    raw  = "[<lyric>Call me, (call me)\nON the LINE</lyric>]"
+    conn = open_db(str(tmp_path/'songs.db'))
+    insert_songs(conn,[('old','a1',remove_chars_loop(raw,'lyrics'),'Rock','1980'),
+                       ('new','a1',remove_chars(raw,'lyrics'),'Rock','1981')])
+    tokenize_media(conn)
+
+    def words(song):
+        blob = conn.execute("SELECT tokens FROM media WHERE song_name = ?",(song,)).fetchone()[0]
+        return [load_vocab(conn)[i] for i in decode_tokens(blob)]
+
+    assert words('old') == ['lyric','call','me','call','me','on','the','line','lyric']
+    assert words('new') == ['call','me','call','me','on','the','line']
+
+    assert normalize_media(conn) == 1
+    assert words('old') == words('new')
+    assert normalize_media(conn) == 0
+    conn.close()
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+The compiled syllable table of data_syllables.py: when it is rebuilt, and
+that loading a current table never needs nltk.
+"""
+
+import json
+import sys
+import os
+
+import numpy as np
+import pytest
+
+import data_syllables
+
+
+@pytest.fixture
+def table(tmp_path,monkeypatch):
+    """
+    A compiled table of two words, built from a stand in cmudict file.
+    """
+    source = tmp_path/'cmudict'
+    source.write_text("love 1 L AH1 V\n")
+
+    directory = tmp_path/'syllable_table'
+    directory.mkdir()
+    np.save(str(directory/'cmu_words.npy'),np.array(['baby','love'],dtype=str))
+    np.save(str(directory/'cmu_starts.npy'),np.array([0,1,2],dtype=np.uint32))
+    np.save(str(directory/'cmu_counts.npy'),np.array([2,1],dtype=np.uint8))
+
+    info = os.stat(str(source))
+    with open(str(directory/'cmu.json'),'w') as meta_f:
+        json.dump({'source':[str(source),info.st_size,info.st_mtime_ns],'n_words':2},meta_f)
+
+    #compiling needs the real cmudict, only record that it was asked for
+    compiled = []
+    monkeypatch.setattr(data_syllables,'syllable_table',None)
+    monkeypatch.setattr(data_syllables,'compile_syllables',lambda directory=None: compiled.append(directory))
+
+    return {'source':source,'dir':str(directory),'compiled':compiled}
+
+def test_current_table_loads_without_nltk(table,monkeypatch):
+    monkeypatch.setitem(sys.modules,'nltk',None) #importing nltk would fail
+
+    loaded = data_syllables.load_syllables(table['dir'])
+
+    assert table['compiled'] == []
+    assert loaded['words'].tolist() == ['baby','love']
+    assert data_syllables.nsyl('Baby') == [2]
+
+def test_changed_cmudict_rebuilds_the_table(table):
+    assert data_syllables.table_current(table['dir'])
+
+    table['source'].write_text("love 1 L AH1 V\nbaby 1 B EY1 B IY0\n")
+    assert not data_syllables.table_current(table['dir'])
+
+    data_syllables.load_syllables(table['dir'])
+    assert table['compiled'] == [table['dir']]
+
+def test_missing_cmudict_or_table_rebuilds(table):
+    os.remove(os.path.join(table['dir'],'cmu_counts.npy'))
+    assert not data_syllables.table_current(table['dir'])
+
+    os.remove(str(table['source']))
+    assert not data_syllables.table_current(table['dir'])
+
+def test_table_lives_in_the_working_directory():
+    assert not os.path.isabs(data_syllables.table_dir)
+
+def test_syllable_vector_returns_its_misses(monkeypatch):
+    monkeypatch.setattr(data_syllables,'syllable_table',{'words' :np.array(['love'],dtype=str),
+                                                        'starts':np.array([0,1],dtype=np.uint32),
+                                                        'counts':np.array([1],dtype=np.uint8)})
+
+    syls, found = data_syllables.syllable_vector(['love','zorp','forever'])
+
+    assert found.tolist() == [True,False,False]
+    assert syls.tolist() == [1,data_syllables.syllables('zorp'),data_syllables.syllables('forever')]
+    assert not hasattr(data_syllables,'syllable_misses') #no state kept between calls
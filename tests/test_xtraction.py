@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""
+The database side of data_xtraction.py: genre classification and the 
+resumable crawl. Nothing here goes to the network.
+"""
+
+import pytest
+
+import data_xtraction
+from data_store import open_db, insert_songs, tokenize_media
+from data_counts import apply_deltas
+
+
+def media_rows(conn):
+    return conn.execute("SELECT * FROM media ORDER BY rowid").fetchall()
+
+def media_changes(conn):
+    return conn.execute("SELECT changes FROM media_version").fetchone()[0]
+
+@pytest.fixture
+def conn(tmp_path,monkeypatch,syllable_table):
+    """
+    data_xtraction's connection, to a fresh database of a few crawled songs.
+    """
+    conn = open_db(str(tmp_path/'songs.db'))
+    insert_songs(conn,[('s1','a1',"love baby",'Pop,Vocal','1982'),
+                       ('s2','a2',"night",'Rock,Pop','1982'),
+                       ('s3','a3',"dance",'Electronic,Dance','1982'),
+                       ('s4','a4',"oh",None,'1982')])
+    tokenize_media(conn)
+    monkeypatch.setattr(data_xtraction,'connect',conn)
+
+    yield conn
+
+    conn.close()
+
+def test_filter_genres_only_writes_changed_labels(conn):
+    data_xtraction.filter_genres()
+    labels  = conn.execute("SELECT genre, genre_raw FROM media ORDER BY rowid").fetchall()
+    changes = media_changes(conn)
+
+    assert labels == [('Pop','Pop,Vocal'),('Rock','Rock,Pop'),('Dance','Electronic,Dance'),("",None)]
+
+    #a second run has nothing to change
+    before = media_rows(conn)
+    data_xtraction.filter_genres()
+    assert media_rows(conn) == before
+    assert media_changes(conn) == changes
+
+def finish_songs(conn,songs): #the queue of a crawl whose items are done
+    data_xtraction.ensure_crawl_state(conn)
+    data_xtraction.queue_items(conn,[('1982','','','chart','')] +
+                                    [('1982',song,artist,stage,str(rank)) for rank, (song, artist, _, _) in 
+                                     enumerate(songs) for stage in ['lyrics','genre']])
+    data_xtraction.record_results(conn,[('done',None,'100','1982','','','chart')] +
+                                       [('done',None,lyrics,'1982',song,artist,'lyrics') for song, artist, lyrics, _ in songs] +
+                                       [('done',None,genre,'1982',song,artist,'genre') for song, artist, _, genre in songs])
+
+def test_resume_with_nothing_to_do_leaves_media_untouched(conn):
+    finish_songs(conn,[('s1','a1',"love baby",'Pop,Vocal'),('s5','a5',"heart",'Rock')])
+
+    data_xtraction.crawl_resumable([1982])
+    assert conn.execute("SELECT lyrics, genre FROM media WHERE song_name = 's5'").fetchone() == ("heart",'Rock')
+
+    data_xtraction.filter_genres()
+    apply_deltas(conn) #the aggregates are up to date, the log is empty
+    before, changes = media_rows(conn), media_changes(conn)
+
+    data_xtraction.crawl_resumable([1982])
+
+    #the labels of filter_genres ('Pop', not 'Pop,Vocal') and the tokens stay
+    assert media_rows(conn) == before
+    assert media_changes(conn) == changes
+    assert conn.execute("SELECT COUNT(*) FROM count_deltas").fetchone() == (0,)
+
+def test_resume_writes_only_new_songs(conn):
+    finish_songs(conn,[('s1','a1',"love baby",'Pop,Vocal')])
+    data_xtraction.crawl_resumable([1982])
+    data_xtraction.filter_genres()
+
+    #a song finished since: only it is written
+    finish_songs(conn,[('s6','a6',"tonight",'Dance')])
+    assert data_xtraction.finished_songs(conn,[1982]) == [('s6','a6',"tonight",'Dance','1982')]
+
+    data_xtraction.crawl_resumable([1982])
+    assert conn.execute("SELECT genre FROM media WHERE song_name = 's1'").fetchone() == ('Pop',)
+    assert conn.execute("SELECT lyrics, genre FROM media WHERE song_name = 's6'").fetchone() == ("tonight",'Dance')
+    assert data_xtraction.finished_songs(conn,[1982]) == []
+
+def scored_genre(genres,genre_weights): #one song at a time, over the nested dictionaries
+    scores = {pg:sum(sub.get(g,0) for g in (genres or "").split(",")) for pg, sub in genre_weights.items()}
+    best   = max(scores.values())
+    return "" if best <= 0 else [pg for pg, score in scores.items() if score == best][0]
+
+def test_classify_genres_matches_scoring_every_song():
+    genre_weights = data_xtraction.load_genre_weights()
+    compiled      = data_xtraction.compile_genre_weights(genre_weights)
+    all_genres    = ['Rock,Alternative,Pop,Heavy Metal,Rap','Pop,Vocal','Holiday','Holiday,Pop',
+                     'Electronic,Dance,Pop','Reggae','Jazz,Pop,Rock','Country,Pop/Rock',
+                     'Polka','',None,'Pop,Vocal','Soul,Disco,Rap,Hip-Hop']
+
+    expected = [scored_genre(genres,genre_weights) for genres in all_genres]
+    assert data_xtraction.classify_genres(all_genres,compiled) == expected
+    assert expected[:2] == ['Rock','Pop'] and expected[8:11] == ["","",""]
+
+def test_classify_genres_ties_and_shared_subgenres():
+    compiled = data_xtraction.compile_genre_weights({'Rock':{'Rock':1.0,'Both':0.5},
+                                                     'Pop' :{'Pop':1.0,'Both':0.7},
+                                                     'Jazz':{'Jazz':0.0}})
+
+    #ties go to the parent listed first, a subgenre votes for every parent it is under
+    assert data_xtraction.classify_genres(['Rock,Pop','Pop,Rock','Both','Rock,Both','Jazz','Nope,Other'],
+                                          compiled) == ['Rock','Rock','Pop','Rock',"",""]
+    assert data_xtraction.classify_genres([],compiled) == []